@@ -4,7 +4,23 @@
 # in the scene, and all code relating to it can be ignored.
 
 # Import all modules/libraries required to run the code.
-import arcade, os, math, sys
+import arcade, os, math, sys, json, hashlib, struct, zlib, re, time, argparse
+import platform, threading, random
+import pyglet, pytiled_parser
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from functools import partial
+from pathlib import Path
+from PIL import Image
+
+# NumPy is optional. It makes revealing the cave faster, but the game
+# works the same without it.
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 # Defining constants
 # This specifies the absolute path to the game folder on the user's
@@ -12,6 +28,268 @@ import arcade, os, math, sys
 # paths.
 MAIN_PATH = os.path.dirname(os.path.abspath(__file__))
 
+# Sprite atlas
+# These constants control the prebuilt sprite atlas, which packs all of
+# the small sprite images into a few large images so that the game
+# doesn't have to open hundreds of files every time it starts.
+# ATLAS_FOLDERS are the asset folders that get packed into the atlas.
+# ATLAS_PAGE_SIZE is the width and height (in pixels) of each atlas
+# image, and ATLAS_PADDING is the gap left between packed images so
+# that neighbouring frames don't bleed into each other.
+ATLAS_PATH = f"{MAIN_PATH}/assets/Atlas"
+ATLAS_MANIFEST = f"{ATLAS_PATH}/manifest.json"
+ATLAS_FOLDERS = ["Friendly", "Enemies", "InanimateObjects", "GUI", "Tiles"]
+ATLAS_PAGE_SIZE = 1024
+ATLAS_PADDING = 1
+
+# Compiled levels
+# The Tiled maps are compiled into a binary format the first time they
+# are loaded, which is stored next to the map and is much faster to
+# turn into sprites than the XML.
+# LEVEL_CACHE_EXTENSION is added to the end of the map file name to get
+# the compiled file name.
+# LEVEL_CACHE_MAGIC and LEVEL_CACHE_VERSION are written at the start of
+# every compiled file. The version is increased whenever the format
+# changes so that old compiled files get rebuilt.
+# LEVEL_CACHE_HEADER is the struct layout of the start of the file:
+# the magic bytes, the version, and the lengths of the JSON header and
+# of the compressed tile data that follow it.
+# COMPILED_LAYER_OPTIONS are the layer options the compiled loader
+# understands. Maps loaded with any other options use the XML loader.
+LEVEL_CACHE_EXTENSION = ".lvl"
+LEVEL_CACHE_MAGIC = b"ATLV"
+LEVEL_CACHE_VERSION = 1
+LEVEL_CACHE_HEADER = "<4sIII"
+COMPILED_LAYER_OPTIONS = [
+    "use_spatial_hash", 
+    "chunk_size", 
+    "collision_grid",
+]
+
+# Level cache
+# Levels which have already been built are kept in memory so that
+# going back to them (e.g. leaving a house through its warp door) is
+# nearly instant, and anything picked up in them stays picked up.
+# LEVEL_CACHE_BUDGET is roughly how much memory (in bytes) the cached
+# levels can use before the least recently visited ones are removed.
+# SPRITE_MEMORY_ESTIMATE is roughly how much memory each sprite in a
+# level uses, which is used to estimate the size of a cached level.
+# (The textures are shared by every level so they aren't counted)
+LEVEL_CACHE_BUDGET = 64 * 1024 * 1024
+SPRITE_MEMORY_ESTIMATE = 2560
+
+# Level prefetching
+# While a level is being played, the levels its warp doors and goal
+# portals lead to are loaded on a background thread, so that going
+# through a door doesn't have to wait for the map to load.
+# PREFETCH_THREADS is the number of background loading threads.
+PREFETCH_THREADS = 1
+
+# Level transitions
+# Going through a warp door or goal portal fades the screen out, loads
+# the next level in the background and then fades the screen back in.
+# TRANSITION_FADE_TIME is how long each fade takes (in seconds).
+# The TRANSITION_* phases are the steps of a transition in order.
+# LOADING_BAR_SIZE is the size of the progress bar drawn while the
+# level is loading (in pixels) and LOADING_BAR_Y_OFFSET is its height
+# above the bottom of the screen.
+TRANSITION_FADE_TIME = 0.25
+TRANSITION_FADE_OUT = "fade_out"
+TRANSITION_LOADING = "loading"
+TRANSITION_FADE_IN = "fade_in"
+LOADING_BAR_SIZE = (400, 8)
+LOADING_BAR_Y_OFFSET = 60
+
+# Physics benchmark
+# "python game.py bench-physics" runs the same player movement through
+# arcade's physics engine and the grid physics engine to compare them.
+# BENCHMARK_FRAMES is the number of frames each engine is run for.
+# BENCHMARK_TURN_FRAMES is how often the player turns around.
+# "python game.py check-physics" runs the same movement through both
+# engines without a window, and fails if the player's position or
+# speed is different after any frame.
+BENCHMARK_FRAMES = 1200
+BENCHMARK_TURN_FRAMES = 240
+
+# Level benchmarks
+# "python game.py bench" times setting up, updating and drawing every
+# map in the maps folder, and saves the results (and what they were
+# run on) as JSON, which later runs can be compared against.
+# BENCH_FRAMES is the number of frames each level is run for.
+# The player runs, turning around every BENCHMARK_TURN_FRAMES frames
+# and jumping every BENCH_JUMP_FRAMES frames, holding the jump key for
+# BENCH_JUMP_HOLD_FRAMES frames.
+# BENCH_THRESHOLD is how much slower than the baseline (as a fraction)
+# a time can be before it counts as a regression, and times which are
+# less than BENCH_MIN_DIFFERENCE slower (in milliseconds) never do.
+# BENCH_COMPARED are the times compared with the baseline, as the keys
+# to them in each level's results.
+BENCH_FRAMES = 600
+BENCH_JUMP_FRAMES = 90
+BENCH_JUMP_HOLD_FRAMES = 10
+BENCH_THRESHOLD = 0.1
+BENCH_MIN_DIFFERENCE = 0.05
+BENCH_COMPARED = [
+    ("cold_setup_ms",),
+    ("warm_setup_ms",),
+    ("update", "mean_ms"),
+    ("update", "p95_ms"),
+    ("draw", "mean_ms"),
+    ("draw", "p95_ms"),
+]
+
+# Stress maps
+# "python game.py stress-map" writes a large random map, to find out how
+# the game copes with much bigger levels than the real ones, and
+# "python game.py stress-curve" benchmarks maps of increasing size.
+# They are written to STRESS_FOLDER in the maps folder, and use the
+# STRESS_TILE_SIZE pixel tiles in STRESS_TILESET (STRESS_GRASS_TILE on
+# the top of the ground, STRESS_GROUND_TILE under it and in the
+# platforms, and STRESS_CAVE_TILE for the cave).
+# The ground is STRESS_GROUND_HEIGHT tiles high (just under where the
+# player starts, see PLAYER_START_Y), and no platforms are put in the
+# STRESS_CLEARANCE rows above it so the player can always run along it.
+# STRESS_DENSITY and STRESS_CAVE_DENSITY are the fractions of the tiles
+# above the ground which are platforms and cave.
+# STRESS_*_PER_TILE are the number of each kind of object put in a map
+# for each of its tiles, so 1000x1000 maps get 10,000 enemies and orbs.
+# STRESS_ENEMY_RANGE is how far (in tiles) enemies walk either way.
+# STRESS_ENEMY_TYPES and STRESS_COLLECTIBLE_TYPES are the kinds of
+# enemies and collectibles put in the maps (in turn).
+# STRESS_SIZES are the map widths and heights in a stress curve.
+# STRESS_SEED is the seed the maps are made from, so the same map is
+# always made from the same settings.
+STRESS_FOLDER = "stress"
+STRESS_TILESET = "Testing Tiles.tsx"
+STRESS_TILE_SIZE = 16
+STRESS_GRASS_TILE = 6
+STRESS_GROUND_TILE = 5
+STRESS_CAVE_TILE = 7
+STRESS_GROUND_HEIGHT = 17
+STRESS_CLEARANCE = 4
+STRESS_DENSITY = 0.05
+STRESS_CAVE_DENSITY = 0.02
+STRESS_ENEMIES_PER_TILE = 0.01
+STRESS_ORBS_PER_TILE = 0.01
+STRESS_COLLECTIBLES_PER_TILE = 0.002
+STRESS_VILLAGERS_PER_TILE = 0.0005
+STRESS_DOORS_PER_TILE = 0.0002
+STRESS_ENEMY_RANGE = 5
+STRESS_SIZES = [100, 250, 500, 1000]
+STRESS_SEED = 0
+STRESS_ENEMY_TYPES = ["Wraith", "Bird"]
+STRESS_COLLECTIBLE_TYPES = [
+    "Apple", 
+    "Card", 
+    "Document", 
+    "Helmet", 
+    "Rainbow Rock",
+]
+
+# Headless simulation
+# "python game.py simulate" runs the game logic without a window (and
+# without drawing anything), for benchmarks and automated playthroughs
+# on machines without a display.
+# HEADLESS_FRAMES is the number of steps simulated if none is given.
+HEADLESS_FRAMES = 3600
+
+# Input recordings
+# "python game.py record" saves the keys pressed while playing, with
+# the game step each one happened before, and "python game.py replay"
+# plays them back (in a window or headless). The game only reads the
+# keys between steps, so a replay always plays out the same way.
+# RECORDING_MAGIC and RECORDING_VERSION are written at the start of
+# every recording, and the version is increased whenever the format
+# changes.
+# RECORDING_HEADER is the struct layout of the start of the file: the
+# magic bytes, the version, the number of steps recorded, the number
+# of key events and the length of the starting level's name (which
+# follows the header).
+# RECORDING_EVENT is the struct layout of each key event: the step, the
+# key, and whether it was pressed (1) or released (0).
+# (Version 2 counts setting up a level during a level change as a step)
+RECORDING_MAGIC = b"ATIR"
+RECORDING_VERSION = 2
+RECORDING_HEADER = "<4sIIIH"
+RECORDING_EVENT = "<IIB"
+# "python game.py check-replay" records a headless run, plays it back
+# and checks that both ended the same way. By default the player starts
+# at the warp door to REPLAY_CHECK_WARP in REPLAY_CHECK_LEVEL, and a
+# run is recorded for each list of key events in REPLAY_CHECK_RUNS.
+# Each goes through the door and presses R (which resets the level the
+# player is in) during the level change, the first while the screen
+# fades out and while the next level loads, the second while it fades
+# back in, then runs and jumps for a while.
+# REPLAY_CHECK_FRAMES is the number of frames recorded.
+REPLAY_CHECK_LEVEL = "1.1"
+REPLAY_CHECK_WARP = "1.2"
+REPLAY_CHECK_FRAMES = 400
+REPLAY_CHECK_RUNS = [
+    [
+        (1, True, arcade.key.F),
+        (2, False, arcade.key.F),
+        (6, True, arcade.key.R),
+        (7, False, arcade.key.R),
+        (18, True, arcade.key.R),
+        (19, False, arcade.key.R),
+        (40, True, arcade.key.RIGHT),
+        (60, True, arcade.key.UP),
+        (70, False, arcade.key.UP),
+        (200, False, arcade.key.RIGHT),
+    ],
+    [
+        (1, True, arcade.key.F),
+        (2, False, arcade.key.F),
+        (19, True, arcade.key.R),
+        (20, False, arcade.key.R),
+        (40, True, arcade.key.RIGHT),
+        (60, True, arcade.key.UP),
+        (70, False, arcade.key.UP),
+        (200, False, arcade.key.RIGHT),
+    ],
+]
+
+# Frame profiler
+# Pressing PROFILER_KEY shows how long each part of the game takes
+# every frame (each game system, and drawing the scene, text and GUI),
+# as the average and the 95th and 99th percentile of the last few
+# frames. Nothing is timed while it's hidden.
+# PROFILER_FRAMES is the number of frames the numbers are worked out
+# from, and PROFILER_REFRESH_FRAMES is how often the numbers shown are
+# worked out again.
+# PROFILER_PERCENTILES are the percentiles shown (as fractions).
+# PROFILER_POSITION is the top left corner of the overlay (in pixels)
+# and PROFILER_LINE_HEIGHT is the gap between its lines.
+# PROFILER_NAME_WIDTH is the width of the column of part names and
+# PROFILER_COLUMN_WIDTH is the width of each column of numbers.
+# TEXT_BATCH_PROFILER is the name of the group of text it draws.
+PROFILER_KEY = arcade.key.F3
+PROFILER_FRAMES = 240
+PROFILER_REFRESH_FRAMES = 30
+PROFILER_PERCENTILES = (0.95, 0.99)
+PROFILER_POSITION = (20, 1000)
+PROFILER_LINE_HEIGHT = 20
+PROFILER_NAME_WIDTH = 220
+PROFILER_COLUMN_WIDTH = 80
+TEXT_BATCH_PROFILER = "profiler"
+
+# Tracing
+# "--trace FILE" (on the simulate, record and replay commands) records
+# when every level setup phase, game system, drawing pass, transition
+# phase and background level load starts and ends, and saves them as a
+# Chrome trace which can be opened in Perfetto or chrome://tracing.
+# TRACE_EVENTS is the most spans kept. Once there are this many the
+# oldest ones are dropped, so long sessions don't keep using more
+# memory.
+TRACE_EVENTS = 200000
+
+# Tile flip flags
+# Tiled stores flipped tiles by setting the top bits of the tile id.
+FLIPPED_HORIZONTALLY_FLAG = 0x80000000
+FLIPPED_VERTICALLY_FLAG = 0x40000000
+FLIPPED_DIAGONALLY_FLAG = 0x20000000
+TILE_ID_MASK = 0x1FFFFFFF
+
 # Window Settings
 # Constants that store window dimensions and window name.
 # ONE_BLOCK refers to cases where a distance of one ingame block is
@@ -44,11 +322,20 @@ MAX_OPACITY = 255
 # on the screen.
 # CHAR_WIDTH refers to the approximate width of each character in the
 # font range 14-18
+# TEXT_FONT_NAMES are the fonts the text is drawn in (the first one
+# that is installed is used), which are the same as arcade's default.
+# TEXT_BATCH_MAP, TEXT_BATCH_GAME and TEXT_BATCH_GUI are the names of
+# the groups of text drawn on the map (under the popups), with the game
+# camera and with the GUI camera.
 TIPS_FONT = 14
 DIALOGUE_FONT = 15
 INTERACT_FONT = 18
 QUEST_FONT = 20
 CHAR_WIDTH = 10
+TEXT_FONT_NAMES = ("calibri", "arial")
+TEXT_BATCH_MAP = "map"
+TEXT_BATCH_GAME = "game"
+TEXT_BATCH_GUI = "gui"
 
 # Background rectangle sizes
 # These constants determine the dimensions and features of the
@@ -155,6 +442,104 @@ FRAMERATE = 1 / 60
 CAMERA_TRACK_SPEED = 0.2
 NOTHING = 0
 
+# Fixed timestep
+# The game logic (physics, enemies and timers) always moves forward in
+# steps of the same length no matter how fast the screen is drawn, so
+# the game plays the same at any framerate. The sprites which move are
+# drawn part of the way between their last two positions so movement
+# still looks smooth when the screen is drawn faster than the steps.
+# SIMULATION_STEP is the length of one step (in seconds). All of the
+# speeds in the game are per step, so this should stay at 60 steps/sec.
+# MAX_SIMULATION_STEPS is the most steps run for one drawn frame, so a
+# very slow frame makes the game slow down instead of freezing while it
+# tries to catch up.
+# RENDER_RATE is how often the screen is drawn (in seconds).
+# TIMER_RESOLUTION is the Windows timer resolution (in milliseconds)
+# asked for while the game runs. The default one (about 15.6 ms) can't
+# wake pyglet's clock up often enough to draw at RENDER_RATE.
+# INTERPOLATION_SNAP_DISTANCE is how far (in pixels) a sprite can move
+# in one step before it counts as teleporting (e.g. respawning), which
+# is drawn straight at the new position instead.
+SIMULATION_STEP = FRAMERATE
+MAX_SIMULATION_STEPS = 5
+RENDER_RATE = 1 / 144
+TIMER_RESOLUTION = 1
+INTERPOLATION_SNAP_DISTANCE = 200
+
+# Menu screens
+# The menu, instructions and end screens are just a picture, so they
+# are updated and redrawn much less often than the game.
+# MENU_FRAME_RATE is how often those screens are redrawn (in seconds).
+# END_SCREEN_SECRETS are the secrets in the order of the digits in the
+# end screen image names (a digit is 1 if the secret was found).
+MENU_FRAME_RATE = 1 / 10
+END_SCREEN_SECRETS = ["Statuette", "Diamond Pickaxe", "Diamond", "Totem"]
+
+# Cave fog
+# When shaders are available the Cave layer is drawn to an offscreen
+# image first, and then drawn onto the screen through the fog shader,
+# which makes it see-through around the player. This replaces changing
+# the opacity of every cave tile. The squares the player has been near
+# are remembered in a small "explored" image (one pixel per tile) so
+# they stay partly see-through afterwards, like the tiles used to.
+# CAVE_FOG_VERTEX_SHADER draws a quad over the whole image,
+# CAVE_EXPLORED_SHADER marks the squares near the player as explored
+# and CAVE_FOG_SHADER draws the cave with the hole cut out of it.
+CAVE_FOG_VERTEX_SHADER = """
+#version 330
+in vec2 in_vert;
+in vec2 in_uv;
+out vec2 uv;
+void main() {
+    gl_Position = vec4(in_vert, 0.0, 1.0);
+    uv = in_uv;
+}
+"""
+CAVE_EXPLORED_SHADER = """
+#version 330
+uniform vec2 map_size;
+uniform vec2 player;
+uniform float reveal_distance;
+in vec2 uv;
+out vec4 fragColor;
+void main() {
+    if (distance(uv * map_size, player) >= reveal_distance) {
+        discard;
+    }
+    fragColor = vec4(1.0);
+}
+"""
+CAVE_FOG_SHADER = """
+#version 330
+uniform sampler2D cave;
+uniform sampler2D explored;
+uniform vec2 view_origin;
+uniform vec2 view_size;
+uniform vec2 map_size;
+uniform vec2 player;
+uniform float reveal_distance;
+uniform float transparent_distance;
+in vec2 uv;
+out vec4 fragColor;
+void main() {
+    vec4 colour = texture(cave, uv);
+    if (colour.a == 0.0) {
+        discard;
+    }
+    vec2 world = view_origin + uv * view_size;
+    float distance_to_player = distance(world, player);
+    float edge = (reveal_distance - transparent_distance) / reveal_distance;
+    float opacity;
+    if (distance_to_player < reveal_distance) {
+        opacity = max(distance_to_player - transparent_distance, 0.0)
+            / reveal_distance;
+    } else {
+        opacity = mix(1.0, edge, texture(explored, world / map_size).r);
+    }
+    fragColor = vec4(colour.rgb, colour.a * opacity);
+}
+"""
+
 # Level categories
 # These constants place the levels and sublevels into two categories.
 # These are used to determine the background colour of the level.
@@ -192,6 +577,113 @@ LAYER_NAME_CAVE = "Cave"
 LAYER_NAME_DEATH = "Death"
 LAYER_NAME_DOOR_BARRIERS_OPEN = "Door Barrier Open"
 LAYER_NAME_DOOR_BARRIERS_CLOSED = "Door Barrier Closed"
+LAYER_NAME_CLOUDS = "Clouds"
+LAYER_NAME_FOREGROUND = "Foreground"
+
+# Layer options
+# Layer specific options for Tilemap
+# These determine whether a tile layer acts as a wall or not.
+# Layers with a chunk size are also split into square chunks of that
+# many tiles across, so only the chunks on screen need to be drawn.
+# Layers with collision_grid get a collision grid, which stores the
+# hit box of the tile in each grid square so the physics engine only
+# has to check the squares the player is touching.
+CHUNK_SIZE = 16
+LAYER_OPTIONS = {
+    LAYER_NAME_BACKGROUND: {
+        "chunk_size": CHUNK_SIZE,
+    },
+    LAYER_NAME_PLATFORMS: {
+        "use_spatial_hash": True,
+        "chunk_size": CHUNK_SIZE,
+        "collision_grid": True,
+    },
+    LAYER_NAME_CAVE: {
+        "chunk_size": CHUNK_SIZE,
+    },
+    LAYER_NAME_CLOUDS: {
+        "chunk_size": CHUNK_SIZE,
+    },
+    LAYER_NAME_FOREGROUND: {
+        "chunk_size": CHUNK_SIZE,
+    },
+    LAYER_NAME_STATUES: {
+        "use_spatial_hash": True,
+    },
+    LAYER_NAME_LADDERS: {
+        "use_spatial_hash": False,
+        "collision_grid": True,
+    },
+    LAYER_NAME_MOVING_PLATFORMS: {
+        "use_spatial_hash": False,
+    },
+    LAYER_NAME_DEATH: {
+        "use_spatial_hash": True,
+    },
+    LAYER_NAME_DOOR_BARRIERS_OPEN: {
+        "use_spatial_hash": False
+    },
+    LAYER_NAME_DOOR_BARRIERS_CLOSED: {
+        "use_spatial_hash": True,
+        "collision_grid": True,
+    },
+    LAYER_NAME_COLLECTIBLES: {
+        "use_spatial_hash": True
+    },
+    LAYER_NAME_WARP_DOORS: {
+        "use_spatial_hash": True
+    },
+    LAYER_NAME_LOCKED_DOORS: {
+        "use_spatial_hash": True
+    },
+}
+
+# Interpolated layers
+# The layers with sprites that move every step, which are drawn between
+# their last two positions (see "Fixed timestep" above).
+INTERPOLATED_LAYERS = [
+    LAYER_NAME_PLAYER,
+    LAYER_NAME_ENEMIES,
+    LAYER_NAME_MOVING_PLATFORMS,
+    LAYER_NAME_KNIFE,
+]
+
+# Collision events
+# The event sent to the collision handlers for each sprite the player
+# touches in these layers. (See CollisionPhase)
+COLLECTIBLE_PICKED = "collectible picked"
+ORB_PICKED = "orb picked"
+DOOR_TOUCHED = "door touched"
+ENEMY_TOUCHED = "enemy touched"
+GOAL_REACHED = "goal reached"
+COLLISION_EVENTS = {
+    LAYER_NAME_COLLECTIBLES: COLLECTIBLE_PICKED,
+    LAYER_NAME_ORBS: ORB_PICKED,
+    LAYER_NAME_LOCKED_DOORS: DOOR_TOUCHED,
+    LAYER_NAME_ENEMIES: ENEMY_TOUCHED,
+    LAYER_NAME_GOAL: GOAL_REACHED,
+}
+
+# The layers whose collisions are checked using the interactable index
+# (see InteractableIndex) instead of the whole layer.
+INDEXED_COLLISION_LAYERS = [LAYER_NAME_STATUES, LAYER_NAME_GOAL]
+
+# Large object layers
+# The layers made from object layers have no spatial hash (their sprites
+# are added one at a time), and arcade checks collisions with sprite
+# lists of more than LARGE_LAYER_SPRITES sprites without a spatial hash
+# on the GPU, which doesn't work without a window. The
+# LARGE_OBJECT_LAYERS which are bigger than this (e.g. in stress maps)
+# get a spatial hash instead.
+LARGE_LAYER_SPRITES = 1500
+LARGE_OBJECT_LAYERS = [
+    LAYER_NAME_VILLAGERS,
+    LAYER_NAME_ENEMIES,
+    LAYER_NAME_GOAL,
+    LAYER_NAME_ORBS,
+    LAYER_NAME_COLLECTIBLES,
+    LAYER_NAME_LOCKED_DOORS,
+]
 
 # GUI Layers
 # These are the layers which are added to the GUI scene,
@@ -266,87 +758,26 @@ NEW_SPAWNPOINT_TIME = 2
 # occur, or things are revealed.
 # CAVE_TRNSPT_DIST means the distance at which cave blocks become fully
 # transparent.
+# INTERACTION_CELL_SIZE is the size (in blocks) of the grid squares the
+# doors, villagers, statues and goal portals are indexed in. It must be
+# bigger than every interaction distance and than half the player.
 MIN_STATUE_DIST = 2
 CAVE_REVEAL_DIST = 10
 CAVE_TRNSPT_DIST = 5
+INTERACTION_CELL_SIZE = 4
 
 # Volume constants
 MUSIC_VOLUME = 0.3
 
-# Dictionary References
-# QUEST_REF is the dictionary which stores all of the quest information
+# Quest data
+# QUEST_DATA is the file which stores all of the quest information
 # corresponding to each villager id.
-# Each nested dictionary contains the quest dialogue, the amount of
-# time it displays for, the item and quantity required, and the
-# item and quantity of the reward.
-# The string concatenation is used to keep line length within standard.
-QUEST_REF = {
-    "000": {
-        "dialogue": (
-            "I'm getting too old to climb trees,"
-            +" can you please pick 3 apples for me?"
-            ),
-        "dialogue_time": 3,
-        "item": "Apple",
-        "number": 3,
-        "reward_item": "Energy",
-        "reward_num": 1 
-    },
-    "001": {
-        "dialogue": (
-            "Heya, I dropped my card on the other side" 
-            +" of that wraith over there, could you grab it for me?"
-            ),
-        "dialogue_time": 4,
-        "item": "Card",
-        "number": 1,
-        "reward_item": "Energy",
-        "reward_num": 1 
-    },
-    "002": {
-        "dialogue": (
-            "I've been looking for a legal document in my basement,"
-            +" can you find it for me?"
-            +" I'll give you this knife if you find it."
-            ),
-        "dialogue_time": 5,
-        "item": "Document",
-        "number": 1,
-        "reward_item": "Knife",
-        "reward_num": 1
-    },
-    "003": {
-        "dialogue": (
-            "Please kill the wraith over there,"
-            +" we need to be able to access the church."
-            +" I can grant you access if you kill it."
-            ),
-        "dialogue_time": 5,
-        "item": "Ectoplasm",
-        "number": 1,
-        "reward_item": "Church Key",
-        "reward_num": 1
-    },
-    "100": {
-        "dialogue": (
-            "Help, I've lost my helmet."+
-            " Get it for me so I can keep mining and I'll give you a key."
-            ),
-        "dialogue_time": 5,
-        "item": "Helmet",
-        "number": 1,
-        "reward_item": "Cave Key",
-        "reward_num": 1
-    },
-    "200": {
-        "dialogue": "I get rainbow rock. You get key of god. Deal?",
-        "dialogue_time": 3,
-        "item": "Rainbow Rock",
-        "number": 1,
-        "reward_item": "God Key",
-        "reward_num": 1
-    }
-}
+# Each quest contains the quest dialogue, the amount of time it
+# displays for, the item and quantity required (and the item's name in
+# the quest inventory), and the item, inventory type and quantity of
+# the reward. Energy rewards have no inventory type as energy isn't
+# kept in the inventory.
+QUEST_DATA = f"{MAIN_PATH}/assets/Data/quests.json"
 
 # Loading mirrored sprites
 def load_texture_pair(filename):
@@ -372,204 +803,2990 @@ def calculate_distance(pos_1, pos_2):
     distance_y = pos_1[Y_POS] - pos_2[Y_POS]
     return math.sqrt(distance_x**2 + distance_y**2)
 
+# Changing the frame rate
+def set_frame_rate(frame_rate):
+    """
+    Changes how often (in seconds) the window is updated and drawn.
+    arcade only lets the update rate be changed, so the redraw that
+    pyglet's event loop schedules is moved to the new rate as well.
+    (Before the event loop starts only the update rate is changed)
+    """
+    arcade.get_window().set_update_rate(frame_rate)
+    # The redraw is scheduled with the event loop's private
+    # _redraw_windows method, which is there in pyglet 2.0.dev23 (the
+    # version arcade 2.6 uses). If another version of pyglet doesn't
+    # have it, only the update rate is changed.
+    event_loop = pyglet.app.event_loop
+    redraw_windows = getattr(event_loop, "_redraw_windows", None)
+    if event_loop.is_running and redraw_windows is not None:
+        pyglet.clock.unschedule(redraw_windows)
+        pyglet.clock.schedule_interval(redraw_windows, frame_rate)
+
+@contextmanager
+def timer_resolution(milliseconds):
+    """
+    Asks Windows for a finer timer while the with block runs, the same
+    way arcade.run() does. (Other platforms don't need it)
+    """
+    if sys.platform != "win32":
+        yield
+        return
+    import ctypes
+    winmm = ctypes.WinDLL("winmm")
+    # (A resolution the timer can't do is an error, and is ignored)
+    if winmm.timeBeginPeriod(milliseconds) != NOTHING:
+        yield
+        return
+    try:
+        yield
+    finally:
+        winmm.timeEndPeriod(milliseconds)
 
-# Entity superclass
-class Entity(arcade.Sprite):
-    """Overarching class for every sprite."""
 
-    def __init__(self, category_folder, sprite_folder, available_anims: list):
+def run_event_loop(frame_rate):
+    """
+    Starts pyglet's event loop, drawing every frame_rate seconds.
+    (arcade.run() always draws at 60 fps, so the game starts the loop
+    itself, with the finer timer arcade.run() uses on Windows)
+    """
+    with timer_resolution(TIMER_RESOLUTION):
+        pyglet.app.run(frame_rate)
+
+# End screen image
+def end_screen_image(secrets_found):
+    """
+    Returns the path (relative to the assets folder) of the end screen
+    image for a list of found secrets.
+    Using by checking which secrets are present in the found list
+    a unique string of numbers can be created for each
+    combination of secrets. This is subsequently the file name
+    for each background image.
+    """
+    secrets_to_display = ""
+    for secret in END_SCREEN_SECRETS:
+        if secret in secrets_found:
+            secrets_to_display += "1"
+        else:
+            secrets_to_display += "0"
+    return f"Screens/End/{secrets_to_display}.PNG"
+
+
+# Sprite atlas
+def atlas_source_images():
+    """
+    Returns the path (relative to the assets folder) of every image in
+    the ATLAS_FOLDERS, which are the images packed into the atlas.
+    """
+    images = []
+    for folder in ATLAS_FOLDERS:
+        for root, dirs, files in os.walk(f"{MAIN_PATH}/assets/{folder}"):
+            for file in files:
+                if not file.lower().endswith(".png"):
+                    continue
+                images.append(
+                    os.path.relpath(
+                        os.path.join(root, file), f"{MAIN_PATH}/assets"
+                        ).replace(os.sep, "/")
+                    )
+    return images
+
+def build_sprite_atlas():
+    """
+    Offline build step which packs every sprite image in the
+    ATLAS_FOLDERS into atlas pages, and writes a manifest of the frame
+    rectangles and animation lengths next to them.
+    Run with: python game.py build-atlas
+    """
+
+    # Find every image to pack. The path of each image relative to the
+    # assets folder is used as its name in the manifest.
+    images = []
+    newest_source = NOTHING
+    for relative in atlas_source_images():
+        path = f"{MAIN_PATH}/assets/{relative}"
+        newest_source = max(newest_source, os.path.getmtime(path))
+        images.append((relative, Image.open(path).convert("RGBA")))
+
+    # Pack the images into shelves (rows), tallest images first, so
+    # that each shelf wastes as little space as possible. Once a page
+    # is full a new one is started.
+    images.sort(key=lambda item: (-item[1].height, -item[1].width, item[0]))
+    pages = []
+    page_heights = []
+    frames = {}
+    # Starting at the far corner forces the first image onto a new page.
+    x = y = shelf_height = ATLAS_PAGE_SIZE
+    for relative, image in images:
+        width, height = image.size
+        if width > ATLAS_PAGE_SIZE or height > ATLAS_PAGE_SIZE:
+            raise ValueError(f"{relative} is too big for an atlas page")
+        if x + width > ATLAS_PAGE_SIZE:
+            x = FIRST_VALUE
+            y += shelf_height + ATLAS_PADDING
+            shelf_height = NOTHING
+        if y + height > ATLAS_PAGE_SIZE:
+            pages.append(
+                Image.new("RGBA", (ATLAS_PAGE_SIZE, ATLAS_PAGE_SIZE))
+                )
+            page_heights.append(NOTHING)
+            x = y = shelf_height = FIRST_VALUE
+        pages[-INDEX_OFFSET].paste(image, (x, y))
+        frames[relative] = [len(pages) - INDEX_OFFSET, x, y, width, height]
+        page_heights[-INDEX_OFFSET] = max(
+            page_heights[-INDEX_OFFSET], y + height
+            )
+        shelf_height = max(shelf_height, height)
+        x += width + ATLAS_PADDING
+
+    # Any folder of numbered images (0.png, 1.png, ...) is an
+    # animation, and its length is the number of frames in it.
+    animations = {}
+    for relative in frames:
+        folder, file = os.path.split(relative)
+        if file[:-len(".png")].isdigit():
+            animations[folder] = animations.get(folder, NOTHING) + 1
+    for folder, frame_num in list(animations.items()):
+        for i in range(frame_num):
+            if f"{folder}/{i}.png" not in frames:
+                # Frames with gaps in their numbering can't be played
+                # back in order, so they stay loose images.
+                del animations[folder]
+                break
+
+    # Save the pages (trimmed to the space actually used) and the
+    # manifest.
+    os.makedirs(ATLAS_PATH, exist_ok=True)
+    page_names = []
+    for i, page in enumerate(pages):
+        page_names.append(f"atlas_{i}.png")
+        page.crop(
+            (FIRST_VALUE, FIRST_VALUE, ATLAS_PAGE_SIZE, page_heights[i])
+            ).save(f"{ATLAS_PATH}/{page_names[i]}")
+    manifest = {
+        "source_mtime": newest_source,
+        "pages": page_names,
+        "frames": frames,
+        "animations": animations,
+    }
+    with open(ATLAS_MANIFEST, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=1)
+    print(
+        f"Packed {len(frames)} images ({len(animations)} animations)"
+        +f" into {len(pages)} atlas page(s) in {ATLAS_PATH}"
+        )
+
+class SpriteAtlas:
+    """
+    Runtime side of the prebuilt sprite atlas.
+    Reads the manifest written by build_sprite_atlas() and cuts the
+    frames back out of the atlas pages.
+    """
+
+    def __init__(self, manifest_path=ATLAS_MANIFEST):
         """
-        Initialises all of the texture lists relevant to the entity.
-        Default texture is the first idle texture.
+        Initialises the atlas. The manifest is only read the first
+        time a frame is asked for.
+        manifest:   The manifest, or None if the atlas isn't used.
+        loaded:     Whether the manifest has been read yet.
+        lock:       Stops two threads (e.g. the level loading thread
+                    and the main thread) reading the manifest at once.
         """
-        # Inherit from parent class (arcade.Sprite)
-        super().__init__()
+        self.manifest_path = manifest_path
+        self.manifest = None
+        self.loaded = False
+        self.lock = threading.Lock()
 
-        # Default right facing
-        self.facing_direction = RIGHT_FACING
+    def load(self):
+        """
+        Reads the manifest, unless another thread already has.
+        loaded is only set once manifest has been, so a thread which
+        sees loaded always sees the manifest too.
+        """
+        with self.lock:
+            if self.loaded:
+                return
+            self.manifest = self.read_manifest()
+            self.loaded = True
 
-        # Set the current texture index to 0, which is the first
-        # texture. Scale the textures by CHARACTER_SCALING by default.
-        # (This can be overidden in child classes).
-        self.cur_texture = FIRST_TEXTURE
-        self.scale = CHARACTER_SCALING
+    def read_manifest(self):
+        """
+        Returns the manifest, or None if the atlas shouldn't be used.
+        If there is no manifest, or any of the images in the
+        ATLAS_FOLDERS have been added, removed or changed since the
+        atlas was built, the loose images are used instead.
+        """
+        try:
+            with open(self.manifest_path) as manifest_file:
+                manifest = json.load(manifest_file)
+            sources = atlas_source_images()
+            if set(sources) != set(manifest["frames"]) or any(
+                os.path.getmtime(f"{MAIN_PATH}/assets/{relative}")
+                > manifest["source_mtime"]
+                for relative in sources
+                ):
+                print("Sprite atlas is out of date, using loose images")
+                return None
+        except (OSError, ValueError, KeyError):
+            return None
+        return manifest
+
+    def has_animation(self, animation_path):
+        """Checks if an animation folder is packed into the atlas."""
+        if not self.loaded:
+            self.load()
+        return (
+            self.manifest is not None
+            and animation_path in self.manifest["animations"]
+            )
 
-        # Define the main path accessed in this class.
-        main_path = f"{MAIN_PATH}/assets/{category_folder}/{sprite_folder}"
+    def has_image(self, relative_path):
+        """Checks if a single image is packed into the atlas."""
+        if not self.loaded:
+            self.load()
+        return (
+            self.manifest is not None
+            and relative_path in self.manifest["frames"]
+            )
 
-        # The below section loads the image files into lists
-        # based on the animation they are a part of.
-        # Since all of the code is essentially the same here,
-        # I'll just put the explanation up here for the whole thing.
-        # The program first uses the os library to find the number of
-        # files in the image folder for the animation.
+    def get_texture(self, relative_path, flipped_horizontally=False):
+        """
+        Cuts one image out of its atlas page.
+        Arcade only opens each page file once and crops every frame
+        from the copy it keeps in memory.
+        """
+        page, x, y, width, height = self.manifest["frames"][relative_path]
+        return arcade.load_texture(
+            f"{ATLAS_PATH}/{self.manifest['pages'][page]}",
+            x,
+            y,
+            width,
+            height,
+            flipped_horizontally=flipped_horizontally,
+        )
+
+    def get_animation(self, animation_path):
+        """
+        Returns the list of texture pairs (original and mirrored) for
+        every frame in a packed animation.
+        """
+        pairs = []
+        for i in range(self.manifest["animations"][animation_path]):
+            relative = f"{animation_path}/{i}.png"
+            pairs.append([
+                self.get_texture(relative),
+                self.get_texture(relative, flipped_horizontally=True),
+            ])
+        return pairs
+
+# The one atlas used by the whole game.
+SPRITE_ATLAS = SpriteAtlas()
+
+# Shared texture registry
+class TextureRegistry:
+    """
+    Process-wide store of the animation frames used by every entity.
+    Frames are keyed by (category_folder, sprite_folder, animation,
+    facing), so all instances of a sprite share one set of textures.
+    """
+
+    def __init__(self):
+        """
+        Initialises the texture dictionaries and the counters.
+        textures:   The list of textures for each animation and facing
+                    direction.
+        pairs:      The list of texture pairs for each animation, which
+                    is the format the entities index their textures in.
+        images:     Single images (like the GUI bars) by their path
+                    relative to the assets folder.
+        hits:       Number of times an animation was already loaded.
+        misses:     Number of times an animation had to be loaded from
+                    the disk.
+        """
+        self.textures = {}
+        self.pairs = {}
+        self.images = {}
+        self.hits = NOTHING
+        self.misses = NOTHING
+
+    def get_animation(self, category_folder, sprite_folder, animation):
+        """
+        Returns the list of texture pairs for an animation, loading
+        the frames from the disk only the first time they are needed.
+        """
+        animation_key = (category_folder, sprite_folder, animation)
+        if animation_key in self.pairs:
+            self.hits += UNIT_INCREMENT
+            return self.pairs[animation_key]
+        self.misses += UNIT_INCREMENT
+
+        # If the animation has been packed into the sprite atlas the
+        # frames are cut out of the atlas pages.
+        # Otherwise the program uses the os library to find the number
+        # of files in the image folder for the animation.
         # Because the only files in the folders are the images,
         # we can just count the number of files in the folder which
         # corresponds to the number of frames in the animation.
         # Then for each image in the animation folder we load the
-        # texture pair generated into the animation texture list,
-        # while also saving the number of frames in the animation
-        # for later.
-        if "Idle" in available_anims:
-            # Idle frames
-            frame_num = FIRST_TEXTURE
-            for path in os.listdir(f"{main_path}/idle"):
-                frame_num += UNIT_INCREMENT
-
-            self.idle_frames = frame_num
-            self.idle_textures = []
+        # texture pair into the animation texture list.
+        atlas_path = f"{category_folder}/{sprite_folder}/{animation}"
+        if SPRITE_ATLAS.has_animation(atlas_path):
+            pairs = SPRITE_ATLAS.get_animation(atlas_path)
+        else:
+            main_path = f"{MAIN_PATH}/assets/{atlas_path}"
+            frame_num = len(os.listdir(main_path))
+            pairs = []
             for i in range(frame_num):
-                texture = load_texture_pair(f"{main_path}/idle/{i}.png")
-                self.idle_textures.append(texture)
+                pairs.append(load_texture_pair(f"{main_path}/{i}.png"))
 
-        if "Jump" in available_anims:
-            # Jumping and falling sprites
-            frame_num = FIRST_TEXTURE
-            for path in os.listdir(f"{main_path}/jump"):
-                frame_num += UNIT_INCREMENT
+        # Store the textures for each facing direction separately as
+        # well as in pairs.
+        for facing in (RIGHT_FACING, LEFT_FACING):
+            self.textures[animation_key + (facing,)] = [
+                pair[facing] for pair in pairs
+                ]
+        self.pairs[animation_key] = pairs
+        return pairs
 
-            self.jump_frames = frame_num
-            self.jump_textures = []
-            for i in range(frame_num):
-                texture = load_texture_pair(f"{main_path}/jump/{i}.png")
-                self.jump_textures.append(texture)
+    def get(self, category_folder, sprite_folder, animation, facing):
+        """
+        Returns the list of textures of an animation for one facing
+        direction.
+        """
+        self.get_animation(category_folder, sprite_folder, animation)
+        return self.textures[
+            (category_folder, sprite_folder, animation, facing)
+            ]
 
-            frame_num = FIRST_TEXTURE
-            for path in os.listdir(f"{main_path}/fall"):
-                frame_num += UNIT_INCREMENT
+    def get_image(self, relative_path):
+        """
+        Returns the texture of a single image, given its path relative
+        to the assets folder (e.g. "GUI/Energy/0.png").
+        """
+        if relative_path in self.images:
+            self.hits += UNIT_INCREMENT
+            return self.images[relative_path]
+        self.misses += UNIT_INCREMENT
+        if SPRITE_ATLAS.has_image(relative_path):
+            texture = SPRITE_ATLAS.get_texture(relative_path)
+        else:
+            texture = arcade.load_texture(
+                f"{MAIN_PATH}/assets/{relative_path}"
+                )
+        self.images[relative_path] = texture
+        return texture
+
+    def stats(self):
+        """Returns the hit/miss counters of the registry."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "animations": len(self.pairs),
+            "images": len(self.images),
+        }
 
-            self.fall_frames = frame_num
-            self.fall_textures = []
-            for i in range(frame_num):
-                texture = load_texture_pair(f"{main_path}/fall/{i}.png")
-                self.fall_textures.append(texture)
+    def clear(self):
+        """Forgets every loaded texture and resets the counters."""
+        self.textures.clear()
+        self.pairs.clear()
+        self.images.clear()
+        self.hits = NOTHING
+        self.misses = NOTHING
 
-        if "Walk" in available_anims:
-            # Walking frames
-            frame_num = FIRST_TEXTURE
-            for path in os.listdir(f"{main_path}/walk"):
-                frame_num += UNIT_INCREMENT
+# The one registry used by the whole game.
+TEXTURE_REGISTRY = TextureRegistry()
 
-            self.walk_frames = frame_num
-            self.walk_textures = []
-            for i in range(frame_num):
-                texture = load_texture_pair(f"{main_path}/walk/{i}.png")
-                self.walk_textures.append(texture)
 
-        if "Climb" in available_anims:
-            # Climbing frames
-            frame_num = FIRST_TEXTURE
-            for path in os.listdir(f"{main_path}/climb"):    
-                frame_num += UNIT_INCREMENT
+# Compiled levels
+def file_fingerprint(path, base_folder):
+    """
+    Returns the information used to tell if a file has changed:
+    its path (relative to base_folder), modified time, size and
+    SHA-1 hash.
+    """
+    with open(path, "rb") as source_file:
+        digest = hashlib.sha1(source_file.read()).hexdigest()
+    stat = os.stat(path)
+    return {
+        "path": os.path.relpath(path, base_folder),
+        "mtime": stat.st_mtime,
+        "size": stat.st_size,
+        "sha1": digest,
+    }
 
-            self.climbing_frames = frame_num
-            self.climbing_textures = []
-            for i in range(frame_num):
-                texture = load_texture_pair(f"{main_path}/climb/{i}.png")
-                self.climbing_textures.append(texture)
+def sources_unchanged(sources, base_folder):
+    """
+    Checks that none of the files a compiled level was built from have
+    changed. The modified time and size are checked first since they
+    are cheap, and only if they differ is the file hashed, so that
+    a file which was only touched (e.g. by git) doesn't need a rebuild.
+    """
+    for source in sources:
+        path = os.path.join(base_folder, source["path"])
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        if stat.st_mtime == source["mtime"] and stat.st_size == source["size"]:
+            continue
+        if (
+            stat.st_size != source["size"]
+            or
+            file_fingerprint(path, base_folder)["sha1"] != source["sha1"]
+            ):
+            return False
+    return True
 
-        if "Wave" in available_anims:
-            frame_num = FIRST_TEXTURE
-            for path in os.listdir(f"{main_path}/wave"):
-                frame_num += UNIT_INCREMENT
+def object_record(tiled_object, map_height, scaling, tile_width, tile_height):
+    """
+    Turns an object from a Tiled object layer into a record with its
+    shape worked out in the same way as arcade's TileMap, and its
+    cartesian (tile) position already calculated.
+    Only points and rectangles are supported.
+    """
+    if isinstance(tiled_object, pytiled_parser.tiled_object.Point) or (
+        isinstance(tiled_object, pytiled_parser.tiled_object.Rectangle)
+        and tiled_object.size.width == NOTHING
+        and tiled_object.size.height == NOTHING
+        ):
+        shape = [
+            tiled_object.coordinates.x * scaling,
+            (map_height - tiled_object.coordinates.y) * scaling,
+        ]
+        cartesian = [
+            math.floor(shape[X_POS] / (tile_width * scaling)),
+            math.floor(shape[Y_POS] / (tile_height * scaling)),
+        ]
+    elif isinstance(tiled_object, pytiled_parser.tiled_object.Rectangle):
+        start_x = tiled_object.coordinates.x
+        start_y = -tiled_object.coordinates.y
+        end_x = tiled_object.coordinates.x + tiled_object.size.width
+        end_y = -(tiled_object.coordinates.y + tiled_object.size.height)
+        shape = [
+            [start_x, start_y],
+            [end_x, start_y],
+            [end_x, end_y],
+            [start_x, end_y],
+        ]
+        cartesian = None
+    else:
+        raise ValueError(
+            f"object {tiled_object.id} is a {type(tiled_object).__name__}"
+            )
+    return {
+        "shape": shape,
+        "properties": tiled_object.properties or {},
+        "name": tiled_object.name,
+        "type": tiled_object.class_,
+        "cartesian": cartesian,
+    }
 
-            self.wave_frames = frame_num
-            self.wave_textures = []
-            for i in range(frame_num):
-                texture = load_texture_pair(f"{main_path}/wave/{i}.png")
-                self.wave_textures.append(texture)
+def compile_level(map_name, scaling=TILE_SCALING):
+    """
+    Parses a Tiled map and compiles it into a LevelData, which is also
+    written next to the map so that later loads can skip the XML.
+    Tile layers become packed arrays of tile ids, and object layers
+    become records with their positions already worked out.
+    Raises a ValueError if the map uses a Tiled feature the compiled
+    format doesn't support (the caller then falls back to the XML
+    loader).
+    """
+    map_folder = os.path.dirname(os.path.abspath(map_name))
+    with open(map_name, "rb") as map_file:
+        map_source = map_file.read()
+    tiled_map = pytiled_parser.parse_map(Path(map_name))
+    if tiled_map.infinite:
+        raise ValueError("infinite maps are not supported")
+
+    # Every file the level depends on, so changes to the tilesets
+    # also cause a rebuild.
+    sources = [file_fingerprint(map_name, map_folder)]
+    for tileset_source in re.findall(
+        rb'<tileset[^>]*source="([^"]+)"', map_source
+        ):
+        sources.append(file_fingerprint(
+            os.path.join(map_folder, tileset_source.decode()), map_folder
+            ))
+
+    for tileset in tiled_map.tilesets.values():
+        for tile in (tileset.tiles or {}).values():
+            if tile.animation or tile.objects:
+                raise ValueError(
+                    f"tile {tile.id} of {tileset.name} is animated"
+                    +" or has a custom hit box"
+                    )
 
-        if "Death" in available_anims:
-            frame_num = FIRST_TEXTURE
-            for path in os.listdir(f"{main_path}/death"):
-                frame_num += UNIT_INCREMENT
-            
-            self.death_frames = frame_num
-            self.death_textures = []
-            for i in range(frame_num):
-                texture = load_texture_pair(f"{main_path}/death/{i}.png")
-                self.death_textures.append(texture)
-        
-        if "Open" in available_anims:
-            frame_num = FIRST_TEXTURE
-            for path in os.listdir(f"{main_path}/open"):
-                frame_num += UNIT_INCREMENT
-            
-            self.open_frames = frame_num
-            self.open_textures = []
-            for i in range(frame_num):
-                texture = load_texture_pair(f"{main_path}/open/{i}.png")
-                self.open_textures.append(texture)
-        
-        if "Closed" in available_anims:
-            frame_num = FIRST_TEXTURE
-            for path in os.listdir(f"{main_path}/closed"):
-                frame_num += UNIT_INCREMENT
-            
-            self.closed_frames = frame_num
-            self.closed_textures = []
-            for i in range(frame_num):
-                texture = load_texture_pair(f"{main_path}/closed/{i}.png")
-                self.closed_textures.append(texture)
-            
-        # Set initial texture
-        self.texture = self.idle_textures[FIRST_TEXTURE][RIGHT_FACING]
+    def tile_record(gid):
+        """
+        Returns the image (and part of the image) used by a tile id.
+        The tilesets are searched in the same order as arcade's TileMap
+        does, so that every tile id gives the same image it always has.
+        Image paths are stored relative to the game folder, so that the
+        compiled file still works if the game folder is moved.
+        """
+        for first_gid, tileset in tiled_map.tilesets.items():
+            if gid < first_gid:
+                continue
+            if (
+                tileset.image is not None
+                and gid < first_gid + tileset.tile_count
+                ):
+                # Tileset made from one image cut into a grid.
+                tile_id = gid - first_gid
+                margin = tileset.margin or NOTHING
+                spacing = tileset.spacing or NOTHING
+                return {
+                    "image": os.path.relpath(tileset.image, MAIN_PATH),
+                    "x": margin + (tile_id % tileset.columns)
+                         * (tileset.tile_width + spacing),
+                    "y": margin + (tile_id // tileset.columns)
+                         * (tileset.tile_height + spacing),
+                    "width": tileset.tile_width,
+                    "height": tileset.tile_height,
+                    "whole_image": False,
+                    "tile_id": tile_id,
+                    "class": "",
+                    "properties": {},
+                }
+            if tileset.tiles is None:
+                if tileset.image is not None:
+                    continue
+                break
+            tile = tileset.tiles.get(gid - first_gid)
+            if tile:
+                # Tileset made from a collection of separate images.
+                return {
+                    "image": os.path.relpath(tile.image, MAIN_PATH),
+                    "x": tile.x or NOTHING,
+                    "y": tile.y or NOTHING,
+                    "width": tile.width or NOTHING,
+                    "height": tile.height or NOTHING,
+                    "whole_image": (
+                        not (tile.x or tile.y)
+                        and tile.width == tile.image_width
+                        and tile.height == tile.image_height
+                        ),
+                    "tile_id": tile.id,
+                    "class": tile.class_,
+                    "properties": tile.properties or {},
+                }
+        raise ValueError(f"no tile for tile id {gid}")
+
+    # Flatten any layer groups into one list of layers, in draw order.
+    def flatten(layers):
+        for layer in layers:
+            if isinstance(layer, pytiled_parser.LayerGroup):
+                yield from flatten(layer.layers)
+            else:
+                yield layer
+
+    map_height = tiled_map.map_size.height * tiled_map.tile_size.height
+    tiles = {}
+    layers = []
+    tile_arrays = {}
+    used_names = set()
+    for layer in flatten(tiled_map.layers):
+        if layer.name in used_names:
+            raise ValueError(f"duplicate layer name '{layer.name}'")
+        layer_info = {
+            "name": layer.name,
+            "visible": layer.visible,
+            "opacity": layer.opacity,
+            "tint": layer.tint_color,
+            "properties": layer.properties or {},
+        }
+        if isinstance(layer, pytiled_parser.TileLayer):
+            layer_info["kind"] = "tiles"
+            tile_arrays[layer.name] = array(
+                "I", [gid for row in layer.data for gid in row]
+                )
+            for gid in set(tile_arrays[layer.name]):
+                tile_id = gid & TILE_ID_MASK
+                if tile_id != NOTHING and tile_id not in tiles:
+                    tiles[tile_id] = tile_record(tile_id)
+            used_names.add(layer.name)
+        elif isinstance(layer, pytiled_parser.ObjectLayer):
+            layer_info["kind"] = "objects"
+            layer_info["objects"] = [
+                object_record(
+                    tiled_object,
+                    map_height,
+                    scaling,
+                    tiled_map.tile_size.width,
+                    tiled_map.tile_size.height,
+                    )
+                for tiled_object in layer.tiled_objects
+            ]
+            # Empty object layers don't appear in arcade's TileMap, so
+            # they don't use up the layer name either.
+            if layer_info["objects"]:
+                used_names.add(layer.name)
+        else:
+            raise ValueError(f"{type(layer).__name__} '{layer.name}'")
+        layers.append(layer_info)
+
+    header = {
+        "sources": sources,
+        "scaling": scaling,
+        "byteorder": sys.byteorder,
+        "width": tiled_map.map_size.width,
+        "height": tiled_map.map_size.height,
+        "tile_width": tiled_map.tile_size.width,
+        "tile_height": tiled_map.tile_size.height,
+        "properties": tiled_map.properties or {},
+        "tiles": tiles,
+        "layers": layers,
+    }
+    # Round trip the header through JSON so that the returned data is
+    # exactly what would be read back from the file.
+    header_bytes = json.dumps(header, default=str).encode()
+    level_data = LevelData(json.loads(header_bytes), tile_arrays)
+
+    # Write the compiled level. It's written to a temporary file first
+    # so that a half written file never gets used. If the maps folder
+    # can't be written to, the level just gets compiled again next
+    # time.
+    tile_bytes = zlib.compress(
+        b"".join(tile_arrays[layer["name"]].tobytes()
+                 for layer in layers if layer["kind"] == "tiles")
+        )
+    cache_name = f"{map_name}{LEVEL_CACHE_EXTENSION}"
+    try:
+        with open(f"{cache_name}.tmp", "wb") as cache_file:
+            cache_file.write(struct.pack(
+                LEVEL_CACHE_HEADER,
+                LEVEL_CACHE_MAGIC,
+                LEVEL_CACHE_VERSION,
+                len(header_bytes),
+                len(tile_bytes),
+            ))
+            cache_file.write(header_bytes)
+            cache_file.write(tile_bytes)
+        os.replace(f"{cache_name}.tmp", cache_name)
+    except OSError:
+        pass
+    return level_data
+
+def read_compiled_level(map_name, scaling=TILE_SCALING):
+    """
+    Reads the compiled copy of a map if it exists and is still up to
+    date, otherwise returns None.
+    """
+    map_folder = os.path.dirname(os.path.abspath(map_name))
+    try:
+        with open(f"{map_name}{LEVEL_CACHE_EXTENSION}", "rb") as cache_file:
+            magic, version, header_length, tile_length = struct.unpack(
+                LEVEL_CACHE_HEADER,
+                cache_file.read(struct.calcsize(LEVEL_CACHE_HEADER))
+                )
+            if magic != LEVEL_CACHE_MAGIC or version != LEVEL_CACHE_VERSION:
+                return None
+            header = json.loads(cache_file.read(header_length))
+            if (
+                header["scaling"] != scaling
+                or not sources_unchanged(header["sources"], map_folder)
+                ):
+                return None
+            tile_bytes = zlib.decompress(cache_file.read(tile_length))
+    except (OSError, ValueError, KeyError, struct.error, zlib.error):
+        return None
+
+    # Cut the tile data back up into one array per tile layer.
+    tile_arrays = {}
+    start = FIRST_VALUE
+    for layer in header["layers"]:
+        if layer["kind"] != "tiles":
+            continue
+        layer_array = array("I")
+        end = start + header["width"] * header["height"] * layer_array.itemsize
+        layer_array.frombytes(tile_bytes[start:end])
+        if header["byteorder"] != sys.byteorder:
+            layer_array.byteswap()
+        tile_arrays[layer["name"]] = layer_array
+        start = end
+    return LevelData(header, tile_arrays)
+
+def load_level_data(map_name, scaling=TILE_SCALING):
+    """
+    Returns the compiled level for a map, compiling it first if there
+    is no up to date compiled copy.
+    """
+    level_data = read_compiled_level(map_name, scaling)
+    if level_data is None:
+        level_data = compile_level(map_name, scaling)
+    return level_data
+
+def load_level(
+    map_name, 
+    scaling=TILE_SCALING, 
+    layer_options=None, 
+    lazy=False, 
+    progress=None
+    ):
+    """
+    Loads a map and returns a tile map with the sprite lists and object
+    lists of every layer.
+    The compiled level is used whenever possible. If the map can't be
+    compiled, it's loaded from the XML by arcade instead.
+    If lazy is True the sprite lists are made without any OpenGL
+    resources, so the level can be loaded on a background thread.
+    Arcade's loader can't do that, so a ValueError is raised instead
+    of falling back to it.
+    progress is an optional function which is given the fraction of
+    the level that has been loaded so far.
+    """
+    layer_options = layer_options or {}
+    try:
+        for options in layer_options.values():
+            for option in options:
+                if option not in COMPILED_LAYER_OPTIONS:
+                    raise ValueError(f"layer option '{option}'")
+        level_data = load_level_data(map_name, scaling)
+    except ValueError as error:
+        if lazy:
+            raise
+        print(f"Loading {map_name} without compiling it: {error}")
+        tile_map = arcade.load_tilemap(map_name, scaling, layer_options)
+        # Give the objects the same records the compiled levels have.
+        for layer_name, objects in tile_map.object_lists.items():
+            tile_map.object_lists[layer_name] = [
+                LevelObject(
+                    tiled_object.shape,
+                    tiled_object.properties or {},
+                    tiled_object.name,
+                    tiled_object.type,
+                    tile_map.get_cartesian(
+                        tiled_object.shape[X_POS], tiled_object.shape[Y_POS]
+                        ),
+                    )
+                for tiled_object in objects
+            ]
+        tile_map.chunked_layers = {}
+        tile_map.collision_grids = {}
+        for layer_name, sprite_list in tile_map.sprite_lists.items():
+            options = layer_options.get(layer_name, {})
+            if options.get("chunk_size"):
+                tile_map.chunked_layers[layer_name] = ChunkedLayer(
+                    sprite_list, 
+                    options["chunk_size"] * tile_map.tile_width * scaling,
+                    )
+            if options.get("collision_grid"):
+                tile_map.collision_grids[layer_name] = CollisionGrid(
+                    sprite_list,
+                    (tile_map.width, tile_map.height),
+                    (tile_map.tile_width*scaling, tile_map.tile_height*scaling),
+                    )
+        return tile_map
+    return CompiledLevel(level_data, layer_options, lazy, progress)
 
-        # Set hitbox
-        # Arcade creates a hitbox based on the vertices of the texture.
-        self.set_hit_box(self.texture.hit_box_points)
+class GridHit:
+    """
+    A grid square which a sprite collided with. It has the same
+    change_x and change_y as a tile sprite (the tiles never move) so
+    the physics engine can treat it like any other wall.
+    """
 
-# Collectible Objects Template class
-class Collectible(Entity):
+    def __init__(self, points):
+        """points: The hit box of the tile, in pixel coordinates."""
+        self.points = points
+        self.change_x = NOTHING
+        self.change_y = NOTHING
+
+class CollisionGrid:
     """
-    Template for collectible items like orbs,
-    quest collectibles, and secrets.
+    Collision shapes of a tile layer stored by grid square.
+    Each grid square holds a number which picks out the hit box of the
+    tile in that square (0 means empty), so finding what a sprite is
+    touching only means looking at the few squares under it.
+    Sprites which don't fit in one grid square are kept in a normal
+    sprite list and checked the usual way.
     """
-    def __init__(self, sprite_folder):
+
+    def __init__(self, sprite_list, map_size, tile_size):
         """
-        Initialises the relevant animations/textures which are
-        the idle textures for collectibles.
-        Sets the scaling of the sprites to COLLECTIBLE_SCALING.
+        Builds the grid from the sprites of a tile layer.
+        map_size:   The width and height of the map (in tiles).
+        tile_size:  The width and height of a grid square (in pixels).
+        cells:      The hit box number of every grid square, row by
+                    row from the bottom of the map.
+        shapes:     The hit boxes (relative to the centre of the grid
+                    square, already scaled). Number 0 is left empty.
+        sprites:    Sprites which don't fit in one grid square.
         """
-        # Inherit from parent class (Entity)
-        super().__init__("InanimateObjects", sprite_folder, ["Idle"])
+        self.map_size = map_size
+        self.tile_size = tile_size
+        self.cells = array("H", bytes(
+            map_size[X_POS] * map_size[Y_POS] * array("H").itemsize
+            ))
+        self.shapes = [None]
+        self.shape_numbers = {}
+        self.sprites = arcade.SpriteList(use_spatial_hash=True, lazy=True)
+        self.refresh(sprite_list)
+
+    def refresh(self, sprite_list):
+        """Fills the whole grid again from a sprite list."""
+        for index in range(len(self.cells)):
+            self.cells[index] = NOTHING
+        self.sprites.clear()
+        for sprite in sprite_list:
+            self.add(sprite)
+
+    def cell_index(self, sprite):
+        """
+        Returns the index in cells of the grid square a sprite fills
+        exactly, or None if it doesn't fit in one grid square.
+        """
+        column = round(
+            (sprite.center_x - self.tile_size[X_POS]*HALF_BLOCK) 
+            / self.tile_size[X_POS]
+            )
+        row = round(
+            (sprite.center_y - self.tile_size[Y_POS]*HALF_BLOCK) 
+            / self.tile_size[Y_POS]
+            )
+        if (
+            sprite.angle != NOTHING
+            or sprite.width != self.tile_size[X_POS]
+            or sprite.height != self.tile_size[Y_POS]
+            or sprite.center_x != (column+HALF_BLOCK)*self.tile_size[X_POS]
+            or sprite.center_y != (row+HALF_BLOCK)*self.tile_size[Y_POS]
+            or not FIRST_VALUE <= column < self.map_size[X_POS]
+            or not FIRST_VALUE <= row < self.map_size[Y_POS]
+            ):
+            return None
+        return row*self.map_size[X_POS] + column
+
+    def add(self, sprite):
+        """Adds a tile which has been added to the grid's layer."""
+        index = self.cell_index(sprite)
+        if index is None:
+            self.sprites.append(sprite)
+            return
+        shape = tuple(
+            (point[X_POS] * sprite.scale, point[Y_POS] * sprite.scale)
+            for point in sprite.get_hit_box()
+            )
+        if shape not in self.shape_numbers:
+            self.shape_numbers[shape] = len(self.shapes)
+            self.shapes.append(shape)
+        self.cells[index] = self.shape_numbers[shape]
+
+    def remove(self, sprite):
+        """Removes a tile which has been removed from the grid's layer."""
+        index = self.cell_index(sprite)
+        if index is not None:
+            self.cells[index] = NOTHING
+        elif self.sprites in sprite.sprite_lists:
+            self.sprites.remove(sprite)
+
+    def check_for_collision(self, sprite):
+        """
+        Returns everything in the layer the sprite is colliding with:
+        a GridHit for every grid square, and any other sprites.
+        """
+        points = sprite.get_adjusted_hit_box()
+        left = min(point[X_POS] for point in points)
+        right = max(point[X_POS] for point in points)
+        bottom = min(point[Y_POS] for point in points)
+        top = max(point[Y_POS] for point in points)
+        first_column = max(
+            math.floor(left / self.tile_size[X_POS]), FIRST_VALUE
+            )
+        last_column = min(
+            math.floor(right / self.tile_size[X_POS]), 
+            self.map_size[X_POS] - INDEX_OFFSET
+            )
+        first_row = max(
+            math.floor(bottom / self.tile_size[Y_POS]), FIRST_VALUE
+            )
+        last_row = min(
+            math.floor(top / self.tile_size[Y_POS]), 
+            self.map_size[Y_POS] - INDEX_OFFSET
+            )
+        hits = []
+        for row in range(first_row, last_row + INDEX_OFFSET):
+            row_start = row * self.map_size[X_POS]
+            center_y = (row + HALF_BLOCK) * self.tile_size[Y_POS]
+            for column in range(first_column, last_column + INDEX_OFFSET):
+                shape_number = self.cells[row_start + column]
+                if shape_number == NOTHING:
+                    continue
+                center_x = (column + HALF_BLOCK) * self.tile_size[X_POS]
+                tile_points = [
+                    (point[X_POS] + center_x, point[Y_POS] + center_y)
+                    for point in self.shapes[shape_number]
+                ]
+                if arcade.are_polygons_intersecting(points, tile_points):
+                    hits.append(GridHit(tile_points))
+        if len(self.sprites) > NOTHING:
+            hits.extend(
+                arcade.check_for_collision_with_list(sprite, self.sprites)
+                )
+        return hits
 
-        # Override the CHARACTER_SCALING from the parent class with
-        # COLLECTIBLE_SCALING
-        self.scale = COLLECTIBLE_SCALING
+class GridPhysicsEngine:
+    """
+    Platformer physics engine which works the same way as arcade's
+    PhysicsEnginePlatformer (with the same methods the game uses), but
+    checks collisions with walls and ladders using collision grids.
+    walls, platforms and ladders can each be a collision grid, a
+    sprite list, or a list of them. Moving platforms should be given
+    as a sprite list since they don't stay in one grid square.
+    """
 
+    def __init__(
+        self, 
+        player_sprite, 
+        platforms=None, 
+        gravity_constant=GRAVITY, 
+        ladders=None, 
+        walls=None
+        ):
+        """
+        Sets up the engine.
+        queries:    Number of collision checks done, for benchmarking.
+        """
+        self.player_sprite = player_sprite
+        self.platforms = self.as_list(platforms)
+        self.gravity_constant = gravity_constant
+        self.ladders = self.as_list(ladders)
+        self.walls = self.as_list(walls)
+        self.queries = NOTHING
+
+    def as_list(self, layers):
+        """Puts a single layer into a list, so layers are always lists."""
+        if layers is None:
+            return []
+        if isinstance(layers, (arcade.SpriteList, CollisionGrid)):
+            return [layers]
+        return list(layers)
+
+    def check_for_collision(self, layers):
+        """Returns everything in the layers the player is touching."""
+        self.queries += UNIT_INCREMENT
+        hits = []
+        for layer in layers:
+            if isinstance(layer, CollisionGrid):
+                hits.extend(layer.check_for_collision(self.player_sprite))
+            else:
+                hits.extend(
+                    arcade.check_for_collision_with_list(
+                        self.player_sprite, layer
+                        )
+                    )
+        return hits
 
-# Energy Orb class
-class Orb(Collectible):
-    """Energy Orb Sprite"""
+    def is_touching(self, item):
+        """Checks if the player is touching one wall or grid square."""
+        if isinstance(item, GridHit):
+            return arcade.are_polygons_intersecting(
+                self.player_sprite.get_adjusted_hit_box(), item.points
+                )
+        return arcade.check_for_collision(self.player_sprite, item)
 
-    def __init__(self):
+    def is_on_ladder(self):
+        """Returns True if the player is touching a ladder."""
+        return len(self.check_for_collision(self.ladders)) > NOTHING
+
+    def can_jump(self, y_distance=5):
         """
-        Loads the specific EnergyOrb textures from the sprite folder
-        in assets. Initialises the type attribute and sets it to None.
+        Returns True if there is a floor under the player (within
+        y_distance pixels), which means the player can jump.
         """
-        # Inherit from parent class (Collectible)
-        super().__init__("EnergyOrb")
+        self.player_sprite.center_y -= y_distance
+        hits = self.check_for_collision(self.walls + self.platforms)
+        self.player_sprite.center_y += y_distance
+        return len(hits) > NOTHING
 
-        # The type attribute is used to figure out what kind of
-        # collectible the player has collided with.
-        self.type = None
+    def jump(self, velocity):
+        """Makes the player jump."""
+        self.player_sprite.change_y = velocity
 
-    def update_animation(self, delta_time: float = FRAMERATE):
+    def free_player(self, walls):
         """
-        Updates the texture of the orb every frame.
+        If the player starts inside a wall, tries positions further
+        and further away (in 8 directions) until one is free.
+        This is the same as arcade's engine does.
         """
-        # For every frame, increase the current texture index by one.
-        # However, the texture only changes every n frame indexes,
-        # where n is the animation rate multiplier defined in the
-        # ANIM_MULT dictionary.
-        # Once the current texture index reaches its maximum,
-        # where the last texture in the loop has displayed for the
-        # correct number of frames, it is reset to 0.
-        self.cur_texture += UNIT_INCREMENT
-        if (
-            self.cur_texture 
-            > 
+        original_x = self.player_sprite.center_x
+        original_y = self.player_sprite.center_y
+        distance = ONE_BLOCK
+        while True:
+            for direction_x, direction_y in [
+                (0, 1), (0, -1), (1, 0), (-1, 0), 
+                (1, 1), (1, -1), (-1, 1), (-1, -1)
+                ]:
+                self.player_sprite.center_x = (
+                    original_x + direction_x * distance
+                    )
+                self.player_sprite.center_y = (
+                    original_y + direction_y * distance
+                    )
+                if len(self.check_for_collision(walls)) == NOTHING:
+                    return
+            distance *= 2
+
+    def move_player(self, walls):
+        """
+        Moves the player by its change_x and change_y and pushes it back
+        out of any walls, going up small steps (ramps) where possible.
+        This follows the same steps as arcade's engine, so the player
+        moves in exactly the same way.
+        """
+        player = self.player_sprite
+        if len(self.check_for_collision(walls)) > NOTHING:
+            self.free_player(walls)
+        original_x = player.center_x
+        original_y = player.center_y
+
+        # Move in the y direction
+        player.center_y += player.change_y
+        hits = self.check_for_collision(walls)
+        if len(hits) > NOTHING:
+            if player.change_y > NOTHING:
+                while len(self.check_for_collision(walls)) > NOTHING:
+                    player.center_y -= ONE_BLOCK
+            elif player.change_y < NOTHING:
+                for item in hits:
+                    while self.is_touching(item):
+                        player.center_y += 0.25
+                    if item.change_x != NOTHING:
+                        player.center_x += item.change_x
+            player.change_y = min(0.0, hits[FIRST_VALUE].change_y)
+        player.center_y = round(player.center_y, 2)
+
+        # Move in the x direction
+        # The furthest distance the player can move without hitting a
+        # wall is found with a binary search.
+        if player.change_x:
+            almost_original_y = player.center_y
+            direction = math.copysign(ONE_BLOCK, player.change_x)
+            x_change = abs(player.change_x)
+            upper_bound = x_change
+            lower_bound = 0
+            y_change = 0
+            while True:
+                player.center_x = original_x + x_change * direction
+                hits = self.check_for_collision(walls)
+                if len(hits) > NOTHING:
+                    # Try going up a ramp
+                    y_change = x_change
+                    player.center_y = original_y + y_change
+                    hits = self.check_for_collision(walls)
+                    if len(hits) > NOTHING:
+                        y_change -= x_change
+                    else:
+                        while len(hits) == NOTHING and y_change > NOTHING:
+                            y_change -= ONE_BLOCK
+                            player.center_y = almost_original_y + y_change
+                            hits = self.check_for_collision(walls)
+                        y_change += ONE_BLOCK
+                        hits = []
+                    if len(hits) > NOTHING:
+                        upper_bound = x_change - ONE_BLOCK
+                        if upper_bound - lower_bound <= NOTHING:
+                            x_change = lower_bound
+                            break
+                        x_change = (upper_bound + lower_bound) // 2
+                    else:
+                        break
+                else:
+                    lower_bound = x_change
+                    if upper_bound - lower_bound <= NOTHING:
+                        break
+                    x_change = (
+                        (upper_bound + lower_bound) // 2 
+                        + (upper_bound + lower_bound) % 2
+                        )
+            player.center_x = original_x + x_change * direction
+            player.center_y = almost_original_y + y_change
+
+    def move_platforms(self):
+        """
+        Moves the moving platforms, turning them around when they reach
+        their boundaries. (Same as arcade's engine)
+        """
+        for platform_list in self.platforms:
+            if isinstance(platform_list, CollisionGrid):
+                continue
+            for platform in platform_list:
+                if platform.change_x == NOTHING and platform.change_y == NOTHING:
+                    continue
+                if (
+                    platform.boundary_left 
+                    and platform.left <= platform.boundary_left
+                    ):
+                    platform.left = platform.boundary_left
+                    if platform.change_x < NOTHING:
+                        platform.change_x *= -ONE_BLOCK
+                if (
+                    platform.boundary_right 
+                    and platform.right >= platform.boundary_right
+                    ):
+                    platform.right = platform.boundary_right
+                    if platform.change_x > NOTHING:
+                        platform.change_x *= -ONE_BLOCK
+                platform.center_x += platform.change_x
+                if (
+                    platform.boundary_top is not None
+                    and platform.top >= platform.boundary_top
+                    ):
+                    platform.top = platform.boundary_top
+                    if platform.change_y > NOTHING:
+                        platform.change_y *= -ONE_BLOCK
+                if (
+                    platform.boundary_bottom is not None
+                    and platform.bottom <= platform.boundary_bottom
+                    ):
+                    platform.bottom = platform.boundary_bottom
+                    if platform.change_y < NOTHING:
+                        platform.change_y *= -ONE_BLOCK
+                platform.center_y += platform.change_y
+
+    def update(self):
+        """
+        Applies gravity (unless the player is on a ladder), moves the
+        player, then moves the moving platforms.
+        """
+        if not self.is_on_ladder():
+            self.player_sprite.change_y -= self.gravity_constant
+        self.move_player(self.walls + self.platforms)
+        self.move_platforms()
+
+class LevelData:
+    """
+    The contents of a compiled level: the JSON header describing the
+    map, its tiles and layers, and one packed array of tile ids for
+    each tile layer.
+    """
+
+    def __init__(self, header, tile_arrays):
+        """
+        Stores the header and the tile arrays.
+        header:         Dictionary with the map size, tile info, and
+                        the list of layers (including object records).
+        tile_arrays:    Array of tile ids (row by row, starting at the
+                        top of the map) for each tile layer name.
+        """
+        self.header = header
+        self.tile_arrays = tile_arrays
+
+class LevelObject:
+    """
+    One object from an object layer. This has the same fields as
+    arcade's TiledObject, plus the cartesian (tile) position of the
+    object so it doesn't need working out every time it's used.
+    """
+
+    def __init__(self, shape, properties, name, type, cartesian):
+        """Stores the object fields."""
+        self.shape = shape
+        self.properties = properties
+        self.name = name
+        self.type = type
+        self.cartesian = cartesian
+
+class ChunkedLayer:
+    """
+    A tile layer split into square chunks, each with its own sprite
+    list, so that only the chunks which are on screen get drawn.
+    The sprites are shared with the original sprite list, which is
+    still used for everything else (like collisions), so changing a
+    sprite (e.g. its opacity) changes it in the chunks as well.
+    """
+
+    def __init__(self, sprite_list, chunk_size, lazy=False):
+        """
+        Sorts the sprites of a layer into chunks by their centre.
+        sprite_list:    The sprite list of the layer.
+        chunk_size:     Width and height of each chunk (in pixels).
+        chunks:         The sprite list of each chunk, keyed by the
+                        chunk's position in the chunk grid.
+        bounds:         The left, bottom, right and top edges of the
+                        sprites in each chunk. This can stick out of
+                        the chunk when tiles are bigger than one block.
+        """
+        self.sprite_list = sprite_list
+        self.chunk_size = chunk_size
+        self.chunks = {}
+        self.bounds = {}
+        for sprite in sprite_list:
+            chunk = (
+                math.floor(sprite.center_x / chunk_size),
+                math.floor(sprite.center_y / chunk_size),
+            )
+            if chunk not in self.chunks:
+                self.chunks[chunk] = arcade.SpriteList(lazy=lazy)
+                self.bounds[chunk] = [
+                    sprite.left, sprite.bottom, sprite.right, sprite.top
+                    ]
+            self.chunks[chunk].append(sprite)
+            bounds = self.bounds[chunk]
+            bounds[0] = min(bounds[0], sprite.left)
+            bounds[1] = min(bounds[1], sprite.bottom)
+            bounds[2] = max(bounds[2], sprite.right)
+            bounds[3] = max(bounds[3], sprite.top)
+
+    def initialize(self):
+        """Creates the OpenGL resources of lazily made chunks."""
+        for chunk in self.chunks.values():
+            chunk.initialize()
+
+    def draw(self, left, bottom, right, top, **kwargs):
+        """
+        Draws the chunks which overlap the given area (usually the
+        area the camera can see). Nothing is drawn if the layer has
+        been hidden.
+        Returns the number of chunks drawn and the number skipped.
+        """
+        if not self.sprite_list.visible:
+            return NOTHING, len(self.chunks)
+        drawn = NOTHING
+        for chunk, bounds in self.bounds.items():
+            if (
+                bounds[2] >= left 
+                and bounds[0] <= right 
+                and bounds[3] >= bottom 
+                and bounds[1] <= top
+                ):
+                self.chunks[chunk].draw(**kwargs)
+                drawn += UNIT_INCREMENT
+        return drawn, len(self.chunks) - drawn
+
+class CompiledLevel:
+    """
+    Stand-in for arcade's TileMap, built from a compiled level rather
+    than from the XML.
+    It has the same attributes as the TileMap that the game uses, so
+    arcade.Scene.from_tilemap() works with it too.
+    """
+
+    def __init__(
+        self, 
+        level_data, 
+        layer_options=None, 
+        lazy=False, 
+        progress=None
+        ):
+        """
+        Creates the sprites for every tile layer and the object lists
+        for every object layer.
+        If lazy is True the sprite lists don't create their OpenGL
+        resources until initialize() is called.
+        progress is given the fraction of the tiles which have been
+        made into sprites after each tile layer.
+        """
+        header = level_data.header
+        self.width = header["width"]
+        self.height = header["height"]
+        self.tile_width = header["tile_width"]
+        self.tile_height = header["tile_height"]
+        self.scaling = header["scaling"]
+        self.properties = header["properties"]
+        self.tiles = header["tiles"]
+        self.lazy = lazy
+        self.sprite_lists = {}
+        self.object_lists = {}
+        self.chunked_layers = {}
+        self.collision_grids = {}
+
+        # Tile textures are only looked up once per tile id.
+        self.tile_textures = {}
+
+        layer_options = layer_options or {}
+        total_tiles = max(
+            sum(len(tiles) for tiles in level_data.tile_arrays.values()), 
+            ONE_BLOCK
+            )
+        tiles_built = NOTHING
+        for layer in header["layers"]:
+            options = layer_options.get(layer["name"], {})
+            if layer["kind"] == "tiles":
+                self.sprite_lists[layer["name"]] = self.build_tile_layer(
+                    layer,
+                    level_data.tile_arrays[layer["name"]],
+                    options.get("use_spatial_hash"),
+                    )
+                if options.get("chunk_size"):
+                    self.chunked_layers[layer["name"]] = ChunkedLayer(
+                        self.sprite_lists[layer["name"]],
+                        options["chunk_size"] * self.tile_width * self.scaling,
+                        lazy,
+                        )
+                if options.get("collision_grid"):
+                    self.collision_grids[layer["name"]] = CollisionGrid(
+                        self.sprite_lists[layer["name"]],
+                        (self.width, self.height),
+                        (
+                            self.tile_width * self.scaling, 
+                            self.tile_height * self.scaling
+                        ),
+                        )
+                tiles_built += len(level_data.tile_arrays[layer["name"]])
+                if progress is not None:
+                    progress(tiles_built / total_tiles)
+            elif layer["objects"]:
+                self.object_lists[layer["name"]] = [
+                    LevelObject(**record) for record in layer["objects"]
+                ]
+
+    def get_cartesian(self, x, y):
+        """
+        Given a set of coordinates in pixel units, this returns the
+        cartesian (tile) coordinates. Works the same as TileMap.
+        """
+        return (
+            math.floor(x / (self.tile_width * self.scaling)),
+            math.floor(y / (self.tile_height * self.scaling)),
+        )
+
+    def initialize(self):
+        """
+        Creates the OpenGL resources of lazily loaded sprite lists.
+        This has to be run on the main thread before the level is used.
+        """
+        for sprite_list in self.sprite_lists.values():
+            sprite_list.initialize()
+        for chunked_layer in self.chunked_layers.values():
+            chunked_layer.initialize()
+
+    def get_tile_texture(self, gid):
+        """
+        Returns the texture for a tile id (including its flip flags).
+        Whole images go through the texture registry so that they can
+        come from the sprite atlas.
+        """
+        if gid in self.tile_textures:
+            return self.tile_textures[gid]
+        tile = self.tiles[str(gid & TILE_ID_MASK)]
+        flipped_horizontally = bool(gid & FLIPPED_HORIZONTALLY_FLAG)
+        flipped_vertically = bool(gid & FLIPPED_VERTICALLY_FLAG)
+        flipped_diagonally = bool(gid & FLIPPED_DIAGONALLY_FLAG)
+        image = tile["image"].replace(os.sep, "/")
+        if (
+            tile["whole_image"]
+            and image.startswith("assets/")
+            and not (
+                flipped_horizontally 
+                or flipped_vertically 
+                or flipped_diagonally
+                )
+            ):
+            texture = TEXTURE_REGISTRY.get_image(image[len("assets/"):])
+        else:
+            texture = arcade.load_texture(
+                os.path.join(MAIN_PATH, tile["image"]),
+                tile["x"],
+                tile["y"],
+                tile["width"],
+                tile["height"],
+                flipped_horizontally=flipped_horizontally,
+                flipped_vertically=flipped_vertically,
+                flipped_diagonally=flipped_diagonally,
+            )
+        self.tile_textures[gid] = texture
+        return texture
+
+    def build_tile_layer(self, layer, tile_array, use_spatial_hash):
+        """
+        Creates a sprite for every tile in a tile layer, placed in the
+        same way as arcade's TileMap places them.
+        """
+        sprite_list = arcade.SpriteList(
+            use_spatial_hash=use_spatial_hash, lazy=self.lazy
+            )
+        sprite_list.visible = layer["visible"]
+        if layer["properties"]:
+            sprite_list.properties = layer["properties"]
+        tile_pixel_width = self.tile_width * self.scaling
+        tile_pixel_height = self.tile_height * self.scaling
+
+        # Everything that is the same for every copy of a tile is only
+        # worked out once: its texture, half its size (for centring it
+        # in its grid square) and its properties.
+        tile_info = {}
+        for index, gid in enumerate(tile_array):
+            if gid == NOTHING:
+                continue
+            if gid not in tile_info:
+                tile = self.tiles[str(gid & TILE_ID_MASK)]
+                texture = self.get_tile_texture(gid)
+                properties = dict(tile["properties"])
+                if tile["class"]:
+                    properties["type"] = tile["class"]
+                properties["tile_id"] = tile["tile_id"]
+                tile_info[gid] = (
+                    texture,
+                    texture.width * self.scaling / 2,
+                    texture.height * self.scaling / 2,
+                    properties,
+                )
+            texture, half_width, half_height, properties = tile_info[gid]
+            row, column = divmod(index, self.width)
+            sprite = arcade.Sprite(
+                texture=texture,
+                scale=self.scaling,
+                center_x=column * tile_pixel_width + half_width,
+                center_y=(
+                    (self.height - row - INDEX_OFFSET) * tile_pixel_height
+                    + half_height
+                    ),
+                )
+            sprite.properties.update(properties)
+            if layer["tint"]:
+                sprite.color = layer["tint"]
+            if layer["opacity"]:
+                sprite.alpha = int(layer["opacity"] * MAX_OPACITY)
+            sprite_list.append(sprite)
+        return sprite_list
+
+
+class CaveReveal:
+    """
+    Makes the cave tiles near the player see-through. The tiles are
+    indexed in a grid with squares as big as the reveal distance, so
+    only the tiles in the 9 squares around the player are checked.
+    When NumPy is installed the tile positions and opacities are kept
+    in arrays and the new opacities are worked out all at once.
+    """
+
+    def __init__(self, sprite_list, reveal_distance, transparent_distance):
+        """
+        Indexes the cave tiles.
+        sprites:                The cave tiles.
+        reveal_distance:        Distance (in pixels) at which the tiles
+                                start being revealed.
+        transparent_distance:   Distance (in pixels) at which the tiles
+                                become fully transparent.
+        cells:                  The indices of the tiles in each grid
+                                square.
+        x, y:                   The positions of the tiles.
+        alphas:                 The opacity each tile was last given.
+        last_position:          Where the player was last update.
+        checked:                Number of tiles checked last update.
+        changed:                Number of tiles whose opacity changed
+                                last update.
+        time:                   How long the last update took (seconds).
+        explored:               The framebuffer of squares the player
+                                has been near, used by the cave fog.
+                                (Made the first time the fog is drawn)
+        """
+        self.sprites = list(sprite_list)
+        self.reveal_distance = reveal_distance
+        self.transparent_distance = transparent_distance
+        cells = {}
+        for index, sprite in enumerate(self.sprites):
+            cell = self.get_cell(sprite.position)
+            cells.setdefault(cell, []).append(index)
+        self.x = [sprite.center_x for sprite in self.sprites]
+        self.y = [sprite.center_y for sprite in self.sprites]
+        self.alphas = [sprite.alpha for sprite in self.sprites]
+        if np is not None:
+            cells = {
+                cell: np.array(indices) for cell, indices in cells.items()
+                }
+            self.x = np.array(self.x, dtype=float)
+            self.y = np.array(self.y, dtype=float)
+            self.alphas = np.array(self.alphas, dtype=float)
+        self.cells = cells
+        self.last_position = None
+        self.checked = NOTHING
+        self.changed = NOTHING
+        self.time = NOTHING
+        self.explored = None
+
+    def get_cell(self, position):
+        """Returns the grid square a position is in."""
+        return (
+            math.floor(position[X_POS] / self.reveal_distance),
+            math.floor(position[Y_POS] / self.reveal_distance),
+        )
+
+    def get_nearby(self, position):
+        """
+        Returns the lists of indices of the tiles in the squares
+        around a position.
+        """
+        cell_x, cell_y = self.get_cell(position)
+        nearby = []
+        for x in (cell_x - ONE_BLOCK, cell_x, cell_x + ONE_BLOCK):
+            for y in (cell_y - ONE_BLOCK, cell_y, cell_y + ONE_BLOCK):
+                if (x, y) in self.cells:
+                    nearby.append(self.cells[(x, y)])
+        return nearby
+
+    def update(self, position):
+        """
+        Changes the opacity of the tiles near the player.
+        If the distance is less than the upper bound start revealing the
+        blocks underneath by reducing the opacity based on the
+        proportion of current distance against the upper bound.
+        If the distance is less than the lower bound, make the block
+        fully transparent. Tiles further away keep their opacity, and
+        nothing changes while the player stands still.
+        """
+        start = time.perf_counter()
+        self.checked = NOTHING
+        self.changed = NOTHING
+        if position != self.last_position:
+            self.last_position = position
+            nearby = self.get_nearby(position)
+            if nearby and np is not None:
+                self.update_arrays(position, np.concatenate(nearby))
+            elif nearby:
+                self.update_lists(position, nearby)
+        self.time = time.perf_counter() - start
+
+    def update_arrays(self, position, indices):
+        """Works out the new opacities of the nearby tiles with NumPy."""
+        self.checked = len(indices)
+        distance_x = position[X_POS] - self.x[indices]
+        distance_y = position[Y_POS] - self.y[indices]
+        distances = np.sqrt(distance_x**2 + distance_y**2)
+        near = distances < self.reveal_distance
+        indices = indices[near]
+        alphas = (
+            MAX_OPACITY
+            * np.maximum(distances[near] - self.transparent_distance, NOTHING)
+            / self.reveal_distance
+            )
+        changed = alphas != self.alphas[indices]
+        indices = indices[changed]
+        alphas = alphas[changed]
+        self.alphas[indices] = alphas
+        self.changed = len(indices)
+        for index, alpha in zip(indices.tolist(), alphas.tolist()):
+            self.sprites[index].alpha = alpha
+
+    def update_lists(self, position, nearby):
+        """Works out the new opacities of the nearby tiles one by one."""
+        for indices in nearby:
+            self.checked += len(indices)
+            for index in indices:
+                distance = calculate_distance(
+                    position, (self.x[index], self.y[index])
+                    )
+                if distance >= self.reveal_distance:
+                    continue
+                alpha = (
+                    MAX_OPACITY
+                    * max(distance - self.transparent_distance, NOTHING)
+                    / self.reveal_distance
+                    )
+                if alpha != self.alphas[index]:
+                    self.alphas[index] = alpha
+                    self.sprites[index].alpha = alpha
+                    self.changed += UNIT_INCREMENT
+
+    def stats(self):
+        """Returns the counters and timing of the last update."""
+        return {
+            "tiles": len(self.sprites),
+            "checked": self.checked,
+            "changed": self.changed,
+            "time": self.time,
+        }
+
+class CaveFog:
+    """
+    Draws the Cave layer as one GPU pass, cutting a see-through hole
+    around the player with a shader instead of changing the opacity of
+    each cave tile. The hole follows the game camera, as the fog works
+    out where each pixel is on the map from the camera's position.
+    """
+
+    def __init__(self, ctx, size):
+        """
+        Compiles the shaders and makes the offscreen image the Cave
+        layer is drawn to. Raises an error if shaders aren't available.
+        framebuffer:    The offscreen image of the Cave layer.
+        quad:           A quad covering a whole image.
+        fog_program:    The shader which draws the cave with the hole.
+        explored_program:   The shader which marks explored squares.
+        """
+        self.ctx = ctx
+        self.framebuffer = ctx.framebuffer(
+            color_attachments=[
+                ctx.texture(size, filter=(ctx.NEAREST, ctx.NEAREST))
+                ]
+            )
+        self.quad = arcade.gl.geometry.quad_2d_fs()
+        self.fog_program = ctx.program(
+            vertex_shader=CAVE_FOG_VERTEX_SHADER,
+            fragment_shader=CAVE_FOG_SHADER,
+            )
+        self.explored_program = ctx.program(
+            vertex_shader=CAVE_FOG_VERTEX_SHADER,
+            fragment_shader=CAVE_EXPLORED_SHADER,
+            )
+        self.fog_program["cave"] = FIRST_VALUE
+        self.fog_program["explored"] = INDEX_OFFSET
+
+    def capture(self):
+        """
+        Clears the offscreen image and returns a context manager which
+        makes everything drawn inside it go to the offscreen image.
+        """
+        self.framebuffer.clear()
+        return self.framebuffer.activate()
+
+    def get_explored(self, cave_reveal, map_size):
+        """
+        Returns the explored framebuffer of a level's cave, making it
+        the first time (with nothing explored).
+        """
+        if cave_reveal.explored is None:
+            cave_reveal.explored = self.ctx.framebuffer(
+                color_attachments=[
+                    self.ctx.texture(
+                        map_size,
+                        components=ONE_BLOCK,
+                        filter=(self.ctx.NEAREST, self.ctx.NEAREST),
+                        )
+                    ]
+                )
+            cave_reveal.explored.clear()
+        return cave_reveal.explored
+
+    def draw(self, cave_reveal, player_position, view, map_size, tile_size):
+        """
+        Marks the squares near the player as explored, then draws the
+        offscreen image of the Cave layer onto the screen through the
+        fog shader.
+        view is the (left, bottom, right, top) of the camera and
+        map_size is the size of the map in tiles.
+        """
+        map_size_px = (
+            map_size[X_POS]*tile_size[X_POS],
+            map_size[Y_POS]*tile_size[Y_POS],
+            )
+        explored = self.get_explored(cave_reveal, map_size)
+        self.explored_program["map_size"] = map_size_px
+        self.explored_program["player"] = player_position
+        self.explored_program["reveal_distance"] = (
+            cave_reveal.reveal_distance
+            )
+        with explored.activate():
+            self.quad.render(self.explored_program)
+
+        left, bottom, right, top = view
+        self.fog_program["view_origin"] = (left, bottom)
+        self.fog_program["view_size"] = (right - left, top - bottom)
+        self.fog_program["map_size"] = map_size_px
+        self.fog_program["player"] = player_position
+        self.fog_program["reveal_distance"] = cave_reveal.reveal_distance
+        self.fog_program["transparent_distance"] = (
+            cave_reveal.transparent_distance
+            )
+        self.framebuffer.color_attachments[FIRST_VALUE].use(FIRST_VALUE)
+        explored.color_attachments[FIRST_VALUE].use(INDEX_OFFSET)
+        self.quad.render(self.fog_program)
+
+class InteractableIndex:
+    """
+    Indexes everything the player can interact with in a level (warp
+    doors, villagers, statues and goal portals) in a grid, so only the
+    things in the 9 squares around the player have to be checked.
+    None of these move, so the grid is only built once per level.
+    """
+
+    def __init__(self, cell_size):
+        """
+        Initialises an empty index.
+        cell_size:  The width and height (in pixels) of the squares.
+        cells:      The things in each square, with the kind of thing
+                    (the layer name) and the order they were added in.
+        order:      The order each thing was added in, so things near
+                    the player are always checked in the same order as
+                    their layer.
+        queries:    Number of times the index has been searched.
+        """
+        self.cell_size = cell_size
+        self.cells = {}
+        self.order = {}
+        self.queries = NOTHING
+
+    def get_cell(self, position):
+        """Returns the grid square a position is in."""
+        return (
+            math.floor(position[X_POS] / self.cell_size),
+            math.floor(position[Y_POS] / self.cell_size),
+        )
+
+    def add(self, kind, item, bottom_left, top_right=None):
+        """
+        Adds a thing to every square between two corners. (Or to the
+        square of one position if no top_right corner is given)
+        """
+        if top_right is None:
+            top_right = bottom_left
+        self.order[item] = len(self.order)
+        left, bottom = self.get_cell(bottom_left)
+        right, top = self.get_cell(top_right)
+        for x in range(left, right + UNIT_INCREMENT):
+            for y in range(bottom, top + UNIT_INCREMENT):
+                self.cells.setdefault((x, y), []).append((kind, item))
+
+    def add_sprites(self, kind, sprite_list):
+        """Adds every sprite in a layer to the squares it covers."""
+        for sprite in sprite_list:
+            self.add(
+                kind,
+                sprite,
+                (sprite.left, sprite.bottom),
+                (sprite.right, sprite.top),
+                )
+
+    def query(self, position):
+        """
+        Returns the things of each kind in the squares around a
+        position, in the order they were added.
+        """
+        self.queries += UNIT_INCREMENT
+        cell_x, cell_y = self.get_cell(position)
+        nearby = {}
+        for x in (cell_x - ONE_BLOCK, cell_x, cell_x + ONE_BLOCK):
+            for y in (cell_y - ONE_BLOCK, cell_y, cell_y + ONE_BLOCK):
+                for kind, item in self.cells.get((x, y), ()):
+                    nearby.setdefault(kind, set()).add(item)
+        return {
+            kind: sorted(items, key=self.order.__getitem__)
+            for kind, items in nearby.items()
+        }
+
+
+class LevelState:
+    """
+    Everything that is built when a level is set up and belongs to the
+    level rather than to the player, so that it can be stored in the
+    level cache and used again when the player comes back.
+    """
+
+    def __init__(
+        self, 
+        tile_map, 
+        scene, 
+        doors, 
+        walls, 
+        text_layer, 
+        layer_flags,
+        cave_reveal=None,
+        interactables=None,
+        ):
+        """
+        Stores the level state.
+        tile_map:       The loaded tilemap.
+        scene:          The scene with every sprite in the level,
+                        including ones which were changed or removed
+                        while the player was in the level.
+        doors:          The warp door information of the level.
+        walls:          The sprite lists which the physics engine uses
+                        as walls.
+        text_layer:     The object list of the guiding text, or None.
+        layer_flags:    The map_has_* control variables of the level.
+        cave_reveal:    The index of the cave tiles, or None.
+        interactables:  The index of the doors, villagers, statues and
+                        goal portals.
+        """
+        self.tile_map = tile_map
+        self.scene = scene
+        self.doors = doors
+        self.walls = walls
+        self.text_layer = text_layer
+        self.layer_flags = layer_flags
+        self.cave_reveal = cave_reveal
+        self.interactables = interactables
+
+    def estimate_memory(self):
+        """
+        Returns a rough estimate of the memory used by the level,
+        based on the number of sprites in it.
+        """
+        sprite_count = sum(
+            len(sprite_list) for sprite_list in self.scene.sprite_lists
+            )
+        return sprite_count * SPRITE_MEMORY_ESTIMATE
+
+class LevelCache:
+    """
+    Least recently used cache of built levels, keyed by the level id.
+    When the estimated memory of the cached levels goes over the
+    budget, the levels which were visited longest ago are removed.
+    The most recently visited level is always kept.
+    """
+
+    def __init__(self, budget=LEVEL_CACHE_BUDGET):
+        """
+        Initialises the cache and the counters.
+        budget:     Rough number of bytes the cached levels can use.
+        levels:     The cached level states, ordered from least to most
+                    recently used. (Dictionaries keep their order)
+        sizes:      The estimated memory of each cached level.
+        hits:       Number of times a level was already built.
+        misses:     Number of times a level had to be built.
+        evictions:  Number of levels removed to stay under budget.
+        """
+        self.budget = budget
+        self.levels = {}
+        self.sizes = {}
+        self.hits = NOTHING
+        self.misses = NOTHING
+        self.evictions = NOTHING
+
+    def get(self, level):
+        """
+        Returns the cached state of a level and marks it as the most
+        recently used, or returns None if the level isn't cached.
+        """
+        level = str(level)
+        if level not in self.levels:
+            self.misses += UNIT_INCREMENT
+            return None
+        self.hits += UNIT_INCREMENT
+        level_state = self.levels.pop(level)
+        self.levels[level] = level_state
+        return level_state
+
+    def put(self, level, level_state):
+        """
+        Adds a level to the cache and then removes the least recently
+        used levels until the cache is back under its budget.
+        """
+        level = str(level)
+        self.evict(level)
+        self.levels[level] = level_state
+        self.sizes[level] = level_state.estimate_memory()
+        while (
+            sum(self.sizes.values()) > self.budget 
+            and len(self.levels) > INDEX_OFFSET
+            ):
+            oldest_level = next(iter(self.levels))
+            self.evict(oldest_level)
+            self.evictions += UNIT_INCREMENT
+
+    def evict(self, level):
+        """Removes a level from the cache if it is in there."""
+        level = str(level)
+        self.levels.pop(level, None)
+        self.sizes.pop(level, None)
+
+    def stats(self):
+        """Returns the counters and the current size of the cache."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "levels": list(self.levels),
+            "memory": sum(self.sizes.values()),
+            "budget": self.budget,
+        }
+
+    def clear(self):
+        """Forgets every cached level and resets the counters."""
+        self.levels.clear()
+        self.sizes.clear()
+        self.hits = NOTHING
+        self.misses = NOTHING
+        self.evictions = NOTHING
+
+
+class LevelPrefetcher:
+    """
+    Loads the levels next to the current level on a background thread.
+    The levels next to a level are the ones its warp doors and goal
+    portals lead to. Loading a level here does everything that doesn't
+    need OpenGL: reading (or compiling) the map, decoding the tile
+    textures and creating the tile sprites.
+    """
+
+    def __init__(self):
+        """
+        Initialises the loading thread and the counters.
+        executor:   Runs the loading jobs on a background thread.
+        pending:    The loading job (a Future) for each level which is
+                    being or has been prefetched.
+        progress:   The fraction of each pending level which has been
+                    loaded so far.
+        hits:       Number of times a prefetched level was used.
+        misses:     Number of times a level wasn't prefetched.
+        tracer:     The Tracer the loading is recorded by (or None).
+        closed:     Whether the loading thread has been stopped.
+        """
+        self.executor = ThreadPoolExecutor(
+            max_workers=PREFETCH_THREADS, thread_name_prefix="prefetch"
+            )
+        self.pending = {}
+        self.progress = {}
+        self.hits = NOTHING
+        self.misses = NOTHING
+        self.tracer = None
+        self.closed = False
+
+    def neighbours(self, tile_map):
+        """
+        Returns the ids of the levels that the warp doors and goal
+        portals in a tilemap lead to. Levels without a map (like the
+        end of the game) are left out.
+        """
+        levels = []
+        for layer_name in [LAYER_NAME_WARP_DOORS, LAYER_NAME_GOAL]:
+            for tiled_object in tile_map.object_lists.get(layer_name, []):
+                level = str(tiled_object.properties.get("warp"))
+                if (
+                    level not in levels
+                    and os.path.exists(f"{MAIN_PATH}/maps/{level}.tmx")
+                    ):
+                    levels.append(level)
+        return levels
+
+    def prefetch(self, tile_map, skip=()):
+        """
+        Starts loading every level next to the given tilemap, except for
+        the ones in skip (e.g. levels which are already in the level
+        cache). Prefetched levels which aren't next to this tilemap any
+        more are dropped.
+        """
+        levels = [
+            level for level in self.neighbours(tile_map) 
+            if level not in skip
+            ]
+        for level in list(self.pending):
+            if level not in levels:
+                self.pending.pop(level).cancel()
+                self.progress.pop(level, None)
+        for level in levels:
+            self.request(level)
+
+    def request(self, level):
+        """
+        Starts loading a level if it isn't already being loaded (and the
+        prefetcher hasn't been closed).
+        """
+        level = str(level)
+        if self.closed or level in self.pending:
+            return
+        self.progress[level] = NOTHING
+        self.pending[level] = self.executor.submit(self.load, level)
+
+    def load(self, level):
+        """Loads a level's tilemap. (Worker thread)"""
+        start = time.perf_counter()
+        tile_map = load_level(
+            f"{MAIN_PATH}/maps/{level}.tmx",
+            TILE_SCALING,
+            LAYER_OPTIONS,
+            True,
+            partial(self.set_progress, level),
+            )
+        if self.tracer is not None:
+            self.tracer.record(
+                f"load {level}", start, time.perf_counter(), "prefetch"
+                )
+        return tile_map
+
+    def set_progress(self, level, fraction):
+        """Records how much of a level has been loaded. (Worker thread)"""
+        self.progress[level] = fraction
+
+    def get_progress(self, level):
+        """
+        Returns the fraction of a level which has been loaded, which is
+        1 for levels that aren't being loaded.
+        """
+        return self.progress.get(str(level), ONE_BLOCK)
+
+    def is_ready(self, level):
+        """
+        Checks if a level can be taken without waiting, which is when
+        it has finished loading or isn't being loaded at all.
+        """
+        future = self.pending.get(str(level))
+        return future is None or future.done()
+
+    def wait(self, level):
+        """Waits for a level to finish loading (if it is loading)."""
+        future = self.pending.get(str(level))
+        if future is not None:
+            wait([future])
+
+    def take(self, level):
+        """
+        Returns the prefetched tilemap of a level, ready to be used.
+        If the level is still loading this waits for it to finish, since
+        that is quicker than starting again. Returns None if the level
+        wasn't prefetched or couldn't be loaded in the background.
+        """
+        self.progress.pop(str(level), None)
+        future = self.pending.pop(str(level), None)
+        if future is None or future.cancel():
+            self.misses += UNIT_INCREMENT
+            return None
+        try:
+            tile_map = future.result()
+        except Exception:
+            self.misses += UNIT_INCREMENT
+            return None
+        self.hits += UNIT_INCREMENT
+        # (Without a window there is no OpenGL to initialise)
+        if arcade.get_window().ctx is not None:
+            tile_map.initialize()
+        return tile_map
+
+    def close(self):
+        """
+        Stops the loading thread once the level it is loading (if any)
+        has loaded, and drops the levels waiting to be loaded.
+        Nothing is prefetched after this, and taking a level which was
+        dropped counts as a miss.
+        """
+        self.closed = True
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self):
+        """Returns the hit/miss counters of the prefetcher."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "pending": list(self.pending),
+        }
+
+
+class LevelTransition:
+    """
+    Keeps track of a move to another level, which goes through the
+    phases fade out, loading and fade in. The time each phase takes
+    is recorded so that slow transitions can be found.
+    """
+
+    def __init__(self, level, spawnpoint):
+        """
+        Starts a transition in the fade out phase.
+        level:          The level being moved to.
+        spawnpoint:     Where the player starts in the new level.
+        phase:          The current phase of the transition.
+        phase_time:     Game time spent in the current phase.
+        progress:       Fraction of the new level which has been loaded.
+        timings:        Real time (in seconds) each finished phase took.
+        """
+        self.level = level
+        self.spawnpoint = spawnpoint
+        self.phase = TRANSITION_FADE_OUT
+        self.phase_time = NOTHING
+        self.phase_start = time.perf_counter()
+        self.progress = NOTHING
+        self.timings = {}
+
+    def next_phase(self, phase):
+        """Records the time the current phase took and starts the next."""
+        now = time.perf_counter()
+        self.timings[self.phase] = now - self.phase_start
+        self.phase = phase
+        self.phase_time = NOTHING
+        self.phase_start = now
+
+    def get_alpha(self):
+        """Returns the opacity of the black screen drawn over the game."""
+        fade = min(self.phase_time / TRANSITION_FADE_TIME, ONE_BLOCK)
+        if self.phase == TRANSITION_FADE_OUT:
+            return int(fade * MAX_OPACITY)
+        if self.phase == TRANSITION_FADE_IN:
+            return int((ONE_BLOCK - fade) * MAX_OPACITY)
+        return MAX_OPACITY
+
+# Heads up display
+class HUD:
+    """
+    The energy and health bars in the top right of the screen.
+    Every frame of the bars is loaded once, and a bar's texture is only
+    changed when the value it shows changes.
+    """
+
+    def __init__(self, energy, health):
+        """
+        Loads the bar frames and makes the GUI scene with the bars.
+        frames:     The textures for each value of each bar, by layer.
+        values:     The value each bar is currently showing.
+        scene:      The GUI scene the bars are drawn from.
+        updates:    Number of times a bar texture was changed.
+        skipped:    Number of bar updates skipped because the value
+                    hadn't changed.
+        """
+        self.frames = {
+            LAYER_NAME_ENERGY: [
+                TEXTURE_REGISTRY.get_image(f"GUI/Energy/{value}.png")
+                for value in range(MAX_ENERGY + INDEX_OFFSET)
+            ],
+            LAYER_NAME_HEALTH: [
+                TEXTURE_REGISTRY.get_image(f"GUI/Health/{value}.png")
+                for value in range(MAX_HEALTH + INDEX_OFFSET)
+            ],
+        }
+        self.values = {
+            LAYER_NAME_ENERGY: energy,
+            LAYER_NAME_HEALTH: health,
+        }
+        self.updates = NOTHING
+        self.skipped = NOTHING
+
+        # Setup energy bar
+        # This is an image in the top right of the screen,
+        # which changes depending on the amount of energy possessed.
+        # Setup health bar
+        # This works the same as the energy bar, just a bit lower.
+        self.scene = arcade.Scene()
+        self.scene.add_sprite(
+            LAYER_NAME_ENERGY,
+            arcade.Sprite(
+                texture=self.frames[LAYER_NAME_ENERGY][energy],
+                scale=TILE_SCALING,
+                center_x=SCREEN_WIDTH-TILE_SCALING*ENERGY_BAR_OFFSET[X_POS],
+                center_y=SCREEN_HEIGHT-TILE_SCALING*ENERGY_BAR_OFFSET[Y_POS],
+                )
+            )
+        self.scene.add_sprite(
+            LAYER_NAME_HEALTH,
+            arcade.Sprite(
+                texture=self.frames[LAYER_NAME_HEALTH][health],
+                scale=TILE_SCALING,
+                center_x=SCREEN_WIDTH-TILE_SCALING*HEALTH_BAR_OFFSET[X_POS],
+                center_y=SCREEN_HEIGHT-TILE_SCALING*HEALTH_BAR_OFFSET[Y_POS],
+            )
+        )
+
+    def set_value(self, layer_name, value):
+        """
+        Changes the texture of a bar to show a new value, if the value
+        has changed. Values without a frame (e.g. negative health for
+        the frame before respawning) leave the bar as it is.
+        """
+        if self.values[layer_name] == value:
+            self.skipped += UNIT_INCREMENT
+            return
+        self.values[layer_name] = value
+        frames = self.frames[layer_name]
+        if NOTHING <= value < len(frames):
+            for bar in self.scene[layer_name]:
+                bar.texture = frames[value]
+            self.updates += UNIT_INCREMENT
+
+    def set_energy(self, energy):
+        """Shows the amount of energy on the energy bar."""
+        self.set_value(LAYER_NAME_ENERGY, energy)
+
+    def set_health(self, health):
+        """Shows the amount of health on the health bar."""
+        self.set_value(LAYER_NAME_HEALTH, health)
+
+    def draw(self):
+        """Draws the bars."""
+        self.scene.draw(pixelated=True)
+
+    def stats(self):
+        """Returns the update/skip counters of the HUD."""
+        return {
+            "updates": self.updates,
+            "skipped": self.skipped,
+        }
+
+# Retained text
+class TextManager:
+    """
+    Keeps a text label for every piece of text drawn on the screen, so
+    the text only has to be laid out again when it changes instead of
+    every frame (which is what arcade.draw_text does).
+    Labels are grouped into one batch per camera, and each batch is
+    drawn all at once.
+    """
+
+    def __init__(self):
+        """
+        Initialises the batches and labels, which are made the first
+        time they are needed (as they need the window to exist).
+        batches:    The pyglet batch for each group of text.
+        labels:     The labels in each group by their key.
+        shown:      The keys of the labels shown this frame by group.
+        layouts:    Number of times a label had to be laid out.
+        reused:     Number of times a label was drawn without being
+                    laid out again.
+        """
+        self.batches = {}
+        self.labels = {}
+        self.shown = {}
+        self.layouts = NOTHING
+        self.reused = NOTHING
+
+    def show(
+        self,
+        batch_name,
+        key,
+        text,
+        x,
+        y,
+        colour,
+        font_size,
+        anchor_x="center",
+        anchor_y="center",
+    ):
+        """
+        Shows a label this frame. If a label with the same key was
+        shown before it is reused, and it's only laid out again if its
+        text has changed. (Moving a label doesn't need a new layout)
+        """
+        if batch_name not in self.batches:
+            self.batches[batch_name] = pyglet.graphics.Batch()
+            self.labels[batch_name] = {}
+            self.shown[batch_name] = set()
+        labels = self.labels[batch_name]
+        self.shown[batch_name].add(key)
+        label = labels.get(key)
+        if label is None:
+            labels[key] = pyglet.text.Label(
+                text,
+                font_name=TEXT_FONT_NAMES,
+                font_size=font_size,
+                x=x,
+                y=y,
+                anchor_x=anchor_x,
+                anchor_y=anchor_y,
+                color=tuple(colour) + (MAX_OPACITY,),
+                batch=self.batches[batch_name],
+            )
+            self.layouts += UNIT_INCREMENT
+            return
+        if not label.visible:
+            label.visible = True
+            self.layouts += UNIT_INCREMENT
+        if label.text != text:
+            label.text = text
+            self.layouts += UNIT_INCREMENT
+        else:
+            self.reused += UNIT_INCREMENT
+        if label.position != (x, y):
+            label.position = (x, y)
+
+    def draw(self, batch_name):
+        """
+        Draws every label in a group which has been shown since the last
+        time it was drawn. Labels which weren't shown are hidden.
+        """
+        if batch_name not in self.batches:
+            return
+        shown = self.shown[batch_name]
+        for key, label in self.labels[batch_name].items():
+            if key not in shown and label.visible:
+                label.visible = False
+        shown.clear()
+        with arcade.get_window().ctx.pyglet_rendering():
+            self.batches[batch_name].draw()
+
+    def stats(self):
+        """Returns the layout/reuse counters of the labels."""
+        return {
+            "labels": sum(len(labels) for labels in self.labels.values()),
+            "layouts": self.layouts,
+            "reused": self.reused,
+        }
+
+
+class QuestEngine:
+    """
+    The quests loaded from the quest data file, and which of the
+    active quests need each item, so a picked up item can be given to
+    its quest straight away. New quest items only need adding to the
+    data file.
+    """
+
+    def __init__(self, path=QUEST_DATA):
+        """
+        Loads the quests.
+        quests:         The information of each quest by its ID, in the
+                        order they are in the file.
+        item_quests:    The IDs of the active quests which need each
+                        item, in the order they were started.
+        """
+        with open(path) as file:
+            data = json.load(file)
+        self.quests = {quest["id"]: quest for quest in data["quests"]}
+        self.item_quests = {}
+
+    def get(self, quest_id):
+        """Returns the information of a quest."""
+        return self.quests[quest_id]
+
+    def new_quest_inventory(self):
+        """Returns an empty inventory of the items each quest needs."""
+        return {
+            quest_id: {"name": quest["item_name"], "number": NOTHING}
+            for quest_id, quest in self.quests.items()
+        }
+
+    def new_reward_inventory(self):
+        """Returns an empty inventory of the quest rewards."""
+        return {
+            quest_id: {
+                "name": quest["reward_item"],
+                "type": quest["reward_type"],
+                "number": NOTHING,
+            }
+            for quest_id, quest in self.quests.items()
+            if quest["reward_type"] is not None
+        }
+
+    def activate(self, quest_id):
+        """Starts routing the quest's item to it."""
+        item = self.quests[quest_id]["item"]
+        self.item_quests.setdefault(item, []).append(quest_id)
+
+    def end(self, quest_id):
+        """Stops routing the quest's item to it."""
+        item = self.quests[quest_id]["item"]
+        self.item_quests[item].remove(quest_id)
+
+    def quest_for_item(self, item):
+        """
+        Returns the ID of the active quest which an item goes to, or
+        None if no active quest needs it. (If more than one does it
+        goes to the most recently started one)
+        """
+        quest_ids = self.item_quests.get(item)
+        if quest_ids:
+            return quest_ids[-1]
+        return None
+
+
+class GameSystem:
+    """
+    One part of the game logic which runs every step (e.g. enemy
+    patrols or orb collection), with the layers it needs to run.
+    """
+
+    def __init__(self, name, update, layers=(), condition=None):
+        """
+        Initialises the system.
+        name:       The name shown in profiles.
+        update:     The function run every step. It is given the step
+                    time, and returns True if the rest of the step
+                    shouldn't run (e.g. the level is changing).
+        layers:     The scene layers which must exist for the system
+                    to run.
+        condition:  Function which returns whether the system can run
+                    in the loaded level (or None if it only needs its
+                    layers).
+        time:       Total time spent running the system.
+        calls:      Number of times the system has run.
+        """
+        self.name = name
+        self.update = update
+        self.layers = layers
+        self.condition = condition
+        self.time = NOTHING
+        self.calls = NOTHING
+
+
+class SystemScheduler:
+    """
+    Runs the game systems in order every step.
+    Which systems run is worked out once when a level is set up, from
+    the layers the level has, so systems for layers the level doesn't
+    have are skipped instead of failing every step.
+    """
+
+    def __init__(self):
+        """
+        Initialises the scheduler.
+        systems:        Every system in the order they run.
+        enabled:        The systems which run in the loaded level.
+        timing_hook:    Function given the name, start and end time of
+                        every system run, so that a profiler can see
+                        the cost of each system (or None).
+        """
+        self.systems = []
+        self.enabled = []
+        self.timing_hook = None
+
+    def add(self, name, update, layers=(), condition=None):
+        """Adds a system to the end of the running order."""
+        self.systems.append(GameSystem(name, update, layers, condition))
+
+    def enable(self, scene):
+        """
+        Enables only the systems whose layers are in the scene and
+        whose condition is met.
+        """
+        self.enabled = [
+            system for system in self.systems
+            if all(layer in scene.name_mapping for layer in system.layers)
+            and (system.condition is None or system.condition())
+        ]
+
+    def run(self, delta_time):
+        """
+        Runs the enabled systems in order, timing each one.
+        Returns True if a system stopped the rest of the step.
+        """
+        for system in self.enabled:
+            start = time.perf_counter()
+            stop = system.update(delta_time)
+            end = time.perf_counter()
+            system.time += end - start
+            system.calls += UNIT_INCREMENT
+            if self.timing_hook is not None:
+                self.timing_hook(system.name, start, end)
+            if stop:
+                return True
+        return False
+
+    def stats(self):
+        """
+        Returns the enabled systems, and the total and average time of
+        every system which has run.
+        """
+        return {
+            "enabled": [system.name for system in self.enabled],
+            "systems": {
+                system.name: {
+                    "calls": system.calls,
+                    "total_ms": system.time * 1000,
+                    "mean_ms": system.time * 1000 / system.calls,
+                }
+                for system in self.systems
+                if system.calls > NOTHING
+            },
+        }
+
+
+def summarise_times(times):
+    """
+    Returns the mean and the PROFILER_PERCENTILES percentiles of some
+    times (in seconds) in milliseconds.
+    """
+    ordered = sorted(times)
+    summary = {"mean_ms": sum(ordered) * 1000 / len(ordered)}
+    for percentile in PROFILER_PERCENTILES:
+        index = min(int(percentile * len(ordered)), len(ordered)-1)
+        summary[f"p{round(percentile*100)}_ms"] = ordered[index] * 1000
+    return summary
+
+
+class FrameProfiler:
+    """
+    Times the parts of every frame (the game systems, and the parts of
+    drawing) while it's turned on, and keeps the times of the last few
+    frames so spikes can be traced to the part which caused them.
+    """
+
+    def __init__(self, frames=PROFILER_FRAMES):
+        """
+        Initialises the profiler, which starts turned off.
+        enabled:    Whether anything is being timed.
+        samples:    The time each part took in the last few frames
+                    (in seconds) by its name, oldest first.
+        current:    The time each part has taken in this frame so far.
+        frames:     The number of frames kept.
+        summary:    The numbers last worked out for the overlay.
+        refresh:    Frames until the overlay numbers are worked out
+                    again.
+        """
+        self.enabled = False
+        self.samples = {}
+        self.current = {}
+        self.frames = frames
+        self.summary = {}
+        self.refresh = NOTHING
+
+    def toggle(self):
+        """Turns the profiler on or off, forgetting the old times."""
+        self.enabled = not self.enabled
+        self.samples = {}
+        self.current = {}
+        self.summary = {}
+        self.refresh = NOTHING
+
+    def record(self, name, start, end):
+        """
+        Adds the time between start and end to a part of this frame.
+        (The same as SystemScheduler.timing_hook, so the systems can be
+        timed by it)
+        """
+        self.current[name] = self.current.get(name, NOTHING) + end - start
+
+    def end_frame(self):
+        """
+        Stores the times of the frame which has just finished. Parts
+        which didn't run in the frame took no time.
+        """
+        if not self.enabled:
+            return
+        for name in self.current:
+            if name not in self.samples:
+                self.samples[name] = deque(maxlen=self.frames)
+        for name, samples in self.samples.items():
+            samples.append(self.current.get(name, NOTHING))
+        self.current = {}
+        self.refresh -= UNIT_INCREMENT
+        if self.refresh <= NOTHING:
+            self.summary = self.stats()
+            self.refresh = PROFILER_REFRESH_FRAMES
+
+    def stats(self):
+        """
+        Returns the mean and percentile times of every part (in
+        milliseconds) over the frames kept.
+        """
+        return {
+            name: summarise_times(samples)
+            for name, samples in self.samples.items()
+        }
+
+    def draw(self, text_manager):
+        """
+        Draws the last worked out numbers in the top left corner of the
+        screen, one line per part. (The GUI camera must be in use)
+        """
+        rows = [["part", "mean"] + [
+            f"p{round(percentile*100)}" for percentile in PROFILER_PERCENTILES
+        ]]
+        for name, part in self.summary.items():
+            rows.append([name] + [f"{value:.2f}" for value in part.values()])
+        columns = len(rows[FIRST_VALUE]) - INDEX_OFFSET
+        arcade.draw_lrtb_rectangle_filled(
+            PROFILER_POSITION[X_POS],
+            (PROFILER_POSITION[X_POS] + PROFILER_NAME_WIDTH
+             + columns*PROFILER_COLUMN_WIDTH),
+            PROFILER_POSITION[Y_POS],
+            PROFILER_POSITION[Y_POS] - len(rows)*PROFILER_LINE_HEIGHT,
+            BLACK,
+        )
+
+        # The names are lined up on the left and the numbers (in ms)
+        # on the right of their columns.
+        for row_number, row in enumerate(rows):
+            y = PROFILER_POSITION[Y_POS] - row_number*PROFILER_LINE_HEIGHT
+            text_manager.show(
+                TEXT_BATCH_PROFILER,
+                (row_number, FIRST_VALUE),
+                row[FIRST_VALUE],
+                PROFILER_POSITION[X_POS],
+                y,
+                WHITE,
+                TIPS_FONT,
+                anchor_x="left",
+                anchor_y="top",
+            )
+            for column, text in enumerate(row[INDEX_OFFSET:], INDEX_OFFSET):
+                text_manager.show(
+                    TEXT_BATCH_PROFILER,
+                    (row_number, column),
+                    text,
+                    (PROFILER_POSITION[X_POS] + PROFILER_NAME_WIDTH
+                     + column*PROFILER_COLUMN_WIDTH),
+                    y,
+                    WHITE,
+                    TIPS_FONT,
+                    anchor_x="right",
+                    anchor_y="top",
+                )
+        text_manager.draw(TEXT_BATCH_PROFILER)
+
+
+class Tracer:
+    """
+    Records when parts of the game start and end (spans), on every
+    thread, and saves them in the Chrome trace event format so the
+    timeline of a slow frame or level change can be looked at.
+    Only the most recent spans are kept.
+    """
+
+    def __init__(self, capacity=TRACE_EVENTS):
+        """
+        Starts the trace.
+        events:     The (name, category, start, end, thread) spans,
+                    oldest first.
+        recorded:   Number of spans recorded, including dropped ones.
+        threads:    The name of every thread which recorded a span.
+        origin:     The time the trace started at.
+        lock:       Stops spans being recorded (e.g. by the level
+                    loading thread) while the trace is being saved.
+        """
+        self.events = deque(maxlen=capacity)
+        self.recorded = NOTHING
+        self.threads = {}
+        self.origin = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def record(self, name, start, end, category="system"):
+        """
+        Records a span on the current thread.
+        (Takes the same arguments as SystemScheduler.timing_hook)
+        """
+        thread = threading.get_ident()
+        with self.lock:
+            if thread not in self.threads:
+                self.threads[thread] = threading.current_thread().name
+            self.events.append((name, category, start, end, thread))
+            self.recorded += UNIT_INCREMENT
+
+    @contextmanager
+    def span(self, name, category="system"):
+        """Records the code inside the with block as a span."""
+        start = time.perf_counter()
+        yield
+        self.record(name, start, time.perf_counter(), category)
+
+    def save(self, path):
+        """
+        Writes the trace to a file in the Chrome trace event format.
+        (Times in the format are in microseconds)
+        Spans recorded while it is being written aren't included.
+        """
+        with self.lock:
+            events = list(self.events)
+            threads = dict(self.threads)
+            recorded = self.recorded
+        process = os.getpid()
+        trace_events = [
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": process,
+                "tid": thread,
+                "args": {"name": thread_name},
+            }
+            for thread, thread_name in threads.items()
+        ]
+        for name, category, start, end, thread in events:
+            trace_events.append({
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": (start - self.origin) * 1000000,
+                "dur": (end - start) * 1000000,
+                "pid": process,
+                "tid": thread,
+            })
+        with open(path, "w") as file:
+            json.dump(
+                {
+                    "traceEvents": trace_events,
+                    "displayTimeUnit": "ms",
+                    "otherData": {
+                        "dropped": recorded - len(events),
+                    },
+                },
+                file,
+            )
+
+
+class CollisionPhase:
+    """
+    Checks what the player is touching at most once per layer every
+    step, and sends the sprites touched to the handlers for that layer's
+    collision event.
+    The physics engine's can_jump and is_on_ladder results are also kept
+    once they have been worked out. Everything kept is only right while
+    the player stays where the physics engine moved them, so anything
+    which moves the player in the middle of a step (e.g. respawning)
+    has to call clear() afterwards.
+    Outside of a step (e.g. in key presses) nothing is kept.
+    """
+
+    def __init__(self):
+        """
+        Initialises the collision phase.
+        handlers:       The functions called for each event, given the
+                        sprite touched. A handler returns True if the
+                        rest of the step shouldn't run.
+        player_sprite:  The player, while a step is running.
+        scene:          The scene, while a step is running.
+        physics_engine: The physics engine, while a step is running.
+        interactables:  The index of the things the player can
+                        interact with, while a step is running.
+        nearby_items:   The things near the player this step (or None
+                        if the index hasn't been searched yet).
+        collisions:     The sprites touched in each layer this step.
+        predicates:     The can_jump/is_on_ladder results this step.
+        requests:       Number of collision checks asked for.
+        queries:        Number of collision checks actually done.
+        steps:          Number of steps run.
+        """
+        self.handlers = {}
+        self.player_sprite = None
+        self.scene = None
+        self.physics_engine = None
+        self.interactables = None
+        self.nearby_items = None
+        self.collisions = {}
+        self.predicates = {}
+        self.requests = NOTHING
+        self.queries = NOTHING
+        self.steps = NOTHING
+
+    def on(self, event, handler):
+        """Adds a handler for a collision event."""
+        self.handlers.setdefault(event, []).append(handler)
+
+    def begin(self, player_sprite, scene, physics_engine, interactables):
+        """
+        Starts a step. This runs after the physics engine has moved the
+        player.
+        """
+        self.player_sprite = player_sprite
+        self.scene = scene
+        self.physics_engine = physics_engine
+        self.interactables = interactables
+        self.clear()
+        self.steps += UNIT_INCREMENT
+
+    def clear(self):
+        """
+        Forgets everything found so far, so it is checked again the next
+        time it is asked for. Called whenever the player is moved in the
+        middle of a step.
+        """
+        self.nearby_items = None
+        self.collisions = {}
+        self.predicates = {}
+
+    def end(self):
+        """Ends a step, forgetting everything found in it."""
+        self.player_sprite = None
+        self.scene = None
+        self.physics_engine = None
+        self.interactables = None
+        self.clear()
+
+    def nearby(self, kind):
+        """
+        Returns the things of a kind (a layer name) near the player,
+        searching the index only once per step.
+        """
+        if self.nearby_items is None:
+            self.nearby_items = self.interactables.query(
+                self.player_sprite.position
+                )
+        return self.nearby_items.get(kind, [])
+
+    def touching(self, layer_name):
+        """
+        Returns the sprites in a layer the player is touching, checking
+        the first time it is asked for in the step.
+        """
+        self.requests += UNIT_INCREMENT
+        collisions = self.collisions.get(layer_name)
+        if collisions is None:
+            sprite_list = self.scene[layer_name]
+            if layer_name in INDEXED_COLLISION_LAYERS:
+                # Only the indexed sprites near the player which are
+                # still in the layer are checked.
+                collisions = [
+                    sprite for sprite in self.nearby(layer_name)
+                    if sprite_list in sprite.sprite_lists
+                    and arcade.check_for_collision(self.player_sprite, sprite)
+                ]
+            else:
+                collisions = arcade.check_for_collision_with_list(
+                    self.player_sprite, sprite_list
+                    )
+            self.collisions[layer_name] = collisions
+            self.queries += UNIT_INCREMENT
+        return collisions
+
+    def check(self, physics_engine, name, *args):
+        """
+        Returns the result of one of the physics engine's checks,
+        working it out only once per step.
+        """
+        self.requests += UNIT_INCREMENT
+        if physics_engine is not self.physics_engine:
+            # Not in a step (or a different engine) so nothing is kept.
+            self.queries += UNIT_INCREMENT
+            return getattr(physics_engine, name)(*args)
+        key = (name,) + args
+        if key not in self.predicates:
+            self.predicates[key] = getattr(physics_engine, name)(*args)
+            self.queries += UNIT_INCREMENT
+        return self.predicates[key]
+
+    def can_jump(self, physics_engine, y_distance=5):
+        """The physics engine's can_jump, kept for the step."""
+        return self.check(physics_engine, "can_jump", y_distance)
+
+    def is_on_ladder(self, physics_engine):
+        """The physics engine's is_on_ladder, kept for the step."""
+        return self.check(physics_engine, "is_on_ladder")
+
+    def dispatch(self, layer_name):
+        """
+        Sends every sprite the player is touching in a layer to the
+        handlers for the layer's event.
+        Returns True if a handler stopped the rest of the step.
+        """
+        for sprite in self.touching(layer_name):
+            for handler in self.handlers.get(
+                COLLISION_EVENTS[layer_name], []
+                ):
+                if handler(sprite):
+                    return True
+        return False
+
+    def stats(self):
+        """
+        Returns how many collision checks were asked for and how many
+        were actually done per step.
+        """
+        steps = max(self.steps, UNIT_INCREMENT)
+        return {
+            "requests": self.requests,
+            "queries": self.queries,
+            "requests_per_step": self.requests / steps,
+            "queries_per_step": self.queries / steps,
+        }
+
+
+# Entity superclass
+class Entity(arcade.Sprite):
+    """Overarching class for every sprite."""
+
+    def __init__(self, category_folder, sprite_folder, available_anims: list):
+        """
+        Initialises all of the texture lists relevant to the entity.
+        Default texture is the first idle texture.
+        """
+        # Inherit from parent class (arcade.Sprite)
+        super().__init__()
+
+        # Default right facing
+        self.facing_direction = RIGHT_FACING
+
+        # Set the current texture index to 0, which is the first
+        # texture. Scale the textures by CHARACTER_SCALING by default.
+        # (This can be overidden in child classes).
+        self.cur_texture = FIRST_TEXTURE
+        self.scale = CHARACTER_SCALING
+
+        # The below section fetches the texture pairs for every
+        # animation the entity has from the shared texture registry.
+        # Since all of the code is essentially the same here,
+        # I'll just put the explanation up here for the whole thing.
+        # The registry only reads the frames from the disk the first
+        # time an animation is asked for, after which every instance
+        # of every entity shares the same list of textures.
+        # The number of frames in each animation is just the length of
+        # the texture list, which is saved for later.
+        if "Idle" in available_anims:
+            # Idle frames
+            self.idle_textures = TEXTURE_REGISTRY.get_animation(
+                category_folder, sprite_folder, "idle"
+                )
+            self.idle_frames = len(self.idle_textures)
+
+        if "Jump" in available_anims:
+            # Jumping and falling sprites
+            self.jump_textures = TEXTURE_REGISTRY.get_animation(
+                category_folder, sprite_folder, "jump"
+                )
+            self.jump_frames = len(self.jump_textures)
+
+            self.fall_textures = TEXTURE_REGISTRY.get_animation(
+                category_folder, sprite_folder, "fall"
+                )
+            self.fall_frames = len(self.fall_textures)
+
+        if "Walk" in available_anims:
+            # Walking frames
+            self.walk_textures = TEXTURE_REGISTRY.get_animation(
+                category_folder, sprite_folder, "walk"
+                )
+            self.walk_frames = len(self.walk_textures)
+
+        if "Climb" in available_anims:
+            # Climbing frames
+            self.climbing_textures = TEXTURE_REGISTRY.get_animation(
+                category_folder, sprite_folder, "climb"
+                )
+            self.climbing_frames = len(self.climbing_textures)
+
+        if "Wave" in available_anims:
+            self.wave_textures = TEXTURE_REGISTRY.get_animation(
+                category_folder, sprite_folder, "wave"
+                )
+            self.wave_frames = len(self.wave_textures)
+
+        if "Death" in available_anims:
+            self.death_textures = TEXTURE_REGISTRY.get_animation(
+                category_folder, sprite_folder, "death"
+                )
+            self.death_frames = len(self.death_textures)
+        
+        if "Open" in available_anims:
+            self.open_textures = TEXTURE_REGISTRY.get_animation(
+                category_folder, sprite_folder, "open"
+                )
+            self.open_frames = len(self.open_textures)
+        
+        if "Closed" in available_anims:
+            self.closed_textures = TEXTURE_REGISTRY.get_animation(
+                category_folder, sprite_folder, "closed"
+                )
+            self.closed_frames = len(self.closed_textures)
+            
+        # Set initial texture
+        self.texture = self.idle_textures[FIRST_TEXTURE][RIGHT_FACING]
+
+        # Set hitbox
+        # Arcade creates a hitbox based on the vertices of the texture.
+        self.set_hit_box(self.texture.hit_box_points)
+
+# Collectible Objects Template class
+class Collectible(Entity):
+    """
+    Template for collectible items like orbs,
+    quest collectibles, and secrets.
+    """
+    def __init__(self, sprite_folder):
+        """
+        Initialises the relevant animations/textures which are
+        the idle textures for collectibles.
+        Sets the scaling of the sprites to COLLECTIBLE_SCALING.
+        """
+        # Inherit from parent class (Entity)
+        super().__init__("InanimateObjects", sprite_folder, ["Idle"])
+
+        # Override the CHARACTER_SCALING from the parent class with
+        # COLLECTIBLE_SCALING
+        self.scale = COLLECTIBLE_SCALING
+
+
+# Energy Orb class
+class Orb(Collectible):
+    """Energy Orb Sprite"""
+
+    def __init__(self):
+        """
+        Loads the specific EnergyOrb textures from the sprite folder
+        in assets. Initialises the type attribute and sets it to None.
+        """
+        # Inherit from parent class (Collectible)
+        super().__init__("EnergyOrb")
+
+        # The type attribute is used to figure out what kind of
+        # collectible the player has collided with.
+        self.type = None
+
+    def update_animation(self, delta_time: float = FRAMERATE):
+        """
+        Updates the texture of the orb every frame.
+        """
+        # For every frame, increase the current texture index by one.
+        # However, the texture only changes every n frame indexes,
+        # where n is the animation rate multiplier defined in the
+        # ANIM_MULT dictionary.
+        # Once the current texture index reaches its maximum,
+        # where the last texture in the loop has displayed for the
+        # correct number of frames, it is reset to 0.
+        self.cur_texture += UNIT_INCREMENT
+        if (
+            self.cur_texture 
+            > 
             self.idle_frames*ANIM_MULT["Orb"]["Idle"]-INDEX_OFFSET
             ):
             self.cur_texture = FIRST_TEXTURE
@@ -1211,33 +4428,38 @@ class MainMenu(arcade.View):
     The main menu screen displayed at the beginning.
     """
 
+    def __init__(self):
+        """Loads the background image once."""
+        super().__init__()
+        self.background = TEXTURE_REGISTRY.get_image(
+            "Screens/Start/Start.PNG"
+            )
+
     def on_show_view(self):
-        """Called when showing this view."""
+        """
+        Called when showing this view.
+        The screen never changes so it is redrawn slowly.
+        """
+        set_frame_rate(MENU_FRAME_RATE)
         self.clear()
-        background = arcade.load_texture(
-            f"{MAIN_PATH}/assets/Screens/Start/Start.PNG"
-            )
         arcade.draw_lrwh_rectangle_textured(
             ORIGIN[X_POS],
             ORIGIN[Y_POS],
             SCREEN_WIDTH,
             SCREEN_HEIGHT,
-            background
+            self.background
         )
 
     def on_draw(self):
         """
         Draws the view every frame.
         """
-        background = arcade.load_texture(
-            f"{MAIN_PATH}/assets/Screens/Start/Start.PNG"
-            )
         arcade.draw_lrwh_rectangle_textured(
             ORIGIN[X_POS],
             ORIGIN[Y_POS],
             SCREEN_WIDTH,
             SCREEN_HEIGHT,
-            background
+            self.background
         )
 
     def on_mouse_press(self, _x, _y, _button, _modifiers):
@@ -1250,31 +4472,36 @@ class Instructions(arcade.View):
     """
     The instructions screen displayed after the menu screen.
     """
+    def __init__(self):
+        """Loads the background image once."""
+        super().__init__()
+        self.background = TEXTURE_REGISTRY.get_image(
+            "Screens/Start/Instructions.PNG"
+            )
+
     def on_show_view(self):
-        """Called when showing this view."""
-        background = arcade.load_texture(
-            f"{MAIN_PATH}/assets/Screens/Start/Instructions.PNG"
-        )
+        """
+        Called when showing this view.
+        The screen never changes so it is redrawn slowly.
+        """
+        set_frame_rate(MENU_FRAME_RATE)
         arcade.draw_lrwh_rectangle_textured(
             ORIGIN[X_POS],
             ORIGIN[Y_POS],
             SCREEN_WIDTH,
             SCREEN_HEIGHT,
-            background
+            self.background
         )
     
     def on_draw(self):
         """Draws the scene every frame."""
         self.clear()
-        background = arcade.load_texture(
-            f"{MAIN_PATH}/assets/Screens/Start/Instructions.PNG"
-            )
         arcade.draw_lrwh_rectangle_textured(
             ORIGIN[X_POS],
             ORIGIN[Y_POS],
             SCREEN_WIDTH,
             SCREEN_HEIGHT,
-            background
+            self.background
         )
 
     def on_mouse_press(self, _x, _y, _button, _modifiers):
@@ -1295,37 +4522,21 @@ class EndScreen(arcade.View):
         and displaying the corresponding image from the folder.
         Takes in the parameter secrets_found, which is the list of
         secrets the player managed to find.
+        (The game loads the image in the background as the secrets are
+        found, so it is normally already loaded by now)
         """
         super().__init__()
-        
-        # Using by checking which secrets are present in the found list
-        # a unique string of numbers can be created for each
-        # combination of secrets. This is subsequently the file name
-        # for each background image.
-        self.secrets_to_display = ""
         self.secrets_found = secrets_found
-        if "Statuette" in self.secrets_found:
-            self.secrets_to_display += "1"
-        else:
-            self.secrets_to_display += "0"
-        if "Diamond Pickaxe" in self.secrets_found:
-            self.secrets_to_display += "1"
-        else:
-            self.secrets_to_display += "0"
-        if "Diamond" in self.secrets_found:
-            self.secrets_to_display += "1"
-        else:
-            self.secrets_to_display += "0"
-        if "Totem" in self.secrets_found:
-            self.secrets_to_display += "1"
-        else:
-            self.secrets_to_display += "0"
-        self.background = arcade.load_texture(
-            f"{MAIN_PATH}/assets/Screens/End/{self.secrets_to_display}.PNG"
+        self.background = TEXTURE_REGISTRY.get_image(
+            end_screen_image(self.secrets_found)
             )
     
     def on_show_view(self):
-        """Called when showing this view."""
+        """
+        Called when showing this view.
+        The screen never changes so it is redrawn slowly.
+        """
+        set_frame_rate(MENU_FRAME_RATE)
         self.clear()
         arcade.draw_lrwh_rectangle_textured(
             ORIGIN[X_POS],
@@ -1360,7 +4571,7 @@ class GameView(arcade.View):
     The actual game class.
     """
 
-    def __init__(self):
+    def __init__(self, window=None, music=True):
         """
         Initialises every attribute needed in the game.
         These include attributes for detecting key presses,
@@ -1371,9 +4582,14 @@ class GameView(arcade.View):
         sound, level changing variables, and the actual functionality
         variables like tilemap and physics engine.
         The music also starts playing on loop.
+
+        Parameters:
+        window: The window the game is in (the current window if None).
+        music:  Whether to play the background music. (Not when the
+                game is run without a window, see HeadlessRunner)
         """
         # Set up window with parent class (arcade.View)
-        super().__init__()
+        super().__init__(window)
 
         # Make the mouse pointer invisible.
         self.window.set_mouse_visible = False
@@ -1401,21 +4617,10 @@ class GameView(arcade.View):
         self.fly_speed = STATIONARY
         self.thrust = PLAYER_THRUST
         self.can_knife = True
-        self.inventory_quest = {
-            "000": {"name": "Apples", "number": 0},
-            "001": {"name": "Cards", "number": 0},
-            "002": {"name": "Documents", "number": 0},
-            "003": {"name": "Ectoplasm", "number": 0},
-            "100": {"name": "Helmet", "number": 0},
-            "200": {"name": "Rainbow Rock", "number": 0}
-        }
-
-        self.inventory_other = {
-            "002": {"name": "Knife", "type": "Weapon", "number": 0},
-            "003": {"name": "Church Key", "type": "Key", "number": 0},
-            "100": {"name": "Cave Key", "type": "Key", "number": 0},
-            "200": {"name": "God Key", "type": "Key", "number": 0}
-        }
+        # Both inventories are made from the quest data.
+        self.quest_engine = QuestEngine()
+        self.inventory_quest = self.quest_engine.new_quest_inventory()
+        self.inventory_other = self.quest_engine.new_reward_inventory()
         self.keys_obtained = []
         self.secrets_found = []
 
@@ -1459,9 +4664,11 @@ class GameView(arcade.View):
         self.new_spawnpoint_text = NOTHING
 
         # Sound effects and audio
-        self.bg_music = arcade.load_sound(
-            f"{MAIN_PATH}/assets/Audio/Background.mp3"
-            )
+        self.bg_music = None
+        if music:
+            self.bg_music = arcade.load_sound(
+                f"{MAIN_PATH}/assets/Audio/Background.mp3"
+                )
 
         # Warp variables
         # This dictionary records the positions of where the 
@@ -1472,6 +4679,46 @@ class GameView(arcade.View):
         self.spawnpoint = (PLAYER_START_X, PLAYER_START_Y)
         self.prev_spawnpoint = None
 
+        # Built levels which can be used again when the player
+        # returns to them.
+        self.level_cache = LevelCache()
+
+        # Loads the levels next to the current level in the background.
+        self.prefetcher = LevelPrefetcher()
+
+        # Loads the end screen image for the secrets found so far in
+        # the background, so the end screen can show straight away.
+        self.end_screen_preload = None
+        self.preload_end_screen()
+
+        # Number of layer chunks drawn and skipped in the last frame.
+        self.chunks_drawn = NOTHING
+        self.chunks_culled = NOTHING
+
+        # The move to another level currently happening (or None),
+        # and the phase timings of the last finished one.
+        self.transition = None
+        self.transition_timings = None
+
+        # Fixed timestep variables
+        # step_accumulator is the time which hasn't been simulated yet,
+        # render_alpha is how far between the last two steps the moving
+        # sprites are drawn and render_delta is the time since the last
+        # drawn frame.
+        self.step_accumulator = NOTHING
+        self.render_alpha = NOTHING
+        self.render_delta = SIMULATION_STEP
+        self.interpolated_positions = []
+
+        # Input recording variables
+        # step_count is the number of steps run since the game started
+        # (setting up a level during a level change counts as one),
+        # recording is the InputRecording the keys pressed are saved
+        # to and replay is the one being played back. (Or None)
+        self.step_count = NOTHING
+        self.recording = None
+        self.replay = None
+
         # Tilemap object
         self.tile_map = None
 
@@ -1481,12 +4728,55 @@ class GameView(arcade.View):
         # Player sprite variable
         self.player_sprite = None
 
-        # Physics engine
+        # Physics engine and the collision layers it uses as walls
         self.physics_engine = None
+        self.walls = None
+
+        # Index of the cave tiles which are revealed near the player
+        self.cave_reveal = None
+
+        # Index of the things the player can interact with, and the
+        # villagers near the player last step and this step.
+        self.interactables = None
+        self.nearby_villagers = []
+        self.active_villagers = []
+
+        # Shader which reveals the cave around the player
+        # Without OpenGL (the headless window) or if the shader can't
+        # be compiled, the opacity of the cave tiles is changed instead.
+        self.cave_fog = None
+        if self.window.ctx is not None:
+            try:
+                self.cave_fog = CaveFog(
+                    self.window.ctx, (self.window.width, self.window.height)
+                    )
+            except arcade.gl.ShaderException as error:
+                print(f"The cave fog shader couldn't be used: {error}")
 
         # Camera for GUI elements (Secondary camera)
         self.gui_camera = None
 
+        # Energy and health bars
+        self.hud = HUD(self.energy, self.health)
+
+        # Labels for all of the text drawn on the screen
+        self.text_manager = TextManager()
+
+        # The parts of the game logic run every step, and which of them
+        # run in the current level.
+        self.systems = SystemScheduler()
+        self.add_systems()
+
+        # Times the parts of each frame while the profiler is shown,
+        # and records the timeline of the game when it's being traced.
+        self.profiler = FrameProfiler()
+        self.tracer = None
+
+        # What the player is touching each step, and the functions
+        # which handle touching each kind of sprite.
+        self.collisions = CollisionPhase()
+        self.add_collision_handlers()
+
         # Level setup
         # Starts with the first main level.
         self.level = "1.1"
@@ -1495,7 +4785,8 @@ class GameView(arcade.View):
         self.camera = None
 
         # Play background music
-        arcade.play_sound(self.bg_music, MUSIC_VOLUME, looping=True)
+        if music:
+            arcade.play_sound(self.bg_music, MUSIC_VOLUME, looping=True)
 
     def setup(self):
         """
@@ -1503,7 +4794,10 @@ class GameView(arcade.View):
         When this runs all variables are reset except for the music,
         and inventories, which include quest, rewards, secrets,
         and keys.
+        Levels the player has been to recently are taken from the
+        level cache rather than built again.
         """
+        setup_start = time.perf_counter()
 
         # Setup camera
         self.camera = arcade.Camera(self.window.width, self.window.height)
@@ -1515,12 +4809,7 @@ class GameView(arcade.View):
         map_name = f"{MAIN_PATH}/maps/{self.level}.tmx"
 
         # Update control variables
-        self.map_has_villagers = False
-        self.map_has_orbs = False
-        self.map_has_enemies = False
-        self.map_has_locked_doors = False
         self.available_layers = []
-        self.text_layer = None
 
         # Update quest variables 
         # (This is done when switching between sublevels)
@@ -1533,48 +4822,29 @@ class GameView(arcade.View):
         # Reset player sprite
         self.player_sprite = None
 
-        # Layer specific options for Tilemap
-        # These determine whether a tile layer acts as a wall or not.
-        layer_options = {
-            LAYER_NAME_PLATFORMS: {
-                "use_spatial_hash": True,
-            },
-            LAYER_NAME_STATUES: {
-                "use_spatial_hash": True,
-            },
-            LAYER_NAME_LADDERS: {
-                "use_spatial_hash": False,
-            },
-            LAYER_NAME_MOVING_PLATFORMS: {
-                "use_spatial_hash": False,
-            },
-            LAYER_NAME_DEATH: {
-                "use_spatial_hash": True,
-            },
-            LAYER_NAME_DOOR_BARRIERS_OPEN: {
-                "use_spatial_hash": False
-            },
-            LAYER_NAME_DOOR_BARRIERS_CLOSED: {
-                "use_spatial_hash": True
-            },
-            LAYER_NAME_COLLECTIBLES: {
-                "use_spatial_hash": True
-            },
-            LAYER_NAME_WARP_DOORS: {
-                "use_spatial_hash": True
-            },
-            LAYER_NAME_LOCKED_DOORS: {
-                "use_spatial_hash": True
-            },
-        }
-
-        # Read in Tiled map
-        self.tile_map = arcade.load_tilemap(
-            map_name, TILE_SCALING, layer_options
-            )
-        
-        # Initialise new scene with the tilemap
-        self.scene = arcade.Scene.from_tilemap(self.tile_map)
+        # Use the level from the level cache if the player has been
+        # there recently, so everything is how the player left it.
+        # Otherwise build the level from the tilemap and cache it.
+        level_state = self.level_cache.get(self.level)
+        if level_state is None:
+            level_state = self.build_level(map_name)
+            self.level_cache.put(self.level, level_state)
+        self.tile_map = level_state.tile_map
+        self.scene = level_state.scene
+        self.doors = level_state.doors
+        self.walls = level_state.walls
+        self.text_layer = level_state.text_layer
+        self.cave_reveal = level_state.cave_reveal
+        self.interactables = level_state.interactables
+        self.map_has_villagers = level_state.layer_flags["villagers"]
+        self.map_has_orbs = level_state.layer_flags["orbs"]
+        self.map_has_enemies = level_state.layer_flags["enemies"]
+        self.map_has_locked_doors = level_state.layer_flags["locked_doors"]
+
+        # Remove the player sprite left in the level from the last
+        # time the player was there.
+        for old_player in list(self.scene[LAYER_NAME_PLAYER]):
+            old_player.remove_from_sprite_lists()
 
         # Setup player at specific coordinates
         self.player_sprite = PlayerCharacter(self.shape)
@@ -1597,32 +4867,101 @@ class GameView(arcade.View):
             arcade.set_background_color(BLACK)
 
         # Create the physics engine
+        self.physics_engine = GridPhysicsEngine(
+            self.player_sprite,
+            platforms=self.scene[LAYER_NAME_MOVING_PLATFORMS],
+            gravity_constant=GRAVITY,
+            ladders=self.tile_map.collision_grids[LAYER_NAME_LADDERS],
+            walls=self.walls,
+        )
+
+        # If these layers exist on the tilemap add them into the
+        # "available_layers" list, which will be added into the
+        # physics engine update function later.
+        if self.map_has_villagers:
+            self.available_layers.append(LAYER_NAME_VILLAGERS)
+        if self.map_has_orbs:
+            self.available_layers.append(LAYER_NAME_ORBS)
+        if self.map_has_enemies:
+            self.available_layers.append(LAYER_NAME_ENEMIES)
+        if self.map_has_locked_doors:
+            self.available_layers.append(LAYER_NAME_LOCKED_DOORS)
+
+        # Start loading the levels the player can go to from here.
+        self.prefetcher.prefetch(self.tile_map, skip=self.level_cache.levels)
+
+        # Only run the game systems for the layers this level has.
+        self.systems.enable(self.scene)
+
+        # Every villager is checked in the first step, in case any of
+        # them were left interactable when the player was last here.
+        if LAYER_NAME_VILLAGERS in self.scene.name_mapping:
+            self.nearby_villagers = list(self.scene[LAYER_NAME_VILLAGERS])
+        else:
+            self.nearby_villagers = []
+
+        # (The phases of building the level are traced inside this)
+        self.trace_phase(f"setup {self.level}", setup_start)
+
+    def build_level(self, map_name):
+        """
+        Builds a level from its tilemap. This creates the scene with
+        every tile, NPC and object in it, the warp door information
+        and the walls for the physics engine, and returns them as a
+        LevelState so the level can be cached.
+        Each part of building the level is traced separately.
+        """
+        phase_start = time.perf_counter()
+
+        # Update control variables
+        self.map_has_villagers = False
+        self.map_has_orbs = False
+        self.map_has_enemies = False
+        self.map_has_locked_doors = False
+        self.text_layer = None
+
+        # Read in Tiled map
+        # This uses the level loaded in the background if there is one,
+        # otherwise it uses the compiled copy of the map when there is
+        # one.
+        self.tile_map = self.prefetcher.take(self.level)
+        if self.tile_map is None:
+            self.tile_map = load_level(map_name, TILE_SCALING, LAYER_OPTIONS)
+        phase_start = self.trace_phase("tilemap parse", phase_start)
+        
+        # Initialise new scene with the tilemap
+        # The player layer is added straight away so that it is drawn
+        # behind the NPCs and objects added below.
+        self.scene = arcade.Scene.from_tilemap(self.tile_map)
+        self.scene.add_sprite_list(LAYER_NAME_PLAYER)
+
+        # Find the walls for the physics engine
+        # These are the collision grids of the layers rather than the
+        # tiles themselves.
         # The try except is used to check if the "Door Barriers Closed"
         # layer is present in the tilemap.
         # If an error occurs that means the layer is not present and
-        # the except block runs, which contains all of the base layers.
+        # the except block runs, which only has the platforms.
         try:
-            self.physics_engine = arcade.PhysicsEnginePlatformer(
-                self.player_sprite,
-                platforms=self.scene[LAYER_NAME_MOVING_PLATFORMS],
-                gravity_constant=GRAVITY,
-                ladders=self.scene[LAYER_NAME_LADDERS],
-                walls=[
-                    self.scene[LAYER_NAME_PLATFORMS], 
-                    self.scene[LAYER_NAME_DOOR_BARRIERS_CLOSED]
-                    ],
-            )
+            walls = [
+                self.tile_map.collision_grids[LAYER_NAME_PLATFORMS], 
+                self.tile_map.collision_grids[LAYER_NAME_DOOR_BARRIERS_CLOSED]
+                ]
         except:
-            self.physics_engine = arcade.PhysicsEnginePlatformer(
-                self.player_sprite,
-                platforms=self.scene[LAYER_NAME_MOVING_PLATFORMS],
-                gravity_constant=GRAVITY,
-                ladders=self.scene[LAYER_NAME_LADDERS],
-                walls=self.scene[LAYER_NAME_PLATFORMS],
-            )
+            walls = self.tile_map.collision_grids[LAYER_NAME_PLATFORMS]
 
-        # Make a scene for the GUI
-        self.gui_scene = arcade.Scene()
+        # Index the cave tiles so that only the ones near the player
+        # are checked when revealing the cave.
+        # If an error occurs there is no cave in the level.
+        try:
+            cave_reveal = CaveReveal(
+                self.scene[LAYER_NAME_CAVE],
+                CAVE_REVEAL_DIST*TILE_SCALING*self.tile_map.tile_width,
+                CAVE_TRNSPT_DIST*TILE_SCALING*self.tile_map.tile_width,
+                )
+        except:
+            cave_reveal = None
+        phase_start = self.trace_phase("scene build", phase_start)
 
         # Add in NPCs
         # Add in villagers
@@ -1631,9 +4970,7 @@ class GameView(arcade.View):
         try:
             villagers_layer = self.tile_map.object_lists[LAYER_NAME_VILLAGERS]
             for villager_object in villagers_layer:
-                cartesian = self.tile_map.get_cartesian(
-                    villager_object.shape[X_POS], villager_object.shape[Y_POS]
-                )
+                cartesian = villager_object.cartesian
                 # The villager variant used is found by adding 1 to the
                 # last digit of the villager id. This is passed on as
                 # an argument into the villager constructor.
@@ -1662,16 +4999,14 @@ class GameView(arcade.View):
                 self.scene.add_sprite(LAYER_NAME_VILLAGERS, villager)
         except:
             self.map_has_villagers = False
-            
+        phase_start = self.trace_phase("villagers", phase_start)
 
         # Try to add in Enemies
         try:
             enemies_layer = self.tile_map.object_lists[LAYER_NAME_ENEMIES]
 
             for enemy_object in enemies_layer:
-                cartesian = self.tile_map.get_cartesian(
-                    enemy_object.shape[X_POS], enemy_object.shape[Y_POS]
-                )
+                cartesian = enemy_object.cartesian
 
                 # The enemy type is determined by the custom property
                 # "type" from the tilemap.
@@ -1717,7 +5052,8 @@ class GameView(arcade.View):
             # If error occurs tilemap does not have enemy layer
             # and control variable is updated to reflect this.
             self.map_has_enemies = False
-            
+        phase_start = self.trace_phase("enemies", phase_start)
+
 
         # Add inanimate objects
         # Try to add in end portal/s
@@ -1728,9 +5064,7 @@ class GameView(arcade.View):
         try:
             goal_layer = self.tile_map.object_lists[LAYER_NAME_GOAL]
             for goal_object in goal_layer:
-                cartesian = self.tile_map.get_cartesian(
-                    goal_object.shape[X_POS], goal_object.shape[Y_POS]
-                )
+                cartesian = goal_object.cartesian
                 goal = GoalPortal()
                 goal.center_x = math.floor(
                     (cartesian[X_POS]+HALF_BLOCK) 
@@ -1757,16 +5091,16 @@ class GameView(arcade.View):
                 self.scene.add_sprite(LAYER_NAME_GOAL, goal)
         except:
             pass
+        phase_start = self.trace_phase("goal portals", phase_start)
                 
         
+
         # Try to add in energy orbs
         # Once again same logic with the try-except.
         try:
             orbs_layer = self.tile_map.object_lists[LAYER_NAME_ORBS]
             for orb_object in orbs_layer:
-                cartesian = self.tile_map.get_cartesian(
-                    orb_object.shape[X_POS], orb_object.shape[Y_POS]
-                )
+                cartesian = orb_object.cartesian
                 orb = Orb()
                 orb.center_x = math.floor(
                     (cartesian[X_POS]+HALF_BLOCK) 
@@ -1787,6 +5121,7 @@ class GameView(arcade.View):
                 self.scene.add_sprite(LAYER_NAME_ORBS, orb)
         except:
             self.map_has_orbs = False
+        phase_start = self.trace_phase("orbs", phase_start)
 
         # Try to add in collectibles which include quests and secrets
         # Try-except system works the same, though collectibles don't
@@ -1796,10 +5131,7 @@ class GameView(arcade.View):
                 LAYER_NAME_COLLECTIBLES
                 ]
             for collectible_object in collectible_layer:
-                cartesian = self.tile_map.get_cartesian(
-                    collectible_object.shape[X_POS], 
-                    collectible_object.shape[Y_POS]
-                )
+                cartesian = collectible_object.cartesian
                 collectible_type = collectible_object.properties["type"]
 
                 # Load in the various collectible sprites based on the
@@ -1860,16 +5192,17 @@ class GameView(arcade.View):
             self.text_layer = self.tile_map.object_lists[LAYER_NAME_TEXT]
         except:
             pass
+        phase_start = self.trace_phase("collectibles", phase_start)
 
         # Add all warp doors positions into the a dictionary of door 
         # information, with the order of the doors added as the key.
         # "key_req" checks if the door needs a key to use.
-        door_layer = self.tile_map.object_lists[LAYER_NAME_WARP_DOORS]
+        # (Levels without a warp door layer just have no doors)
+        self.doors = {}
+        door_layer = self.tile_map.object_lists.get(LAYER_NAME_WARP_DOORS, [])
         count = NOTHING
         for door in door_layer:
-            cartesian = self.tile_map.get_cartesian(
-                door.shape[X_POS], door.shape[Y_POS]
-            )
+            cartesian = door.cartesian
             warp = door.properties["warp"]
             dest = [door.properties["dest_x"], door.properties["dest_y"]]
             key = door.properties["key_req"]
@@ -1894,10 +5227,7 @@ class GameView(arcade.View):
                 LAYER_NAME_LOCKED_DOORS
                 ]
             for locked_door_object in locked_door_layer:
-                cartesian = self.tile_map.get_cartesian(
-                    locked_door_object.shape[X_POS], 
-                    locked_door_object.shape[Y_POS]
-                )
+                cartesian = locked_door_object.cartesian
                 locked_door = LockedDoor()
                 locked_door.center_x = math.floor(
                     (cartesian[X_POS]+HALF_BLOCK) 
@@ -1916,102 +5246,115 @@ class GameView(arcade.View):
                 self.scene.add_sprite(LAYER_NAME_LOCKED_DOORS, locked_door)
         except:
             self.map_has_locked_doors = False
+        phase_start = self.trace_phase("doors", phase_start)
 
-        # Setup GUI Layers
-
-        # Setup energy bar
-        # This is an image in the top right of the screen,
-        # which changes depending on the amount of energy possessed.
-        # The default quantity is 0, so the default texture is also
-        # 0.png.
-        self.gui_scene.add_sprite(
-            LAYER_NAME_ENERGY,
-            arcade.Sprite(
-                texture=arcade.load_texture(
-            f"{MAIN_PATH}/assets/GUI/Energy/0.png"
-            ), 
-                scale=TILE_SCALING,
-                center_x=SCREEN_WIDTH-TILE_SCALING*ENERGY_BAR_OFFSET[X_POS],
-                center_y=SCREEN_HEIGHT-TILE_SCALING*ENERGY_BAR_OFFSET[Y_POS],
-                )
-            )
-
-        # Setup health bar
-        # This works the same as the energy bar, except the default is
-        # 3 rather than 0.
-        self.gui_scene.add_sprite(
-            LAYER_NAME_HEALTH,
-            arcade.Sprite(
-                texture=arcade.load_texture(
-            f"{MAIN_PATH}/assets/GUI/Health/3.png"
-            ),
-                scale=TILE_SCALING,
-                center_x=SCREEN_WIDTH-TILE_SCALING*HEALTH_BAR_OFFSET[X_POS],
-                center_y=SCREEN_HEIGHT-TILE_SCALING*HEALTH_BAR_OFFSET[Y_POS],
+        # Give the object layers which are too big to check collisions
+        # with one sprite at a time a spatial hash.
+        for layer_name in LARGE_OBJECT_LAYERS:
+            if (
+                layer_name in self.scene.name_mapping
+                and len(self.scene[layer_name]) > LARGE_LAYER_SPRITES
+                and self.scene[layer_name].spatial_hash is None
+                ):
+                self.scene[layer_name].enable_spatial_hashing()
+
+        # Index the warp doors, villagers, statues and goal portals so
+        # that only the ones near the player are checked for
+        # interactions. (The current statue is indexed with the other
+        # statues, as statues move between the two layers)
+        interactables = InteractableIndex(
+            INTERACTION_CELL_SIZE*TILE_SCALING*self.tile_map.tile_width
             )
+        for id, info in self.doors.items():
+            interactables.add(LAYER_NAME_WARP_DOORS, id, info["pos"])
+        for layer_name, kind in [
+            (LAYER_NAME_VILLAGERS, LAYER_NAME_VILLAGERS),
+            (LAYER_NAME_STATUES, LAYER_NAME_STATUES),
+            (LAYER_NAME_SPAWNPOINT, LAYER_NAME_STATUES),
+            (LAYER_NAME_GOAL, LAYER_NAME_GOAL),
+            ]:
+            if layer_name in self.scene.name_mapping:
+                interactables.add_sprites(kind, self.scene[layer_name])
+        self.trace_phase("indexes", phase_start)
+
+        return LevelState(
+            self.tile_map,
+            self.scene,
+            self.doors,
+            walls,
+            self.text_layer,
+            {
+                "villagers": self.map_has_villagers,
+                "orbs": self.map_has_orbs,
+                "enemies": self.map_has_enemies,
+                "locked_doors": self.map_has_locked_doors,
+            },
+            cave_reveal,
+            interactables,
         )
 
-        # If these layers exist on the tilemap add them into the
-        # "available_layers" list, which will be added into the
-        # physics engine update function later.
-        if self.map_has_villagers:
-            self.available_layers.append(LAYER_NAME_VILLAGERS)
-        if self.map_has_orbs:
-            self.available_layers.append(LAYER_NAME_ORBS)
-        if self.map_has_enemies:
-            self.available_layers.append(LAYER_NAME_ENEMIES)
-        if self.map_has_locked_doors:
-            self.available_layers.append(LAYER_NAME_LOCKED_DOORS)
-        
-
     def on_show_view(self):
         """
         Runs when the window first appears. 
-        (Sets up the first level)
+        (Sets up the first level, and goes back to the full frame rate
+        after the menus)
         """
+        set_frame_rate(RENDER_RATE)
         self.setup()
 
+    def on_hide_view(self):
+        """
+        Runs when another view (the end screen) replaces the game.
+        A game view isn't shown again, so its loading thread is stopped.
+        """
+        self.prefetcher.close()
+
     def on_draw(self):
         """Render the screen"""
 
         # Clear screen contents (only background remains)
         self.clear()
 
+        # Move the moving sprites part of the way between their last two
+        # positions, then move the camera towards the (drawn) player.
+        self.interpolate_sprites()
+        self.center_camera_to_player(self.get_camera_speed())
+
         # Activate game camera
         self.camera.use()
         
         # Draw the scene 
         # (the pixelated property makes the lines sharper).
-        self.scene.draw(pixelated=True)
+        with self.measure("scene draw", "draw"):
+            self.draw_scene()
+
+        # The map text and popups are timed together by the profiler.
+        text_start = time.perf_counter()
 
         # Actually draw the floating text from the layer.
         # If the text colour property is 1 make the text white,
         # otherwise if it is 0 make it black. This is done to increase
         # contrast and thus readability against the background.
-        # The try-except works similarly to before where if the layer
-        # exists then there are no issues and the code runs normally.
-        # If the layer doesn't exist then there will be errors and thus
-        # this block of code can be ignored.
-        try:
+        # (Levels without a text layer have no text_layer)
+        if self.text_layer is not None:
             for text in self.text_layer:
-                cartesian = self.tile_map.get_cartesian(
-                    text.shape[X_POS], text.shape[Y_POS]
-                )
+                cartesian = text.cartesian
                 if text.properties["colour"] == "1":
                     colour = WHITE
                 else:
                     colour = BLACK
-                arcade.draw_text(
+                x = cartesian[X_POS]*TILE_SCALING*self.tile_map.tile_width
+                y = cartesian[Y_POS]*TILE_SCALING*self.tile_map.tile_height
+                self.text_manager.show(
+                    TEXT_BATCH_MAP,
+                    (text.properties["text"], colour, x, y),
                     text.properties["text"],
-                    cartesian[X_POS]*TILE_SCALING*self.tile_map.tile_width,
-                    cartesian[Y_POS]*TILE_SCALING*self.tile_map.tile_height,
+                    x,
+                    y,
                     colour,
                     TIPS_FONT,
-                    anchor_x="center",
-                    anchor_y="center"
                 )
-        except:
-            pass
+        self.text_manager.draw(TEXT_BATCH_MAP)
 
         # Start quest dialogue
         # If there is an available quest that the player is in,
@@ -2019,34 +5362,30 @@ class GameView(arcade.View):
         # To increase readability also draw a matching white rectangle
         # behind the black text.
         # This will be drawn as long as the timer for that specific
-        # quest dialogue is above 0.
-        if self.in_quest:
-            try:
-                if self.latest_quest["dialogue_time"] > NOTHING:
-                    arcade.draw_rectangle_filled(
-                        self.latest_quest["villager_pos"][X_POS],
-                        (self.latest_quest["villager_pos"][Y_POS]
-                         +(ONE_BLOCK+HALF_BLOCK)
-                         *TILE_SCALING*self.tile_map.tile_width),
-                        len(self.start_dialogue)*CHAR_WIDTH+CHAR_WIDTH,
-                        RECT_HEIGHT,
-                        WHITE,
-                    )
-                    arcade.draw_text(
-                        self.start_dialogue,
-                        self.latest_quest["villager_pos"][X_POS],
-                        (self.latest_quest["villager_pos"][Y_POS]
-                         +(ONE_BLOCK+HALF_BLOCK)
-                         *TILE_SCALING*self.tile_map.tile_width),
-                        BLACK,
-                        DIALOGUE_FONT,
-                        anchor_x="center",
-                        anchor_y="center",
-                    )
-            except:
-                # If there's no available quest at the moment
-                # just ignore this block.
-                pass
+        # quest dialogue is above 0. (There is no latest quest until
+        # a quest has been started)
+        if self.in_quest and self.latest_quest is not None:
+            if self.latest_quest["dialogue_time"] > NOTHING:
+                arcade.draw_rectangle_filled(
+                    self.latest_quest["villager_pos"][X_POS],
+                    (self.latest_quest["villager_pos"][Y_POS]
+                     +(ONE_BLOCK+HALF_BLOCK)
+                     *TILE_SCALING*self.tile_map.tile_width),
+                    len(self.start_dialogue)*CHAR_WIDTH+CHAR_WIDTH,
+                    RECT_HEIGHT,
+                    WHITE,
+                )
+                self.text_manager.show(
+                    TEXT_BATCH_GAME,
+                    "start_dialogue",
+                    self.start_dialogue,
+                    self.latest_quest["villager_pos"][X_POS],
+                    (self.latest_quest["villager_pos"][Y_POS]
+                     +(ONE_BLOCK+HALF_BLOCK)
+                     *TILE_SCALING*self.tile_map.tile_width),
+                    BLACK,
+                    DIALOGUE_FONT,
+                )
         
         # If quest not complete then draw this
         # The rectangle and text works the same as before.
@@ -2062,7 +5401,9 @@ class GameView(arcade.View):
                 RECT_HEIGHT,
                 WHITE
             )
-            arcade.draw_text(
+            self.text_manager.show(
+                TEXT_BATCH_GAME,
+                "Bruh you're not done yet",
                 "Bruh you're not done yet",
                 self.check_quest["villager_pos"][X_POS],
                 (self.check_quest["villager_pos"][Y_POS]
@@ -2070,8 +5411,6 @@ class GameView(arcade.View):
                  *TILE_SCALING*self.tile_map.tile_width),
                 BLACK,
                 DIALOGUE_FONT,
-                anchor_x="center",
-                anchor_y="center",
             )
 
         # If quest complete draw this
@@ -2091,7 +5430,9 @@ class GameView(arcade.View):
                     RECT_HEIGHT,
                     WHITE,
                 )
-                arcade.draw_text(
+                self.text_manager.show(
+                    TEXT_BATCH_GAME,
+                    "Thanks, here is your reward",
                     "Thanks, here is your reward",
                     self.finished_quest["villager_pos"][X_POS],
                     (self.finished_quest["villager_pos"][Y_POS]
@@ -2099,8 +5440,6 @@ class GameView(arcade.View):
                      *TILE_SCALING*self.tile_map.tile_width),
                     BLACK,
                     DIALOGUE_FONT,
-                    anchor_x="center",
-                    anchor_y="center",
                 )
 
         # If key missing draw this text above the player sprite.
@@ -2114,7 +5453,9 @@ class GameView(arcade.View):
                 RECT_HEIGHT,
                 WHITE,
             )
-            arcade.draw_text(
+            self.text_manager.show(
+                TEXT_BATCH_GAME,
+                "Missing key",
                 "Missing key",
                 self.player_sprite.center_x,
                 (self.player_sprite.center_y
@@ -2122,8 +5463,6 @@ class GameView(arcade.View):
                  *TILE_SCALING*self.tile_map.tile_height),
                 BLACK,
                 DIALOGUE_FONT,
-                anchor_x = "center",
-                anchor_y="center"
             )
 
         # If secret found then draw this above the player sprite.
@@ -2137,7 +5476,9 @@ class GameView(arcade.View):
                 RECT_HEIGHT,
                 WHITE,
             )
-            arcade.draw_text(
+            self.text_manager.show(
+                TEXT_BATCH_GAME,
+                "Secret Found",
                 "Secret Found",
                 self.player_sprite.center_x,
                 (self.player_sprite.center_y
@@ -2145,8 +5486,6 @@ class GameView(arcade.View):
                  *TILE_SCALING*self.tile_map.tile_height),
                 BLACK,
                 DIALOGUE_FONT,
-                anchor_x = "center",
-                anchor_y="center"
             )
 
         # If the player interacts with a statue
@@ -2161,7 +5500,9 @@ class GameView(arcade.View):
                 RECT_HEIGHT,
                 WHITE,
             )
-            arcade.draw_text(
+            self.text_manager.show(
+                TEXT_BATCH_GAME,
+                "New Spawnpoint Set",
                 "New Spawnpoint Set",
                 self.player_sprite.center_x,
                 (self.player_sprite.center_y
@@ -2169,17 +5510,23 @@ class GameView(arcade.View):
                  *TILE_SCALING*self.tile_map.tile_height),
                 BLACK,
                 DIALOGUE_FONT,
-                anchor_x = "center",
-                anchor_y="center"
             )
 
+        # Draw all of the popup text on top of its background.
+        self.text_manager.draw(TEXT_BATCH_GAME)
+        self.record_time("text draw", text_start, time.perf_counter(), "draw")
+
+        # Put the moving sprites back where the game logic left them.
+        self.restore_sprites()
+
         # Activate the GUI camera to draw GUI elements
         self.gui_camera.use()
+        gui_start = time.perf_counter()
 
         # Draw GUI content
 
         # Display current energy and health
-        self.gui_scene.draw(pixelated=True)
+        self.hud.draw()
 
         # If interact is possible then draw this text
         # This text is drawn in the bottom right of the screen.
@@ -2193,14 +5540,14 @@ class GameView(arcade.View):
                 RECT_HEIGHT,
                 BLACK,
             )
-            arcade.draw_text(
+            self.text_manager.show(
+                TEXT_BATCH_GUI,
+                "Press 'f' to interact",
                 "Press 'f' to interact",
                 SCREEN_WIDTH*INTERACT_TEXT_POS,
                 INTERACT_Y_OFFSET,
                 WHITE,
                 INTERACT_FONT,
-                anchor_x="center",
-                anchor_y="center"
             )
         
         # If in quest then draw the current quest progress.
@@ -2220,7 +5567,9 @@ class GameView(arcade.View):
                     QUEST_RECT_HEIGHT,
                     WHITE
                 )
-                arcade.draw_text(
+                self.text_manager.show(
+                    TEXT_BATCH_GUI,
+                    id,
                     (f"{info['quest_item']}: "
                     +f"{self.inventory_quest[id]['number']}/"
                     +f"{info['num_needed']}"),
@@ -2229,11 +5578,171 @@ class GameView(arcade.View):
                      *TILE_SCALING),
                     BLACK,
                     QUEST_FONT,
-                    anchor_x="center",
-                    anchor_y="center"
                 )
                 count += UNIT_INCREMENT
-        
+
+        # Draw all of the GUI text on top of its background.
+        self.text_manager.draw(TEXT_BATCH_GUI)
+        self.record_time("gui draw", gui_start, time.perf_counter(), "draw")
+
+        # Fade the screen to black while changing levels, with a
+        # progress bar while the next level is loading.
+        if self.transition is not None:
+            arcade.draw_rectangle_filled(
+                SCREEN_WIDTH*HALF_BLOCK,
+                SCREEN_HEIGHT*HALF_BLOCK,
+                SCREEN_WIDTH,
+                SCREEN_HEIGHT,
+                BLACK + (self.transition.get_alpha(),),
+            )
+            if self.transition.phase == TRANSITION_LOADING:
+                arcade.draw_lrtb_rectangle_filled(
+                    (SCREEN_WIDTH-LOADING_BAR_SIZE[X_POS])*HALF_BLOCK,
+                    (SCREEN_WIDTH-LOADING_BAR_SIZE[X_POS])*HALF_BLOCK
+                    + LOADING_BAR_SIZE[X_POS]*self.transition.progress,
+                    LOADING_BAR_Y_OFFSET+LOADING_BAR_SIZE[Y_POS],
+                    LOADING_BAR_Y_OFFSET,
+                    WHITE,
+                )
+
+        # Draw the frame profiler on top of everything.
+        if self.profiler.enabled:
+            self.profiler.draw(self.text_manager)
+
+    def preload_end_screen(self):
+        """
+        Starts loading the end screen image for the secrets found so
+        far on the background loading thread. (Unless the game is over
+        and the thread has been stopped)
+        """
+        if self.prefetcher.closed:
+            return
+        self.end_screen_preload = self.prefetcher.executor.submit(
+            TEXTURE_REGISTRY.get_image,
+            end_screen_image(self.secrets_found),
+            )
+
+    def refresh_collision(self, layer_name, added=(), removed=()):
+        """
+        Updates the collision grid of a layer after tiles have been
+        added to or removed from it (e.g. a door being unlocked). Only
+        the grid squares of those tiles are changed, in place so the
+        physics engine picks up the change.
+        """
+        if layer_name not in self.tile_map.collision_grids:
+            return
+        collision_grid = self.tile_map.collision_grids[layer_name]
+        for sprite in removed:
+            collision_grid.remove(sprite)
+        for sprite in added:
+            collision_grid.add(sprite)
+
+    def draw_scene(self):
+        """
+        Draws every layer of the scene in order. Layers which have been
+        split into chunks only draw the chunks the camera can see, and
+        the number of chunks drawn and skipped is counted.
+        """
+        left = self.camera.position[X_POS]
+        bottom = self.camera.position[Y_POS]
+        right = left + self.camera.viewport_width*self.camera.scale
+        top = bottom + self.camera.viewport_height*self.camera.scale
+        view = (left, bottom, right, top)
+        self.chunks_drawn = NOTHING
+        self.chunks_culled = NOTHING
+        for layer_name, sprite_list in self.scene.name_mapping.items():
+            # The cave is drawn offscreen and then through the fog.
+            if (
+                layer_name == LAYER_NAME_CAVE
+                and self.cave_fog is not None
+                and self.cave_reveal is not None
+                ):
+                with self.cave_fog.capture():
+                    self.draw_layer(layer_name, sprite_list, view)
+                self.cave_fog.draw(
+                    self.cave_reveal,
+                    self.player_sprite.position,
+                    view,
+                    (self.tile_map.width, self.tile_map.height),
+                    (
+                        self.tile_map.tile_width * TILE_SCALING,
+                        self.tile_map.tile_height * TILE_SCALING,
+                    ),
+                    )
+            else:
+                self.draw_layer(layer_name, sprite_list, view)
+
+    def draw_layer(self, layer_name, sprite_list, view):
+        """
+        Draws one layer of the scene, only drawing the chunks inside
+        the view (left, bottom, right, top) if it has been split into
+        chunks.
+        """
+        chunked_layer = self.tile_map.chunked_layers.get(layer_name)
+        if chunked_layer is None:
+            sprite_list.draw(pixelated=True)
+        else:
+            drawn, culled = chunked_layer.draw(*view, pixelated=True)
+            self.chunks_drawn += drawn
+            self.chunks_culled += culled
+
+    def start_transition(self, level, spawnpoint):
+        """
+        Starts moving the player to another level. The level starts
+        loading in the background straight away, while the screen fades
+        out. (Levels in the level cache don't need loading)
+        """
+        self.transition = LevelTransition(level, spawnpoint)
+        if str(level) not in self.level_cache.levels:
+            self.prefetcher.request(level)
+
+    def update_transition(self, delta_time):
+        """
+        Moves the current level transition through its phases.
+        Once the screen has faded out and the level has loaded the
+        level is setup, then the screen fades back in.
+        Returns whether the game should stay paused this frame.
+        """
+        transition = self.transition
+        transition.phase_time += delta_time
+
+        # Wait for the screen to go black.
+        if transition.phase == TRANSITION_FADE_OUT:
+            if transition.phase_time >= TRANSITION_FADE_TIME:
+                self.next_transition_phase(TRANSITION_LOADING)
+            return True
+
+        # Wait for the level to load in the background, then set it up.
+        # (This is where the sprites get their OpenGL resources, which
+        # has to happen on this thread)
+        if transition.phase == TRANSITION_LOADING:
+            transition.progress = self.prefetcher.get_progress(
+                transition.level
+                )
+            if not self.prefetcher.is_ready(transition.level):
+                return True
+            setup_start = time.perf_counter()
+            self.level = transition.level
+            self.spawnpoint = transition.spawnpoint
+            self.setup()
+            self.center_camera_to_player(ONE_BLOCK)
+            self.camera.update()
+            self.step_accumulator = NOTHING
+            # Setting up the new level counts as a step, so keys
+            # recorded before it and keys recorded after it (while the
+            # screen fades back in) are played back in the right level.
+            self.step_count += UNIT_INCREMENT
+            transition.timings["setup"] = time.perf_counter() - setup_start
+            self.next_transition_phase(TRANSITION_FADE_IN)
+            return True
+
+        # The game carries on while the screen fades back in.
+        if transition.phase_time >= TRANSITION_FADE_TIME:
+            self.next_transition_phase(None)
+            self.transition_timings = transition.timings
+            self.transition = None
+        return False
+
     def process_keychange(self):
         """
         Called when we change a key up/down or we move on/off a ladder.
@@ -2245,7 +5754,7 @@ class GameView(arcade.View):
         # It has no jumping mechanic, while the human and dog shapes
         # do.
         if self.up_pressed and not self.down_pressed:
-            if self.physics_engine.is_on_ladder():
+            if self.collisions.is_on_ladder(self.physics_engine):
                 self.player_sprite.change_y = PLAYER_WALK_SPEED
             elif self.shape == PLAYER_SHAPE_BLAZE:
                 self.fly_speed += (self.thrust - GRAVITY)*self.delta_time
@@ -2253,13 +5762,15 @@ class GameView(arcade.View):
                 # If the player is a certain distance above the ground
                 # it can jump again.
                 if (
-                    self.physics_engine.can_jump(y_distance=GROUND_DISTANCE)
+                    self.collisions.can_jump(
+                        self.physics_engine, y_distance=GROUND_DISTANCE
+                        )
                     and not self.jump_needs_reset
                 ):
                     self.player_sprite.change_y = PLAYER_JUMP_SPEED
                     self.jump_needs_reset = True
         elif self.down_pressed and not self.up_pressed:
-            if self.physics_engine.is_on_ladder():
+            if self.collisions.is_on_ladder(self.physics_engine):
                 self.player_sprite.change_y = -PLAYER_WALK_SPEED
             elif self.shape == PLAYER_SHAPE_BLAZE:
                 self.fly_speed -= (
@@ -2269,7 +5780,7 @@ class GameView(arcade.View):
 
         # Process up/down when on a ladder. If both keys pressed
         # at the same time there is no movement.
-        if self.physics_engine.is_on_ladder():
+        if self.collisions.is_on_ladder(self.physics_engine):
             if not self.up_pressed and not self.down_pressed:
                 self.player_sprite.change_y = STATIONARY
             elif self.up_pressed and self.down_pressed:
@@ -2287,7 +5798,91 @@ class GameView(arcade.View):
             self.player_sprite.change_x = STATIONARY
 
     def on_key_press(self, key, modifiers):
-        """Called whenever a key is pressed."""
+        """
+        Called whenever a key is pressed.
+        The key is saved if the game is being recorded, and ignored if
+        a recording is being played back.
+        """
+        # The profiler key isn't part of the game, so it works while
+        # a recording plays and isn't recorded.
+        if key == PROFILER_KEY:
+            self.toggle_profiler()
+            return
+        if self.replay is not None:
+            return
+        if self.recording is not None:
+            self.recording.record(self.step_count, True, key)
+        self.press_key(key)
+
+    def toggle_profiler(self):
+        """
+        Shows or hides the frame profiler, timing the game systems
+        only while it's shown.
+        """
+        self.profiler.toggle()
+        self.update_timing_hook()
+
+    def start_tracing(self, tracer):
+        """
+        Records the timeline of the game (including background level
+        loading) in a Tracer from now on.
+        """
+        self.tracer = tracer
+        self.prefetcher.tracer = tracer
+        self.update_timing_hook()
+
+    def update_timing_hook(self):
+        """
+        Sends the times of the game systems to the profiler and tracer,
+        or nowhere if neither of them is on.
+        """
+        if self.profiler.enabled or self.tracer is not None:
+            self.systems.timing_hook = self.record_time
+        else:
+            self.systems.timing_hook = None
+
+    def record_time(self, name, start, end, category="system"):
+        """
+        Gives the time a part of the frame took to the profiler and the
+        tracer (if they are on).
+        """
+        if self.profiler.enabled:
+            self.profiler.record(name, start, end)
+        if self.tracer is not None:
+            self.tracer.record(name, start, end, category)
+
+    @contextmanager
+    def measure(self, name, category="system"):
+        """Times the code inside the with block as a part of the frame."""
+        start = time.perf_counter()
+        yield
+        self.record_time(name, start, time.perf_counter(), category)
+
+    def trace_phase(self, name, start):
+        """
+        Records a span from start until now in the tracer (if there is
+        one), and returns the time now so the next span can start there.
+        """
+        now = time.perf_counter()
+        if self.tracer is not None:
+            self.tracer.record(name, start, now, "setup")
+        return now
+
+    def next_transition_phase(self, phase):
+        """Moves the level transition to its next phase, tracing it."""
+        transition = self.transition
+        name, start = transition.phase, transition.phase_start
+        transition.next_phase(phase)
+        if self.tracer is not None:
+            self.tracer.record(
+                f"{name} {transition.level}",
+                start,
+                transition.phase_start,
+                "transition",
+                )
+
+    def press_key(self, key):
+        """Changes the key states for a pressed key."""
 
         # If Up Arrow or W key pressed make self.up_pressed True.
         # If the player is in the blaze shape also make the flying
@@ -2338,27 +5933,14 @@ class GameView(arcade.View):
 
                 self.scene.add_sprite(LAYER_NAME_PLAYER, self.player_sprite)
                 # This is a repeat of the physics engine setup from 
-                # the setup() method. The try-except is used for
-                # the same reason.
-                try:
-                    self.physics_engine = arcade.PhysicsEnginePlatformer(
-                        self.player_sprite,
-                        platforms=self.scene[LAYER_NAME_MOVING_PLATFORMS],
-                        gravity_constant=GRAVITY,
-                        ladders=self.scene[LAYER_NAME_LADDERS],
-                        walls=[
-                            self.scene[LAYER_NAME_PLATFORMS], 
-                            self.scene[LAYER_NAME_DOOR_BARRIERS_CLOSED]
-                            ],
-                    )
-                except:
-                    self.physics_engine = arcade.PhysicsEnginePlatformer(
-                        self.player_sprite,
-                        platforms=self.scene[LAYER_NAME_MOVING_PLATFORMS],
-                        gravity_constant=GRAVITY,
-                        ladders=self.scene[LAYER_NAME_LADDERS],
-                        walls=self.scene[LAYER_NAME_PLATFORMS],
-                    )
+                # the setup() method.
+                self.physics_engine = GridPhysicsEngine(
+                    self.player_sprite,
+                    platforms=self.scene[LAYER_NAME_MOVING_PLATFORMS],
+                    gravity_constant=GRAVITY,
+                    ladders=self.tile_map.collision_grids[LAYER_NAME_LADDERS],
+                    walls=self.walls,
+                )
 
             # If the '2' key is pressed and shape is not dog,
             # shapeshift into dog shape and consume 3 energy.
@@ -2375,23 +5957,12 @@ class GameView(arcade.View):
                 self.player_sprite.center_y = player_pos[Y_POS]
 
                 self.scene.add_sprite(LAYER_NAME_PLAYER, self.player_sprite)
-                try:
-                    self.physics_engine = arcade.PhysicsEnginePlatformer(
-                        self.player_sprite,
-                        platforms=self.scene[LAYER_NAME_MOVING_PLATFORMS],
-                        gravity_constant=GRAVITY,
-                        walls=[
-                            self.scene[LAYER_NAME_PLATFORMS], 
-                            self.scene[LAYER_NAME_DOOR_BARRIERS_CLOSED]
-                            ],
-                    )
-                except:
-                    self.physics_engine = arcade.PhysicsEnginePlatformer(
-                        self.player_sprite,
-                        platforms=self.scene[LAYER_NAME_MOVING_PLATFORMS],
-                        gravity_constant=GRAVITY,
-                        walls=self.scene[LAYER_NAME_PLATFORMS],
-                    )
+                self.physics_engine = GridPhysicsEngine(
+                    self.player_sprite,
+                    platforms=self.scene[LAYER_NAME_MOVING_PLATFORMS],
+                    gravity_constant=GRAVITY,
+                    walls=self.walls,
+                )
 
             # If the '3' key is pressed and shape is not blaze,
             # change into blaze shape and consume 3 energy.
@@ -2408,27 +5979,19 @@ class GameView(arcade.View):
                 self.player_sprite.center_y = player_pos[Y_POS]
 
                 self.scene.add_sprite(LAYER_NAME_PLAYER, self.player_sprite)
-                try:
-                    self.physics_engine = arcade.PhysicsEnginePlatformer(
-                        self.player_sprite,
-                        platforms=self.scene[LAYER_NAME_MOVING_PLATFORMS],
-                        gravity_constant=GRAVITY,
-                        walls=[
-                            self.scene[LAYER_NAME_PLATFORMS], 
-                            self.scene[LAYER_NAME_DOOR_BARRIERS_CLOSED]
-                            ],
-                    )
-                except:
-                    self.physics_engine = arcade.PhysicsEnginePlatformer(
-                        self.player_sprite,
-                        platforms=self.scene[LAYER_NAME_MOVING_PLATFORMS],
-                        gravity_constant=GRAVITY,
-                        walls=self.scene[LAYER_NAME_PLATFORMS],
-                    )
+                self.physics_engine = GridPhysicsEngine(
+                    self.player_sprite,
+                    platforms=self.scene[LAYER_NAME_MOVING_PLATFORMS],
+                    gravity_constant=GRAVITY,
+                    walls=self.walls,
+                )
 
         # If the 'R' key is pressed reset the level and 
         # respawn the player back to the start of the level.
+        # The level is removed from the level cache first so that it
+        # gets built again from the tilemap.
         if key == arcade.key.R:
+            self.level_cache.evict(self.level)
             self.setup()
             self.player_sprite.center_x = (
                 self.tile_map.tile_width 
@@ -2456,7 +6019,18 @@ class GameView(arcade.View):
         self.process_keychange()
 
     def on_key_release(self, key, modifiers):
-        """Called when the user releases a key."""
+        """
+        Called when the user releases a key.
+        (Recorded and ignored like key presses)
+        """
+        if key == PROFILER_KEY or self.replay is not None:
+            return
+        if self.recording is not None:
+            self.recording.record(self.step_count, False, key)
+        self.release_key(key)
+
+    def release_key(self, key):
+        """Changes the key states for a released key."""
 
         # Change movement states to False when keys are released.
         if key == arcade.key.UP or key == arcade.key.W:
@@ -2535,7 +6109,7 @@ class GameView(arcade.View):
         # When a quest is activated record all of the details,
         # including the villager who issued the quest, and
         # all of the items needed.
-        quest = QUEST_REF[villager.id]
+        quest = self.quest_engine.get(villager.id)
         self.start_dialogue = quest["dialogue"]
         self.quests[villager.id] = {
             "quest_id": villager.id,
@@ -2548,6 +6122,9 @@ class GameView(arcade.View):
         # Set the latest quest to the new quest.
         self.latest_quest = self.quests[villager.id].copy()
 
+        # Items picked up from now on go to this quest.
+        self.quest_engine.activate(villager.id)
+
     def check_quest_complete(self, villager):
         """
         Checks if the quest in progress has been completed.
@@ -2584,28 +6161,239 @@ class GameView(arcade.View):
         # reward is energy in which case if the energy bar is not
         # already full the energy will increase by 1.
         self.finished_quest = self.quests.pop(villager.id)
+        self.quest_engine.end(villager.id)
         self.finished_quest["dialogue_time"] = QUEST_COMPLETE_TIME
         self.quest_ended = True
         self.completed_quests.append(villager.id)
         self.inventory_quest[villager.id]["number"] -= (
             self.finished_quest["num_needed"]
             )
-        if QUEST_REF[villager.id]["reward_item"] != "Energy":
+        quest = self.quest_engine.get(villager.id)
+        if quest["reward_item"] != "Energy":
             self.inventory_other[villager.id]["number"] += (
-                QUEST_REF[villager.id]["reward_num"]
+                quest["reward_num"]
                 )
         else:
             if self.energy < MAX_ENERGY:
-                self.energy += QUEST_REF[villager.id]["reward_num"]
+                self.energy += quest["reward_num"]
 
     def on_update(self, delta_time):
+        """
+        Runs as many fixed length game steps as have built up since the
+        last frame, and works out how far between the last two steps
+        the moving sprites should be drawn.
+        """
+        self.render_delta = delta_time
+
+        # A new frame starts with every update.
+        self.profiler.end_frame()
+
+        # Keys being played back are pressed before anything else
+        # happens in the frame, so keys pressed while a level change
+        # has paused the game reach the same level they did when
+        # they were recorded.
+        if self.replay is not None:
+            self.replay.apply(self, self.step_count)
+
+        # While the screen is faded out for a level change the game
+        # is paused.
+        if self.transition is not None and self.update_transition(delta_time):
+            return
+
+        # Run the steps, stopping early if a level change starts.
+        # If too many steps have built up the extra time is dropped.
+        self.step_accumulator += delta_time
+        steps = NOTHING
+        while self.step_accumulator >= SIMULATION_STEP:
+            if steps == MAX_SIMULATION_STEPS:
+                self.step_accumulator %= SIMULATION_STEP
+                break
+            # Keys being played back are pressed just before the
+            # step they were pressed before, and the game stops once
+            # every recorded step has been played.
+            if self.replay is not None:
+                if self.replay.finished(self.step_count):
+                    break
+                self.replay.apply(self, self.step_count)
+            self.store_previous_positions()
+            self.fixed_update(SIMULATION_STEP)
+            self.step_accumulator -= SIMULATION_STEP
+            self.step_count += UNIT_INCREMENT
+            steps += UNIT_INCREMENT
+            if self.transition is not None:
+                break
+        self.render_alpha = self.step_accumulator / SIMULATION_STEP
+
+        # Close the window once a recording has finished playing.
+        if self.replay is not None and self.replay.finished(self.step_count):
+            self.window.close()
+
+    def store_previous_positions(self):
+        """
+        Records where the moving sprites are before a step, so they
+        can be drawn between this position and the next one.
+        """
+        for layer_name in INTERPOLATED_LAYERS:
+            if layer_name in self.scene.name_mapping:
+                for sprite in self.scene[layer_name]:
+                    sprite.previous_position = sprite.position
+
+    def interpolate_sprites(self):
+        """
+        Moves the moving sprites to where they would be part of the way
+        through the next step, remembering their real positions so they
+        can be put back after drawing. Sprites which have just been
+        added or have teleported are left where they are.
+        """
+        self.interpolated_positions = []
+        for layer_name in INTERPOLATED_LAYERS:
+            if layer_name not in self.scene.name_mapping:
+                continue
+            for sprite in self.scene[layer_name]:
+                previous = getattr(sprite, "previous_position", None)
+                if previous is None:
+                    continue
+                position = sprite.position
+                if (
+                    calculate_distance(previous, position)
+                    > INTERPOLATION_SNAP_DISTANCE
+                    ):
+                    continue
+                self.interpolated_positions.append((sprite, position))
+                sprite.position = (
+                    previous[X_POS]
+                    + (position[X_POS]-previous[X_POS])*self.render_alpha,
+                    previous[Y_POS]
+                    + (position[Y_POS]-previous[Y_POS])*self.render_alpha,
+                    )
+
+    def restore_sprites(self):
+        """Puts the interpolated sprites back at their real positions."""
+        for sprite, position in self.interpolated_positions:
+            sprite.position = position
+        self.interpolated_positions = []
+
+    def get_camera_speed(self):
+        """
+        The camera moves CAMERA_TRACK_SPEED of the way to the player
+        every step, so when frames are drawn faster or slower than the
+        steps the amount it moves each frame is adjusted to match.
+        """
+        return (
+            ONE_BLOCK
+            - (ONE_BLOCK-CAMERA_TRACK_SPEED)
+            ** (self.render_delta/SIMULATION_STEP)
+            )
+
+    def add_systems(self):
+        """
+        Adds every game system in the order they run each step, with
+        the layers each one needs. Systems whose layers aren't in a
+        level are skipped in that level.
+        """
+        self.systems.add("player", self.update_player)
+        self.systems.add("knife", self.update_knife)
+        self.systems.add("animations", self.update_animations)
+        self.systems.add("moving sprites", self.update_moving_sprites)
+        self.systems.add(
+            "villager proximity",
+            self.update_villagers,
+            layers=(LAYER_NAME_VILLAGERS,),
+            )
+        self.systems.add(
+            "enemy patrol",
+            self.update_enemy_patrol,
+            layers=(LAYER_NAME_ENEMIES,),
+            )
+        self.systems.add(
+            "villager interaction",
+            self.update_villager_interaction,
+            layers=(LAYER_NAME_VILLAGERS,),
+            )
+        self.systems.add(
+            "warp doors",
+            self.update_warp_doors,
+            condition=lambda: len(self.doors) > NOTHING,
+            )
+        self.systems.add(
+            "statues",
+            self.update_statues,
+            layers=(LAYER_NAME_STATUES, LAYER_NAME_SPAWNPOINT),
+            )
+        self.systems.add(
+            "orbs", self.update_orbs, layers=(LAYER_NAME_ORBS,)
+            )
+        self.systems.add(
+            "collectibles",
+            self.update_collectibles,
+            layers=(LAYER_NAME_COLLECTIBLES,),
+            )
+        self.systems.add(
+            "locked doors",
+            self.update_locked_doors,
+            layers=(
+                LAYER_NAME_LOCKED_DOORS,
+                LAYER_NAME_DOOR_BARRIERS_CLOSED,
+                LAYER_NAME_DOOR_BARRIERS_OPEN,
+                ),
+            )
+        self.systems.add(
+            "knife stab",
+            self.update_knife_stab,
+            layers=(LAYER_NAME_ENEMIES,),
+            )
+        self.systems.add(
+            "enemy contact",
+            self.update_enemy_contact,
+            layers=(LAYER_NAME_ENEMIES,),
+            )
+        self.systems.add("hud", self.update_hud)
+        # (When the cave fog shader is used it reveals the cave instead)
+        self.systems.add(
+            "cave",
+            self.update_cave,
+            condition=lambda: (
+                self.cave_reveal is not None and self.cave_fog is None
+                ),
+            )
+        self.systems.add("respawn", self.update_respawn)
+        self.systems.add(
+            "death tiles", self.update_death_tiles, layers=(LAYER_NAME_DEATH,)
+            )
+        self.systems.add("death", self.update_death)
+        self.systems.add("timers", self.update_timers)
+        self.systems.add(
+            "goal", self.update_goal, layers=(LAYER_NAME_GOAL,)
+            )
+
+    def add_collision_handlers(self):
+        """
+        Adds the functions which handle the player touching each kind
+        of sprite. (Collectibles are checked for keys and secrets before
+        quest items)
+        """
+        self.collisions.on(COLLECTIBLE_PICKED, self.pick_up_collectible)
+        self.collisions.on(COLLECTIBLE_PICKED, self.collect_quest_item)
+        self.collisions.on(ORB_PICKED, self.pick_up_orb)
+        self.collisions.on(DOOR_TOUCHED, self.touch_locked_door)
+        self.collisions.on(ENEMY_TOUCHED, self.touch_enemy)
+        self.collisions.on(GOAL_REACHED, self.reach_goal)
+
+    def fixed_update(self, delta_time):
         """
         Movement and game logic.
-        Advances the game every frame in terms of physics,
+        Advances the game by one fixed step in terms of physics,
         which includes detecting collisions, adding sprites to layers,
         removing sprites from layers,
         or calculating level changes.
+        Each part of this is a game system, and only the systems for
+        the layers the level has are run. (See add_systems)
         """
+        self.systems.run(delta_time)
+        self.collisions.end()
+
+    def update_player(self, delta_time):
+        """Moves the player and updates their animation states."""
 
         # Reset the interactable text
         self.can_interact = False
@@ -2617,6 +6405,15 @@ class GameView(arcade.View):
         # Move the player
         self.physics_engine.update()
 
+        # From here on what the player is touching is only checked once,
+        # unless something moves the player again. (See CollisionPhase)
+        self.collisions.begin(
+            self.player_sprite,
+            self.scene,
+            self.physics_engine,
+            self.interactables,
+            )
+
         # If blaze shape then do helicopter physics
         # This means accelerating the player vertically
         # and subjecting them to gravity when they're not flying.
@@ -2627,27 +6424,26 @@ class GameView(arcade.View):
             if not self.is_flying:
                 self.fly_speed -= GRAV_MULT*GRAVITY*delta_time
             if (
-                self.physics_engine.can_jump() 
-                and 
+                self.collisions.can_jump(self.physics_engine)
+                and
                 self.time_since_ground > START_CLIMB
                 ):
                 self.fly_speed = STATIONARY
                 self.time_since_ground = NOTHING
             self.time_since_ground += delta_time
-                
 
         # Update animations for the player
         # Change the various states of the player based on
         # physics interactions.
-        if self.physics_engine.can_jump():
+        if self.collisions.can_jump(self.physics_engine):
             self.player_sprite.can_jump = False
         else:
             self.player_sprite.can_jump = True
 
         if (
-            self.physics_engine.is_on_ladder() 
-            and 
-            not self.physics_engine.can_jump()
+            self.collisions.is_on_ladder(self.physics_engine)
+            and
+            not self.collisions.can_jump(self.physics_engine)
             ):
             self.player_sprite.is_on_ladder = True
             self.process_keychange()
@@ -2655,6 +6451,9 @@ class GameView(arcade.View):
             self.player_sprite.is_on_ladder = False
             self.process_keychange()
 
+    def update_knife(self, delta_time):
+        """Swings the knife, and moves it along with the player."""
+
         # Check if knife is being swung
         if self.can_knife:
             # If knife is swung then spawn knife in front of player
@@ -2663,18 +6462,18 @@ class GameView(arcade.View):
                 knife = Knife()
                 if self.player_sprite.facing_direction == RIGHT_FACING:
                     knife.center_x = (
-                        self.player_sprite.center_x 
+                        self.player_sprite.center_x
                         + HALF_BLOCK*TILE_SCALING*self.tile_map.tile_width
                         )
                     knife.facing_direction = RIGHT_FACING
                 else:
                     knife.center_x = (
-                        self.player_sprite.center_x 
+                        self.player_sprite.center_x
                         - HALF_BLOCK*TILE_SCALING*self.tile_map.tile_width
                         )
                     knife.facing_direction = LEFT_FACING
                 knife.center_y = self.player_sprite.center_y
-                    
+
                 self.scene.add_sprite(LAYER_NAME_KNIFE, knife)
 
                 # Stop swinging knife and activate knife ban.
@@ -2691,18 +6490,18 @@ class GameView(arcade.View):
                 self.knife_timer = NOTHING
 
         # Remove knife after it has finished its swing
-        # If an error occurs that just means the knife doesn't exist and we can ignore.
-        try:
+        # (The knife layer only exists once the first knife is swung)
+        if LAYER_NAME_KNIFE in self.scene.name_mapping:
             for knife in self.scene[LAYER_NAME_KNIFE]:
                 if self.player_sprite.facing_direction == RIGHT_FACING:
                     knife.center_x = (
-                        self.player_sprite.center_x 
+                        self.player_sprite.center_x
                         + HALF_BLOCK*TILE_SCALING*self.tile_map.tile_width
                     )
                     knife.facing_direction = RIGHT_FACING
                 else:
                     knife.center_x = (
-                        self.player_sprite.center_x 
+                        self.player_sprite.center_x
                         - HALF_BLOCK*TILE_SCALING*self.tile_map.tile_width
                         )
                     knife.facing_direction = LEFT_FACING
@@ -2710,8 +6509,9 @@ class GameView(arcade.View):
                 knife.update_animation(delta_time)
                 if knife.swing_finished:
                     self.scene[LAYER_NAME_KNIFE].remove(knife)
-        except:
-            pass
+
+    def update_animations(self, delta_time):
+        """Animates the player and the other animated layers."""
 
         # Update animations for other layers.
         self.scene.update_animation(
@@ -2722,6 +6522,9 @@ class GameView(arcade.View):
             ] + self.available_layers
         )
 
+    def update_moving_sprites(self, delta_time):
+        """Moves the moving platforms and enemies."""
+
         # Update moving platforms and enemies
         # If there are no moving enemies only update moving platforms.
         if self.map_has_enemies:
@@ -2736,121 +6539,133 @@ class GameView(arcade.View):
                 [LAYER_NAME_MOVING_PLATFORMS]
             )
 
-        # All try-excepts beyond this point are used to prevent errors
-        # where in some tilemaps certain layers do not exist and will
-        # cause an error when attempting to access.
+    def update_villagers(self, delta_time):
+        """Checks which villagers are close enough to talk to."""
 
         # Update villagers' interaction possible sensing.
-        try:
-            for villager in self.scene[LAYER_NAME_VILLAGERS]:
-                villager.update(
-                    player_pos=(
-                    self.player_sprite.center_x, 
-                    self.player_sprite.center_y
-                    ), 
-                    tile_map=self.tile_map
-                    )
-        except:
-            pass
+        # Only the villagers near the player are checked, as well as
+        # the ones which were near last step so that they stop being
+        # interactable once the player has left.
+        nearby = self.collisions.nearby(LAYER_NAME_VILLAGERS)
+        self.active_villagers = sorted(
+            set(nearby) | set(self.nearby_villagers),
+            key=self.interactables.order.__getitem__,
+            )
+        self.nearby_villagers = nearby
+        for villager in self.active_villagers:
+            villager.update(
+                player_pos=(
+                self.player_sprite.center_x,
+                self.player_sprite.center_y
+                ),
+                tile_map=self.tile_map
+                )
+
+    def update_enemy_patrol(self, delta_time):
+        """Turns enemies around at the ends of their patrol."""
 
         # See if the enemy hit a boundary and needs to reverse direction.
-        try:
-            for enemy in self.scene[LAYER_NAME_ENEMIES]:
-                if (
-                    enemy.boundary_right
-                    and enemy.right > (
-                    enemy.boundary_right
-                    *TILE_SCALING*self.tile_map.tile_width
-                    )
-                    and enemy.change_x > STATIONARY
-                ):
-                    # No need for a constant here, this just
-                    # reverses the horizontal speed.
-                    enemy.change_x *= -1
+        for enemy in self.scene[LAYER_NAME_ENEMIES]:
+            if (
+                enemy.boundary_right
+                and enemy.right > (
+                enemy.boundary_right
+                *TILE_SCALING*self.tile_map.tile_width
+                )
+                and enemy.change_x > STATIONARY
+            ):
+                # No need for a constant here, this just
+                # reverses the horizontal speed.
+                enemy.change_x *= -1
 
-                if (
-                    enemy.boundary_left
-                    and enemy.left < (
-                    enemy.boundary_left
-                    *TILE_SCALING*self.tile_map.tile_width
-                    )
-                    and enemy.change_x < STATIONARY
-                ):
-                    # No need for a constant here, this just
-                    # reverses the horizontal speed.
-                    enemy.change_x *= -1
-        except:
-            pass
-        
+            if (
+                enemy.boundary_left
+                and enemy.left < (
+                enemy.boundary_left
+                *TILE_SCALING*self.tile_map.tile_width
+                )
+                and enemy.change_x < STATIONARY
+            ):
+                # No need for a constant here, this just
+                # reverses the horizontal speed.
+                enemy.change_x *= -1
+
+    def update_villager_interaction(self, delta_time):
+        """Starts and hands in quests when talking to villagers."""
 
         # Only try to check interaction with villagers if in human shape
         if self.shape == PLAYER_SHAPE_HUMAN:
             # If the villager is close enough assign the ID of the
             # villager as the interactable_villager variable.
-            try:
-                interactable_villager = None
-                # Check if in range of villager
-                for villager in self.scene[LAYER_NAME_VILLAGERS]:
-                    if villager.interactable:
-                        self.can_interact = True
-                        interactable_villager = villager.id
-                        break
-                    else:
-                        villager.wave = False
-            except:
-                pass
-            try:        
-                # Check for interaction with villager
-                # If interacted and quest not started yet start
-                # the quest. Otherwise check if the quest is done
-                # or if the quest is done just wave instead.
-                    if self.interact:
-                        for villager in self.scene[LAYER_NAME_VILLAGERS]:
-                            if villager.id == interactable_villager:
-                                if villager.id not in self.completed_quests:
-                                    if villager.id not in self.quests.keys():
-                                        villager.wave = True
-                                        self.activate_quest(villager)
-                                    elif (
-                                        self.latest_quest["dialogue_time"] 
-                                        <= NOTHING
-                                        ):
-                                        self.check_quest_complete(villager)
-                                else:
-                                    villager.wave = True
-            except:
-                pass
+            interactable_villager = None
+            # Check if in range of villager
+            for villager in self.active_villagers:
+                if villager.interactable:
+                    self.can_interact = True
+                    interactable_villager = villager.id
+                    break
+                else:
+                    villager.wave = False
+
+            # Check for interaction with villager
+            # If interacted and quest not started yet start
+            # the quest. Otherwise check if the quest is done
+            # or if the quest is done just wave instead.
+            if self.interact:
+                for villager in self.active_villagers:
+                    if villager.id == interactable_villager:
+                        if villager.id not in self.completed_quests:
+                            if villager.id not in self.quests.keys():
+                                villager.wave = True
+                                self.activate_quest(villager)
+                            elif (
+                                self.latest_quest["dialogue_time"]
+                                <= NOTHING
+                                ):
+                                self.check_quest_complete(villager)
+                        else:
+                            villager.wave = True
+
+    def update_warp_doors(self, delta_time):
+        """
+        Goes through warp doors the player interacts with.
+        Returns True if the level is changing.
+        """
 
         # Check if interaction possible with door
         # If close enough to door interaction is possible.
         # Set the interactable_door variable to whatever door position
         # is the closed to the player.
-        for id, info in self.doors.items():
+        # Only the doors near the player are checked.
+        self.interactable_door = None
+        for id in self.collisions.nearby(LAYER_NAME_WARP_DOORS):
             if (
-                calculate_distance(self.player_sprite.position, info["pos"])
+                calculate_distance(
+                    self.player_sprite.position, self.doors[id]["pos"]
+                    )
                 < TILE_SCALING*self.tile_map.tile_width
                 ):
                 self.interactable_door = id
                 self.can_interact = True
                 break
-            self.interactable_door = None
-        
+
         # Level changing mechanics
         # Check if actually interacting with door
         if (
-            self.interact 
-            and self.can_interact 
+            self.interact
+            and self.can_interact
             and self.interactable_door != None
             ):
             # If the door requires no key, setup the level,
             # spawnpoint, disable the interact action and setup the
             # sublevel.
             if self.doors[self.interactable_door]["key_req"] == "None":
-                self.level = self.doors[self.interactable_door]["warp"]
-                self.spawnpoint = self.doors[self.interactable_door]["dest"]
                 self.interact = False
-                self.setup()
-                return
+                self.start_transition(
+                    self.doors[self.interactable_door]["warp"],
+                    self.doors[self.interactable_door]["dest"],
+                    )
+                return True
             else:
                 # Check if the player has the key.
                 has_key = False
@@ -2858,7 +6673,7 @@ class GameView(arcade.View):
                     if (
                         item["name"] == self.doors[
                             self.interactable_door
-                            ]["key_req"] 
+                            ]["key_req"]
                         and item["number"] > NOTHING
                         ):
                         has_key = True
@@ -2866,401 +6681,293 @@ class GameView(arcade.View):
                 if has_key:
                     # If the player has the key also setup the
                     # spawnpoint, spawn position, and stop interacting.
-                    self.level = self.doors[self.interactable_door]["warp"]
-                    self.spawnpoint = self.doors[
-                        self.interactable_door
-                        ]["dest"]
                     self.interact = False
-                    self.setup()
-                    return
+                    self.start_transition(
+                        self.doors[self.interactable_door]["warp"],
+                        self.doors[self.interactable_door]["dest"],
+                        )
+                    return True
                 else:
                     # Otherwise the key is missing and the key missing
                     # text is drawn above the player.
                     self.missing_key_text = MISSING_KEY_TIME
-                            
+
+    def update_statues(self, delta_time):
+        """Sets the spawnpoint to statues the player interacts with."""
+
         # Check if interaction possible with statue (not current).
-        try:
-            if (
-                len(
-                arcade.check_for_collision_with_list(
-                self.player_sprite, 
-                self.scene[LAYER_NAME_STATUES]
-                )
-                ) 
-                > NOTHING
-                ):
-                self.can_interact = True
-        except:
-            pass
-        
+        if (
+            len(self.collisions.touching(LAYER_NAME_STATUES))
+            > NOTHING
+            ):
+            self.can_interact = True
 
         # Check for collisions with the statue.
         # The player can only interact with the statue if they're
         # colliding.
-        # If there are no statues in the scene ignore this code.
-        try:
-            if self.interact:
-                player_collision_list = arcade.check_for_collision_with_list(
-                    self.player_sprite, self.scene[LAYER_NAME_STATUES]
+        if self.interact:
+            player_collision_list = self.collisions.touching(
+                LAYER_NAME_STATUES
+                )
+            for collision in player_collision_list:
+                # If there is an available statue, set the
+                # spawnpoint to that statue and set energy up to
+                # three. (Must be within a certain distance to
+                # interact)
+                # The spawnpoint works by storing the previous
+                # spawnpoint statue in the self.prev_spawnpoint,
+                # and after interacting with a new statue that
+                # statue is moved back to the "Statues" layer,
+                # while the new statue is moved from the "Statues"
+                # layer into the "Current Statue" layer.
+                if self.prev_spawnpoint != None:
+                    self.scene[LAYER_NAME_STATUES].append(
+                        self.prev_spawnpoint
+                        )
+                    self.scene[LAYER_NAME_SPAWNPOINT].clear()
+                if (
+                    abs(collision.center_x - self.player_sprite.center_x)
+                    <
+                    (
+                    self.tile_map.tile_width * TILE_SCALING
+                    * MIN_STATUE_DIST
                     )
-                for collision in player_collision_list:
-                    # If there is an available statue, set the
-                    # spawnpoint to that statue and set energy up to
-                    # three. (Must be within a certain distance to
-                    # interact)
-                    # The spawnpoint works by storing the previous
-                    # spawnpoint statue in the self.prev_spawnpoint,
-                    # and after interacting with a new statue that
-                    # statue is moved back to the "Statues" layer,
-                    # while the new statue is moved from the "Statues"
-                    # layer into the "Current Statue" layer.
-                    if self.prev_spawnpoint != None:
-                        self.scene[LAYER_NAME_STATUES].append(
-                            self.prev_spawnpoint
-                            )
-                        self.scene[LAYER_NAME_SPAWNPOINT].clear()
-                    if (
-                        abs(collision.center_x - self.player_sprite.center_x)
-                        < 
+                    ):
+                    self.spawnpoint = (
+                        (
+                        collision.center_x /
+                        (self.tile_map.tile_width * TILE_SCALING)
+                        ),
                         (
-                        self.tile_map.tile_width * TILE_SCALING 
-                        * MIN_STATUE_DIST
+                        collision.center_y /
+                        (
+                        self.tile_map.tile_width * TILE_SCALING
                         )
-                        ):
-                        self.spawnpoint = (
-                            (
-                            collision.center_x / 
-                            (self.tile_map.tile_width * TILE_SCALING)
-                            ), 
-                            (
-                            collision.center_y / 
-                            (
-                            self.tile_map.tile_width * TILE_SCALING
-                            ) 
-                            - ONE_BLOCK)
-                            )
-                        self.scene[LAYER_NAME_SPAWNPOINT].append(collision)
-                        self.scene[LAYER_NAME_STATUES].remove(collision)
-                        self.prev_spawnpoint = collision
-                        self.energy = MAX_ENERGY
-                        self.new_spawnpoint_text = NEW_SPAWNPOINT_TIME
-                self.interact = False
-        except:
-            pass
+                        - ONE_BLOCK)
+                        )
+                    self.scene[LAYER_NAME_SPAWNPOINT].append(collision)
+                    self.scene[LAYER_NAME_STATUES].remove(collision)
+                    self.prev_spawnpoint = collision
+                    self.energy = MAX_ENERGY
+                    self.new_spawnpoint_text = NEW_SPAWNPOINT_TIME
+            self.interact = False
+
+    def update_orbs(self, delta_time):
+        """Collects energy orbs."""
 
         # Check for collisions with energy orbs.
         # Only register if the player still has room to gain energy.
-        # Try except still works the same as before.
-        try:
-            if self.energy < MAX_ENERGY:
-                player_collision_list = arcade.check_for_collision_with_list(
-                    self.player_sprite, self.scene[LAYER_NAME_ORBS]
-                    )
-                for collision in player_collision_list:
-                    if collision.type == "Energy":
-                        self.energy += UNIT_INCREMENT
-                        self.scene[LAYER_NAME_ORBS].remove(collision)
-        except:
-            pass
-        
-        # Check for collisions with keys or secrets
-        # All try-excepts in this general area work the same,
-        # where if the layer exists in the scene the code runs,
-        # but if the layer doesn't exist the code is ignored.
-        try:
-            player_collision_list = arcade.check_for_collision_with_list(
-                self.player_sprite, self.scene[LAYER_NAME_COLLECTIBLES]
-                )
-            for collision in player_collision_list:
-                if collision.type == "Key":
-                    # If key collected then remove key from scene and
-                    # add the key ID to the lst of keys obtained.
-                    self.keys_obtained.append(collision.id)
-                    self.scene[LAYER_NAME_COLLECTIBLES].remove(collision)
-                if collision.type == "Secret":
-                    # If secret collected then remove secret from scene
-                    # and add the name to the secrets found list.
-                    self.secret_found_text = SECRET_FOUND_TIME
-                    self.secrets_found.append(collision.name)
-                    self.scene[LAYER_NAME_COLLECTIBLES].remove(collision)
-
-        except:
-            pass
+        if self.energy < MAX_ENERGY:
+            self.collisions.dispatch(LAYER_NAME_ORBS)
+
+    def pick_up_orb(self, collision):
+        """Adds the energy from an orb the player touches."""
+        if collision.type == "Energy":
+            self.energy += UNIT_INCREMENT
+            self.scene[LAYER_NAME_ORBS].remove(collision)
+
+    def update_collectibles(self, delta_time):
+        """Collects keys, secrets and quest items."""
+
+        # Check for collisions with keys, secrets or quest items
+        self.collisions.dispatch(LAYER_NAME_COLLECTIBLES)
+
+    def pick_up_collectible(self, collision):
+        """Collects a key or secret the player touches."""
+        if collision.type == "Key":
+            # If key collected then remove key from scene and
+            # add the key ID to the lst of keys obtained.
+            self.keys_obtained.append(collision.id)
+            self.scene[LAYER_NAME_COLLECTIBLES].remove(collision)
+        if collision.type == "Secret":
+            # If secret collected then remove secret from scene
+            # and add the name to the secrets found list.
+            self.secret_found_text = SECRET_FOUND_TIME
+            self.secrets_found.append(collision.name)
+            self.scene[LAYER_NAME_COLLECTIBLES].remove(collision)
+            self.preload_end_screen()
+
+    def update_locked_doors(self, delta_time):
+        """Opens locked doors the player has the key for."""
 
         # Check for collisions with locked door
-        try:
-            player_collision_list = arcade.check_for_collision_with_list(
-                self.player_sprite, self.scene[LAYER_NAME_LOCKED_DOORS]
-                )
-            for collision in player_collision_list:
-                # If the ID of the door is in the keys obtained list,
-                # open the door by moving the thin barrier from a wall
-                # layer to a transparent layer and change the texture
-                # of the door from closed to open.
-                if str(collision.id) in self.keys_obtained:
-                    for door_barrier in self.scene[
-                        LAYER_NAME_DOOR_BARRIERS_CLOSED
-                        ]:
-                        self.scene[LAYER_NAME_DOOR_BARRIERS_OPEN].append(
-                            door_barrier
-                            )
-                        self.scene[LAYER_NAME_DOOR_BARRIERS_CLOSED].remove(
-                            door_barrier
-                            )
-                    collision.open = True
-                else:
-                    # If no door ID in the keys obtained list,
-                    # display the missing key text above the player.
-                    # Also move the door barrier from the transparent
-                    # layer to the wall layer so that the player
-                    # cannot get past.
-                    self.missing_key_text = MISSING_KEY_TIME
-                    for door_barrier in self.scene[
-                        LAYER_NAME_DOOR_BARRIERS_OPEN
-                        ]:
-                        self.scene[LAYER_NAME_DOOR_BARRIERS_CLOSED].append(
-                            door_barrier
-                            )
-                        self.scene[LAYER_NAME_DOOR_BARRIERS_OPEN].remove(
-                            door_barrier
-                            )
+        self.collisions.dispatch(LAYER_NAME_LOCKED_DOORS)
+
+    def touch_locked_door(self, collision):
+        """Opens (or keeps shut) a locked door the player touches."""
+        # If the ID of the door is in the keys obtained list,
+        # open the door by moving the thin barrier from a wall
+        # layer to a transparent layer and change the texture
+        # of the door from closed to open.
+        # Only the barriers which moved change the collision grid.
+        if str(collision.id) in self.keys_obtained:
+            opened = []
+            for door_barrier in self.scene[
+                LAYER_NAME_DOOR_BARRIERS_CLOSED
+                ]:
+                self.scene[LAYER_NAME_DOOR_BARRIERS_OPEN].append(
+                    door_barrier
+                    )
+                self.scene[LAYER_NAME_DOOR_BARRIERS_CLOSED].remove(
+                    door_barrier
+                    )
+                opened.append(door_barrier)
+            if opened:
+                self.refresh_collision(
+                    LAYER_NAME_DOOR_BARRIERS_CLOSED, removed=opened
+                    )
+            collision.open = True
+        else:
+            # If no door ID in the keys obtained list,
+            # display the missing key text above the player.
+            # Also move the door barrier from the transparent
+            # layer to the wall layer so that the player
+            # cannot get past.
+            self.missing_key_text = MISSING_KEY_TIME
+            closed = []
+            for door_barrier in self.scene[
+                LAYER_NAME_DOOR_BARRIERS_OPEN
+                ]:
+                self.scene[LAYER_NAME_DOOR_BARRIERS_CLOSED].append(
+                    door_barrier
+                    )
+                self.scene[LAYER_NAME_DOOR_BARRIERS_OPEN].remove(
+                    door_barrier
+                    )
+                closed.append(door_barrier)
+            if closed:
+                self.refresh_collision(
+                    LAYER_NAME_DOOR_BARRIERS_CLOSED, added=closed
+                    )
 
-        except:
-            pass
+    def collect_quest_item(self, collision):
+        """Collects an item needed for a current quest."""
 
         # Quest item collision processing
-        # This checks all of the current quests
-        # and checks which quest items are needed.
-        # Also stores the ID of the quest which needs the item
-        # that is being checked.
-        if self.in_quest:
-            quest_req_apples = False
-            quest_req_cards = False
-            quest_req_documents = False
-            quest_req_helmets = False
-            quest_req_rainbow_rocks = False
-            for id, info in self.quests.items():
-                if info["quest_item"] == "Apple":
-                    quest_req_apples = True
-                    quest_id_apples = id
-                if info["quest_item"] == "Card":
-                    quest_req_cards = True
-                    quest_id_cards = id
-                if info["quest_item"] == "Document":
-                    quest_req_documents = True
-                    quest_id_documents = id
-                if info["quest_item"] == "Helmet":
-                    quest_req_helmets = True
-                    quest_id_helmets = id
-                if info["quest_item"] == "Rainbow Rock":
-                    quest_req_rainbow_rocks = True
-                    quest_id_rainbow_rocks = id
-            
-            # Try Except is used here to ensure no errors.
-            # If there is an error that means the level doesn't
-            # actually have any collectibles.
-            try:
-                player_collision_list = arcade.check_for_collision_with_list(
-                    self.player_sprite, self.scene[LAYER_NAME_COLLECTIBLES]
-                    )
-                for collision in player_collision_list:
-                    # For all quest items reference the inventory
-                    # ID corresponding to that quest and add one to the
-                    # quest item belonging to the quest.
-                    if quest_req_apples:
-                        # Check for collisions with apples
-                        if collision.type == "Apple":
-                            self.inventory_quest[
-                                quest_id_apples
-                                ]["number"] += UNIT_INCREMENT
-                            self.scene[LAYER_NAME_COLLECTIBLES].remove(
-                                collision
-                                )
-                    if quest_req_cards:
-                        # Check for collisions with cards
-                        if collision.type == "Card":
-                            self.inventory_quest[
-                                quest_id_cards
-                                ]["number"] += UNIT_INCREMENT
-                            self.scene[LAYER_NAME_COLLECTIBLES].remove(
-                                collision
-                                )
-                    if quest_req_documents:
-                        # Check for collisions with documents
-                        if collision.type == "Document":
-                            self.inventory_quest[
-                                quest_id_documents
-                                ]["number"] += UNIT_INCREMENT
-                            self.scene[LAYER_NAME_COLLECTIBLES].remove(
-                                collision
-                                )
-                    if quest_req_helmets:
-                        # Check for collisions with helmets
-                        if collision.type == "Helmet":
-                            self.inventory_quest[
-                                quest_id_helmets
-                                ]["number"] += UNIT_INCREMENT
-                            self.scene[LAYER_NAME_COLLECTIBLES].remove(
-                                collision
-                                )
-                    if quest_req_rainbow_rocks:
-                        # Check for collisions with rainbow rocks
-                        if collision.type == "Rainbow Rock":
-                            self.inventory_quest[
-                                quest_id_rainbow_rocks
-                                ]["number"] += UNIT_INCREMENT
-                            self.scene[LAYER_NAME_COLLECTIBLES].remove(
-                                collision
-                                )
-            except:
-                pass
-
+        # The quest engine knows which of the current quests needs the
+        # item, and the item is added to that quest's inventory.
+        if not self.in_quest:
+            return
+        quest_id = self.quest_engine.quest_for_item(collision.type)
+        if quest_id is not None:
+            self.inventory_quest[quest_id]["number"] += UNIT_INCREMENT
+            self.scene[LAYER_NAME_COLLECTIBLES].remove(collision)
 
-        # Update energy bar
-        # Change the texture of the energy bar to the corresponding
-        # energy level.
-        try:
-            for energy_bar in self.gui_scene[LAYER_NAME_ENERGY]:
-                energy_bar.texture = arcade.load_texture(
-                    f"{MAIN_PATH}/assets/GUI/Energy/{self.energy}.png"
-                    )
-        except:
-            pass
+    def update_knife_stab(self, delta_time):
+        """Kills enemies hit by the knife."""
 
         # Check for stabbing of enemy
-        try:
-            knife_collision_list = arcade.check_for_collision_with_list(
-                self.scene[LAYER_NAME_KNIFE][FIRST_VALUE], 
-                self.scene[LAYER_NAME_ENEMIES]
-                )
-            for collision in knife_collision_list:
-                if collision.can_kill:
-                    # If the enemy is killable remove enemy
-                    # from the scene and add one to the drop
-                    # in the inventory.
-                    for id, info in self.inventory_quest.items():
-                        if collision.drop == info["name"]:
-                            self.inventory_quest[id]["number"] += (
-                                UNIT_INCREMENT
-                                )
-                    self.scene[LAYER_NAME_ENEMIES].remove(collision)
-        
-        except:
-            pass
+        # (Only while a knife is being swung)
+        if (
+            LAYER_NAME_KNIFE not in self.scene.name_mapping
+            or len(self.scene[LAYER_NAME_KNIFE]) == NOTHING
+            ):
+            return
+        knife_collision_list = arcade.check_for_collision_with_list(
+            self.scene[LAYER_NAME_KNIFE][FIRST_VALUE],
+            self.scene[LAYER_NAME_ENEMIES]
+            )
+        for collision in knife_collision_list:
+            if collision.can_kill:
+                # If the enemy is killable remove enemy
+                # from the scene and add one to the drop
+                # in the inventory.
+                for id, info in self.inventory_quest.items():
+                    if collision.drop == info["name"]:
+                        self.inventory_quest[id]["number"] += (
+                            UNIT_INCREMENT
+                            )
+                self.scene[LAYER_NAME_ENEMIES].remove(collision)
+
+    def update_enemy_contact(self, delta_time):
+        """Hurts the player when they touch an enemy."""
 
         # Check for collisions with enemies
-        # If touching enemy start timer for one second immunity.
-        # Also make the player jump up to extricate themself from
-        # the situation.
-        try:
-            player_collision_list = arcade.check_for_collision_with_list(
-                self.player_sprite, self.scene[LAYER_NAME_ENEMIES]
-                )
-            if len(player_collision_list) > NOTHING:
-                if self.cooldown <= NOTHING:
-                    self.health -= UNIT_INCREMENT
-                    self.cooldown = HIT_COOLDOWN
-                    self.player_sprite.change_y = PLAYER_JUMP_SPEED
-        except:
-            pass
+        self.collisions.dispatch(LAYER_NAME_ENEMIES)
+
+    def touch_enemy(self, collision):
+        """
+        If touching enemy start timer for one second immunity.
+        Also make the player jump up to extricate themself from
+        the situation.
+        """
+        if self.cooldown <= NOTHING:
+            self.health -= UNIT_INCREMENT
+            self.cooldown = HIT_COOLDOWN
+            self.player_sprite.change_y = PLAYER_JUMP_SPEED
+
+    def update_hud(self, delta_time):
+        """Updates the energy and health bars."""
+
+        # Update energy bar
+        # Change the texture of the energy bar to the corresponding
+        # energy level (only if it has changed).
+        self.hud.set_energy(self.energy)
 
         # Update health bar
-        # Change health bar texture to the current health level.
-        try:
-            for health_bar in self.gui_scene[LAYER_NAME_HEALTH]:
-                health_bar.texture = arcade.load_texture(
-                    f"{MAIN_PATH}/assets/GUI/Health/{self.health}.png"
-                    )
-        except:
-            pass
+        # Change health bar texture to the current health level
+        # (only if it has changed).
+        self.hud.set_health(self.health)
+
+    def update_cave(self, delta_time):
+        """Reveals the cave tiles near the player."""
 
         # Reveal tunnels/cave when player approaches
-        try:
-            for tile in self.scene[LAYER_NAME_CAVE]:
-                # Calculate distance from player to each cave tile.
-                distance_to_player = calculate_distance(
-                    [
-                        self.player_sprite.center_x, 
-                        self.player_sprite.center_y
-                        ], 
-                    [tile.center_x, tile.center_y]
-                    )
-                # If the distance is less than the upper bound
-                # start revealing the blocks underneath by reducing
-                # the opacity based on the proportion of current
-                # distance against the upper bound.
-                # If the distance is less than the lower bound,
-                # Make the block fully transparent.
-                if (
-                    distance_to_player 
-                    < 
-                    CAVE_REVEAL_DIST*TILE_SCALING*self.tile_map.tile_width
-                    ):
-                    tile.alpha = (
-                        MAX_OPACITY
-                        *(
-                        max(
-                        (
-                        distance_to_player-CAVE_TRNSPT_DIST
-                        *TILE_SCALING*self.tile_map.tile_width
-                        ), 
-                        NOTHING
-                        )
-                        ) 
-                        / (
-                        CAVE_REVEAL_DIST*TILE_SCALING*self.tile_map.tile_width
-                        )
-                        )
-        except:
-            pass
-        
+        # Only the cave tiles near the player are checked, and only the
+        # ones whose opacity changes are updated.
+        # (When the cave fog shader is used it does this instead)
+        self.cave_reveal.update(self.player_sprite.position)
+
+    def update_respawn(self, delta_time):
+        """Moves the player back to the spawnpoint after dying."""
 
         # Once death animation over respawn
         if (
-            self.player_sprite.dying 
-            and 
+            self.player_sprite.dying
+            and
             self.player_sprite.dying != self.player_sprite.is_dead
             ):
             self.player_sprite.center_x = (
-                self.tile_map.tile_width 
+                self.tile_map.tile_width
                 * TILE_SCALING * self.spawnpoint[X_POS]
                 )
             self.player_sprite.center_y = (
-                self.tile_map.tile_height 
+                self.tile_map.tile_height
                 * TILE_SCALING * self.spawnpoint[Y_POS]
                 )
             # This resets the dying state to not dying.
             self.player_sprite.dying = False
+            # What the player was touching before respawning has to be
+            # checked again.
+            self.collisions.clear()
+
+    def update_death_tiles(self, delta_time):
+        """Kills the player when they touch the death layer."""
+
+        # Check for collision with death layer (spikes etc)
+        # If the player hits a spike immediately start the
+        # death animation.
+        if (
+            len(self.collisions.touching(LAYER_NAME_DEATH)) > NOTHING
+            and not self.player_sprite.is_dead
+            ):
+            self.player_sprite.is_dead = True
+
+    def update_death(self, delta_time):
+        """Kills the player when they fall or run out of health."""
 
-        # Check for collision with death layer (spikes etc)
-        try:
-            # If the player hits a spike immediately start the
-            # death animation.
-            if (
-                len(
-                arcade.check_for_collision_with_list(
-                    self.player_sprite, 
-                    self.scene[LAYER_NAME_DEATH]
-                    )
-                ) 
-                > NOTHING and not self.player_sprite.is_dead
-                ):
-                self.player_sprite.is_dead = True
-        except:
-            pass
-        
         # Run player death animation if the player jumps off the edge
         # or runs out of health.
         if (
             self.player_sprite.center_y < ORIGIN[Y_POS]
-            or 
-            self.health <= NOTHING 
-            and 
+            or
+            self.health <= NOTHING
+            and
             not self.player_sprite.is_dead
             ):
-            
+
             self.player_sprite.is_dead = True
-        
+
         # Once the player dies reset their speed and
         # health/energy.
         if self.player_sprite.is_dead:
@@ -3268,6 +6975,9 @@ class GameView(arcade.View):
             self.energy = MAX_ENERGY
             self.fly_speed = STATIONARY
 
+    def update_timers(self, delta_time):
+        """Counts down the quest state and popup timers."""
+
         # If there are quests in the current quest list
         # set the in_quest state to True,
         # otherwise set it to False.
@@ -3282,7 +6992,7 @@ class GameView(arcade.View):
             self.cooldown -= delta_time
         else:
             self.cooldown = NOTHING
-        
+
         if self.not_complete_time > NOTHING:
             self.not_complete_time -= delta_time
         else:
@@ -3296,7 +7006,7 @@ class GameView(arcade.View):
             self.missing_key_text -= delta_time
         else:
             self.missing_key_text = NOTHING
-        
+
         if self.secret_found_text > NOTHING:
             self.secret_found_text -= delta_time
         else:
@@ -3306,66 +7016,1082 @@ class GameView(arcade.View):
             self.new_spawnpoint_text -= delta_time
         else:
             self.new_spawnpoint_text = NOTHING
-        
+
         # If these variables exist, i.e. after a quest has been started,
         # Run the timer code
         # Otherwise, just ignore it
-        try:
+        if self.latest_quest is not None:
             if self.latest_quest["dialogue_time"] > NOTHING:
                 self.latest_quest["dialogue_time"] -= delta_time
             else:
                 self.latest_quest["dialogue_time"] = NOTHING
-        except:
-            pass
 
-        try:
+        if self.finished_quest is not None:
             if self.finished_quest["dialogue_time"] > NOTHING:
                 self.finished_quest["dialogue_time"] -= delta_time
             else:
                 self.finished_quest["dialogue_time"] = NOTHING
 
-            # Once the timer for the quest end dialogue goes to 0, 
+            # Once the timer for the quest end dialogue goes to 0,
             # delete the finished quest.
             if (
-                self.finished_quest["dialogue_time"] 
-                <= 
+                self.finished_quest["dialogue_time"]
+                <=
                 NOTHING and self.quest_ended
                 ):
                 self.finished_quest = None
                 self.quest_ended = False
-  
-        except:
-            pass
+
+    def update_goal(self, delta_time):
+        """
+        Moves the player to the next main level (or the end screen) when
+        they reach the goal portal.
+        Returns True if the level is changing.
+        """
 
         # Check for collision with goal/warp portal
         # This moves the player to the next main level.
+        return self.collisions.dispatch(LAYER_NAME_GOAL)
+
+    def reach_goal(self, collision):
+        """
+        Moves the player through the goal portal they touched.
+        Returns True as the level is changing.
+        """
+        # If the destination level is 4 end the game and show
+        # the end screen.
+        if collision.warp == "4":
+            self.end_screen_preload.result()
+            end_view = EndScreen(self.secrets_found)
+            self.window.show_view(end_view)
+            return True
+        else:
+            # Otherwise teleport the player to the next level
+            # and run the setup, placing the player at the
+            # target position.
+            self.start_transition(collision.warp, collision.dest)
+        # Once this code runs the update code should stop
+        # running and everything resets for the start of the
+        # next level.
+        return True
+
+# Headless simulation
+class HeadlessWindow:
+    """
+    Stands in for the arcade window when the game runs without a
+    display. It has no OpenGL context so nothing can be drawn, and the
+    views shown in it are only recorded.
+    """
+
+    def __init__(self, width=SCREEN_WIDTH, height=SCREEN_HEIGHT):
+        """
+        Initialises the window attributes the game uses.
+        width, height:      The size of the screen the cameras are made
+                            for.
+        ctx:                The OpenGL context. (There isn't one)
+        current_view:       The view last shown.
+        current_camera:     The camera last used. (Used by arcade)
+        background_color:   The colour the screen would be cleared to.
+        """
+        self.width = width
+        self.height = height
+        self.ctx = None
+        self.current_view = None
+        self.current_camera = None
+        self.background_color = BLACK
+
+    def show_view(self, view):
+        """
+        Records the view which would be shown, telling the view it
+        replaces like a real window does.
+        """
+        if self.current_view is not None:
+            self.current_view.on_hide_view()
+        self.current_view = view
+
+    def set_update_rate(self, rate):
+        """Does nothing, as the runner decides when updates happen."""
+
+    def set_mouse_visible(self, visible=True):
+        """Does nothing, as there is no mouse pointer."""
+
+    def close(self):
+        """Does nothing, as there is nothing to close."""
+
+
+class HeadlessRunner:
+    """
+    Runs the game without a window. A level is loaded, then the game is
+    updated with a fixed delta_time as fast as possible, with keys
+    pressed and released on the given frames. Nothing is drawn.
+    """
+
+    def __init__(self, level="1.1", delta_time=SIMULATION_STEP, tracer=None):
+        """
+        Sets up the game in the given level, recording the timeline of
+        the game in the tracer if one is given.
+        window:     The stand-in window.
+        view:       The game.
+        delta_time: The time passed to every update.
+        frame:      Number of updates run so far.
+        time:       Real time the updates took (seconds).
+        """
+        self.window = HeadlessWindow()
+        arcade.set_window(self.window)
+        self.view = GameView(self.window, music=False)
+        self.view.level = level
+        if tracer is not None:
+            self.view.start_tracing(tracer)
+        self.window.show_view(self.view)
+        self.view.setup()
+        self.delta_time = delta_time
+        self.frame = NOTHING
+        self.time = NOTHING
+
+    def press(self, key):
+        """Presses a key."""
+        self.view.on_key_press(key, NOTHING)
+
+    def release(self, key):
+        """Releases a key."""
+        self.view.on_key_release(key, NOTHING)
+
+    def finished(self):
+        """Returns True once the game has ended (the end screen)."""
+        return self.window.current_view is not self.view
+
+    def close(self):
+        """Stops the game's level loading thread once done with it."""
+        self.view.prefetcher.close()
+
+    def run(self, frames, key_events=()):
+        """
+        Runs up to the given number of updates, stopping early if the
+        game ends.
+        key_events are (frame, pressed, key) tuples, where frame counts
+        from the first update the runner ran.
+        """
+        events = {}
+        for frame, pressed, key in key_events:
+            events.setdefault(frame, []).append((pressed, key))
+        start = time.perf_counter()
+        for _ in range(frames):
+            if self.finished():
+                break
+            for pressed, key in events.get(self.frame, []):
+                if pressed:
+                    self.press(key)
+                else:
+                    self.release(key)
+            # The runner goes faster than real time, so it waits for
+            # levels to load instead of running frames while they load.
+            # (This means the same inputs always give the same game)
+            transition = self.view.transition
+            if (
+                transition is not None
+                and transition.phase == TRANSITION_LOADING
+                ):
+                self.view.prefetcher.wait(transition.level)
+            self.view.on_update(self.delta_time)
+            self.frame += UNIT_INCREMENT
+        self.time += time.perf_counter() - start
+
+    def play_back(self, recording):
+        """
+        Plays back a recording until every step in it has been played
+        (or the game ends).
+        """
+        self.view.replay = recording
+        # Each update runs at most one step, and none while the level is
+        # changing, so the updates are run until every step has been.
+        while not (self.finished() or recording.finished(self.view.step_count)):
+            self.run(recording.length - self.view.step_count)
+
+    def stats(self):
+        """Returns how far the game got and how fast it ran."""
+        return {
+            "frames": self.frame,
+            "seconds": self.time,
+            "frames_per_second": self.frame / max(self.time, FRAMERATE),
+            "level": self.view.level,
+            "player_position": tuple(self.view.player_sprite.position),
+            "finished": self.finished(),
+        }
+
+
+def parse_key_events(text):
+    """
+    Turns key events written as "frame+KEY" (pressed) or "frame-KEY"
+    (released), separated by commas, into (frame, pressed, key) tuples.
+    Key names are the ones in arcade.key, e.g. "5+RIGHT,60+UP,62-UP".
+    """
+    key_events = []
+    for event in text.split(","):
+        match = re.fullmatch(r"\s*(\d+)([+-])(\w+)\s*", event)
+        if match is None or not hasattr(arcade.key, match[3].upper()):
+            raise argparse.ArgumentTypeError(f"bad key event: {event!r}")
+        key_events.append(
+            (
+                int(match[1]),
+                match[2] == "+",
+                getattr(arcade.key, match[3].upper()),
+            )
+        )
+    return key_events
+
+
+def simulate(level="1.1", frames=HEADLESS_FRAMES, key_events=(), trace=None):
+    """
+    Runs the game without a window and prints how fast it ran and
+    where the player ended up. If a trace file is given the timeline
+    of the game is saved to it.
+    """
+    tracer = Tracer() if trace is not None else None
+    runner = HeadlessRunner(level, tracer=tracer)
+    runner.run(frames, key_events)
+    runner.close()
+    if tracer is not None:
+        tracer.save(trace)
+    stats = runner.stats()
+    print(
+        f"{stats['frames']} frames in {stats['seconds']:.3f} s"
+        +f" ({stats['frames_per_second']:.0f} frames per second),"
+        +f" ended in level {stats['level']}"
+        +f" at {stats['player_position']}"
+        +(" (game finished)" if stats["finished"] else "")
+        )
+
+# Input recordings
+class InputRecording:
+    """
+    The keys pressed and released while playing, each with the game
+    step it happened before, and the level the game started in.
+    A recording can be played back into a GameView, which then plays
+    out exactly the same way as when it was recorded.
+    """
+
+    def __init__(self, level="1.1", events=None, length=NOTHING):
+        """
+        Initialises the recording.
+        level:      The level the recording starts in.
+        events:     The (step, pressed, key) key events in the order
+                    they happened.
+        length:     The number of steps recorded.
+        position:   The index of the next event to play back.
+        """
+        self.level = level
+        self.events = events if events is not None else []
+        self.length = length
+        self.position = NOTHING
+
+    def record(self, step, pressed, key):
+        """Adds a key event which happened before the given step."""
+        self.events.append((step, pressed, key))
+
+    def apply(self, view, step):
+        """
+        Presses and releases the keys in a view which were pressed or
+        released before the given step.
+        """
+        while (
+            self.position < len(self.events)
+            and self.events[self.position][FIRST_VALUE] <= step
+            ):
+            _, pressed, key = self.events[self.position]
+            if pressed:
+                view.press_key(key)
+            else:
+                view.release_key(key)
+            self.position += UNIT_INCREMENT
+
+    def finished(self, step):
+        """Returns True once every recorded step has been played."""
+        return step >= self.length
+
+    def save(self, path):
+        """Writes the recording to a file."""
+        level_bytes = self.level.encode()
+        with open(path, "wb") as file:
+            file.write(struct.pack(
+                RECORDING_HEADER,
+                RECORDING_MAGIC,
+                RECORDING_VERSION,
+                self.length,
+                len(self.events),
+                len(level_bytes),
+            ))
+            file.write(level_bytes)
+            for step, pressed, key in self.events:
+                file.write(struct.pack(RECORDING_EVENT, step, key, pressed))
+
+
+def load_recording(path):
+    """
+    Reads a recording saved by InputRecording.save.
+    Raises ValueError if the file isn't a recording this version of the
+    game can play.
+    """
+    with open(path, "rb") as file:
+        data = file.read()
+    header_size = struct.calcsize(RECORDING_HEADER)
+    event_size = struct.calcsize(RECORDING_EVENT)
+    try:
+        magic, version, length, event_count, level_length = (
+            struct.unpack_from(RECORDING_HEADER, data)
+            )
+    except struct.error:
+        raise ValueError(f"{path} is not an input recording")
+    if magic != RECORDING_MAGIC:
+        raise ValueError(f"{path} is not an input recording")
+    if version != RECORDING_VERSION:
+        raise ValueError(
+            f"{path} is a version {version} recording"
+            +f" (version {RECORDING_VERSION} is needed)"
+            )
+    level = data[header_size:header_size + level_length].decode()
+    start = header_size + level_length
+    if len(data) != start + event_count * event_size:
+        raise ValueError(f"{path} is cut short")
+    events = [
+        (step, bool(pressed), key)
+        for step, key, pressed in struct.iter_unpack(
+            RECORDING_EVENT, data[start:]
+            )
+    ]
+    return InputRecording(level, events, length)
+
+
+def play(level="1.1", recording=None, replay=None, tracer=None):
+    """
+    Opens the game straight into a level (skipping the menus), either
+    recording the keys pressed or playing back a recording, and
+    recording the timeline of the game if a tracer is given.
+    Returns the game view once the window is closed.
+    """
+    window = arcade.Window(
+        SCREEN_WIDTH, SCREEN_HEIGHT, SCREEN_TITLE, update_rate=RENDER_RATE
+        )
+    game_view = GameView(window)
+    game_view.level = level
+    game_view.recording = recording
+    game_view.replay = replay
+    if tracer is not None:
+        game_view.start_tracing(tracer)
+    window.show_view(game_view)
+    run_event_loop(RENDER_RATE)
+    game_view.prefetcher.close()
+    return game_view
+
+
+def record(path, level="1.1", trace=None):
+    """
+    Plays the game from a level and saves the keys pressed to a file
+    (and the timeline to the trace file if one is given) when the
+    window is closed.
+    """
+    recording = InputRecording(level)
+    tracer = Tracer() if trace is not None else None
+    game_view = play(level, recording=recording, tracer=tracer)
+    recording.length = game_view.step_count
+    recording.save(path)
+    if tracer is not None:
+        tracer.save(trace)
+    print(
+        f"Recorded {len(recording.events)} key events over"
+        +f" {recording.length} steps to {path}"
+        )
+
+
+def replay(path, headless=False, trace=None):
+    """
+    Plays back a recording, in a window or without one. Without one
+    the game runs as fast as it can, and how fast it ran is printed.
+    If a trace file is given the timeline of the game is saved to it.
+    """
+    recording = load_recording(path)
+    tracer = Tracer() if trace is not None else None
+    if not headless:
+        play(recording.level, replay=recording, tracer=tracer)
+        if tracer is not None:
+            tracer.save(trace)
+        return
+    runner = HeadlessRunner(recording.level, tracer=tracer)
+    runner.play_back(recording)
+    runner.close()
+    if tracer is not None:
+        tracer.save(trace)
+    stats = runner.stats()
+    print(
+        f"Replayed {runner.view.step_count} steps in {stats['seconds']:.3f} s"
+        +f" ({stats['frames_per_second']:.0f} frames per second),"
+        +f" ended in level {stats['level']}"
+        +f" at {stats['player_position']}"
+        +(" (game finished)" if stats["finished"] else "")
+        )
+
+def replay_check_runner(level, warp=None):
+    """
+    Starts a headless game in a level, with the player at the warp door
+    to the warp level if one is given.
+    """
+    runner = HeadlessRunner(level)
+    if warp is not None:
+        doors = [
+            door for door in runner.view.doors.values()
+            if door["warp"] == warp
+            ]
+        if not doors:
+            runner.close()
+            raise ValueError(f"level {level} has no warp door to {warp}")
+        runner.view.player_sprite.position = doors[FIRST_VALUE]["pos"]
+    return runner
+
+
+def replay_check_state(runner):
+    """Returns the parts of a game a replay has to end up matching."""
+    return {
+        "steps": runner.view.step_count,
+        "level": runner.view.level,
+        "player_position": tuple(runner.view.player_sprite.position),
+        "finished": runner.finished(),
+        }
+
+
+def check_replay(
+    level=REPLAY_CHECK_LEVEL,
+    warp=REPLAY_CHECK_WARP,
+    frames=REPLAY_CHECK_FRAMES,
+    runs=REPLAY_CHECK_RUNS,
+    ):
+    """
+    Records each list of key events in a headless game, plays the
+    recording back in a new one and prints how both ended.
+    Returns whether every replay ended the same way as its recorded run.
+    """
+    matches = True
+    for run_number, key_events in enumerate(runs, start=INDEX_OFFSET):
+        recording = InputRecording(level)
+        runner = replay_check_runner(level, warp)
+        runner.view.recording = recording
+        runner.run(frames, key_events)
+        recording.length = runner.view.step_count
+        recorded = replay_check_state(runner)
+        runner.close()
+
+        runner = replay_check_runner(level, warp)
+        runner.play_back(recording)
+        replayed = replay_check_state(runner)
+        runner.close()
+
+        print(f"Run {run_number} recorded: {recorded}")
+        print(f"Run {run_number} replayed: {replayed}")
+        if recorded != replayed:
+            print("The replay did not end the same way as the recording")
+            matches = False
+    if matches:
+        print("Every replay matches its recording")
+    return matches
+
+# Physics benchmark
+def run_scripted_physics(level, engine_name, frames, spatial_hash=False):
+    """
+    Moves a player through a level with arcade's PhysicsEnginePlatformer
+    ("arcade", using the tile sprites) or the GridPhysicsEngine ("grid",
+    using the collision grids). The player runs, jumping whenever it
+    can and turning around every few seconds.
+    Returns the time taken per frame (in seconds) and the player's
+    position and speed after every frame.
+    If spatial_hash is True every sprite list arcade's engine checks
+    gets a spatial hash, since without one arcade checks lists on the
+    GPU, which needs a window. (This only changes which sprites are
+    checked, not what the player collides with)
+    """
+    # Each engine gets its own copy of the level so the moving
+    # platforms start in the same place.
+    map_name = f"{MAIN_PATH}/maps/{level}.tmx"
+    tile_map = load_level(map_name, TILE_SCALING, LAYER_OPTIONS)
+    player = PlayerCharacter(PLAYER_SHAPE_HUMAN)
+    player.center_x = tile_map.tile_width * TILE_SCALING * PLAYER_START_X
+    player.center_y = tile_map.tile_height * TILE_SCALING * PLAYER_START_Y
+    wall_layers = [LAYER_NAME_PLATFORMS]
+    if LAYER_NAME_DOOR_BARRIERS_CLOSED in tile_map.sprite_lists:
+        wall_layers.append(LAYER_NAME_DOOR_BARRIERS_CLOSED)
+    if engine_name == "arcade":
+        platforms = tile_map.sprite_lists[LAYER_NAME_MOVING_PLATFORMS]
+        ladders = tile_map.sprite_lists[LAYER_NAME_LADDERS]
+        walls = [tile_map.sprite_lists[name] for name in wall_layers]
+        if spatial_hash:
+            for sprite_list in [platforms, ladders] + walls:
+                if sprite_list.spatial_hash is None:
+                    sprite_list.enable_spatial_hashing()
+        engine = arcade.PhysicsEnginePlatformer(
+            player,
+            platforms=platforms,
+            gravity_constant=GRAVITY,
+            ladders=ladders,
+            walls=walls,
+        )
+    else:
+        engine = GridPhysicsEngine(
+            player,
+            platforms=tile_map.sprite_lists[LAYER_NAME_MOVING_PLATFORMS],
+            gravity_constant=GRAVITY,
+            ladders=tile_map.collision_grids[LAYER_NAME_LADDERS],
+            walls=[tile_map.collision_grids[name] for name in wall_layers],
+        )
+
+    path = []
+    direction = ONE_BLOCK
+    start = time.perf_counter()
+    for frame in range(frames):
+        if frame % BENCHMARK_TURN_FRAMES == NOTHING:
+            direction = -direction
+        player.change_x = -direction * PLAYER_RUN_SPEED
+        if engine.can_jump():
+            player.change_y = PLAYER_JUMP_SPEED
+        engine.update()
+        path.append((player.position, player.change_x, player.change_y))
+    return (time.perf_counter() - start) / frames, path
+
+
+def benchmark_physics(level="1.1", frames=BENCHMARK_FRAMES):
+    """
+    Moves a player through a level with each physics engine (see
+    run_scripted_physics), and prints how long each engine took per
+    frame and whether the player ended up in the same place.
+    """
+    # Arcade's engine needs a window for some collision checks.
+    window = arcade.Window(
+        SCREEN_WIDTH, SCREEN_HEIGHT, SCREEN_TITLE, visible=False
+        )
+    results = {}
+    for engine_name in ["arcade", "grid"]:
+        frame_time, path = run_scripted_physics(level, engine_name, frames)
+        results[engine_name] = (frame_time, path[-INDEX_OFFSET][FIRST_VALUE])
+        print(
+            f"{engine_name:>6}: {frame_time*1000:.3f}"
+            +f" ms per frame, player ended at"
+            +f" {results[engine_name][INDEX_OFFSET]}"
+            )
+    print(
+        f"Speed up: {results['arcade'][0] / results['grid'][0]:.1f}x, "
+        +"same path: "
+        +str(results["arcade"][INDEX_OFFSET] == results["grid"][INDEX_OFFSET])
+        )
+    window.close()
+
+
+def check_physics(levels=None, frames=BENCHMARK_FRAMES):
+    """
+    Runs the same movement through both physics engines in every level
+    (every map in the maps folder if none are given) without a window,
+    and prints the first frame where the player's position or speed
+    differ.
+    Returns whether the engines matched on every frame of every level.
+    """
+    if levels is None:
+        levels = sorted(
+            path.stem for path in Path(f"{MAIN_PATH}/maps").glob("*.tmx")
+            )
+    arcade.set_window(HeadlessWindow())
+    matches = True
+    for level in levels:
+        _, arcade_path = run_scripted_physics(level, "arcade", frames, True)
+        _, grid_path = run_scripted_physics(level, "grid", frames)
+        for frame, (expected, result) in enumerate(
+            zip(arcade_path, grid_path)
+            ):
+            if expected != result:
+                print(
+                    f"{level}: the engines differ after frame {frame}"
+                    +f" (arcade {expected}, grid {result})"
+                    )
+                matches = False
+                break
+        else:
+            print(f"{level}: the engines match for {frames} frames")
+    return matches
+
+# Level benchmarks
+def bench_key_events(frames=BENCH_FRAMES):
+    """
+    Returns the (frame, pressed, key) key events of the scripted
+    player used by the benchmarks.
+    """
+    key_events = [(FIRST_VALUE, True, arcade.key.RIGHT)]
+    direction = arcade.key.RIGHT
+    for frame in range(INDEX_OFFSET, frames):
+        if frame % BENCHMARK_TURN_FRAMES == NOTHING:
+            key_events.append((frame, False, direction))
+            if direction == arcade.key.RIGHT:
+                direction = arcade.key.LEFT
+            else:
+                direction = arcade.key.RIGHT
+            key_events.append((frame, True, direction))
+        if frame % BENCH_JUMP_FRAMES == NOTHING:
+            key_events.append((frame, True, arcade.key.UP))
+        if frame % BENCH_JUMP_FRAMES == BENCH_JUMP_HOLD_FRAMES:
+            key_events.append((frame, False, arcade.key.UP))
+    return key_events
+
+
+def wait_for_prefetching(view):
+    """
+    Waits for the levels being loaded in the background to finish, so
+    they don't slow down what is being timed.
+    """
+    for level in list(view.prefetcher.pending):
+        view.prefetcher.wait(level)
+
+
+def clear_load_caches(level):
+    """
+    Forgets everything that makes loading a level quicker after the
+    first time: the compiled copy of its map, and the textures loaded
+    by the game and by arcade. (Textures already sent to the GPU stay
+    there)
+    """
+    try:
+        os.remove(f"{MAIN_PATH}/maps/{level}.tmx{LEVEL_CACHE_EXTENSION}")
+    except FileNotFoundError:
+        pass
+    TEXTURE_REGISTRY.clear()
+    arcade.cleanup_texture_cache()
+
+
+def benchmark_level(level, frames=BENCH_FRAMES, draw=True):
+    """
+    Times setting up a level with nothing cached (cold, which compiles
+    the map and loads every texture again) and again from the level
+    cache (warm), then updating it for a number of frames
+    with the scripted player and drawing each frame (if there is an
+    OpenGL context and draw is True).
+    Returns the times and the number of sprites in each layer.
+    """
+    window = arcade.get_window()
+    draw = draw and window.ctx is not None
+    # Every level's cold setup starts from nothing, not just the first
+    # level benchmarked.
+    clear_load_caches(level)
+    view = GameView(window, music=False)
+    view.level = level
+
+    start = time.perf_counter()
+    view.setup()
+    cold_setup = time.perf_counter() - start
+    wait_for_prefetching(view)
+    start = time.perf_counter()
+    view.setup()
+    warm_setup = time.perf_counter() - start
+    wait_for_prefetching(view)
+    sprites = {
+        layer_name: len(sprite_list)
+        for layer_name, sprite_list in view.scene.name_mapping.items()
+    }
+
+    events = {}
+    for frame, pressed, key in bench_key_events(frames):
+        events.setdefault(frame, []).append((pressed, key))
+    update_times = []
+    draw_times = []
+    for frame in range(frames):
+        # Stop if the scripted player happens to finish the game.
+        if isinstance(window.current_view, EndScreen):
+            break
+        for pressed, key in events.get(frame, []):
+            if pressed:
+                view.on_key_press(key, NOTHING)
+            else:
+                view.on_key_release(key, NOTHING)
+        transition = view.transition
+        if transition is not None and transition.phase == TRANSITION_LOADING:
+            view.prefetcher.wait(transition.level)
+        start = time.perf_counter()
+        view.on_update(SIMULATION_STEP)
+        update_times.append(time.perf_counter() - start)
+        if draw:
+            # Wait for the GPU to finish, so the time is the whole draw.
+            start = time.perf_counter()
+            view.on_draw()
+            window.ctx.finish()
+            draw_times.append(time.perf_counter() - start)
+    view.prefetcher.close()
+
+    return {
+        "cold_setup_ms": cold_setup * 1000,
+        "warm_setup_ms": warm_setup * 1000,
+        "update": summarise_times(update_times),
+        "draw": summarise_times(draw_times) if draw_times else None,
+        "frames": len(update_times),
+        "end_level": view.level,
+        "sprites": sprites,
+    }
+
+
+def machine_metadata(window):
+    """Returns what the benchmarks are being run on."""
+    return {
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpus": os.cpu_count(),
+        "python": platform.python_version(),
+        "arcade": arcade.VERSION,
+        "pyglet": pyglet.version,
+        "renderer": (
+            window.ctx.info.RENDERER if window.ctx is not None else None
+            ),
+    }
+
+
+def benchmark_levels(levels=None, frames=BENCH_FRAMES, draw=True):
+    """
+    Benchmarks every level (every map in the maps folder if none are
+    given), in a hidden window if one can be opened or without one
+    otherwise, and returns the results.
+    """
+    if levels is None:
+        levels = sorted(
+            path.stem for path in Path(f"{MAIN_PATH}/maps").glob("*.tmx")
+            )
+    window = None
+    if draw:
+        # Opening a window fails without a display (or OpenGL), in
+        # which case nothing is drawn.
         try:
-            player_collision_list = arcade.check_for_collision_with_list(
-                self.player_sprite, self.scene[LAYER_NAME_GOAL]
+            window = arcade.Window(
+                SCREEN_WIDTH, SCREEN_HEIGHT, SCREEN_TITLE, visible=False
                 )
-            for collision in player_collision_list:
-                # If the destination level is 4 end the game and show
-                # the end screen.
-                if collision.warp == "4":
-                    end_view = EndScreen(self.secrets_found)
-                    self.window.show_view(end_view)
-                    return
-                else:
-                    # Otherwise teleport the player to the next level
-                    # and run the setup, placing the player at the
-                    # target position.
-                    self.level = collision.warp
-                    self.spawnpoint = collision.dest
-                    self.setup()
-                # Once this code runs the update code should stop
-                # running and everything resets for the start of the
-                # next level.
-                return
-        except:
-            pass
-        
-        # Center the camera on the player.
-        self.center_camera_to_player()
+        except Exception:
+            window = None
+    if window is None:
+        window = HeadlessWindow()
+        arcade.set_window(window)
+    results = {
+        "machine": machine_metadata(window),
+        "frames": frames,
+        "levels": {},
+    }
+    for level in levels:
+        results["levels"][level] = benchmark_level(level, frames, draw)
+        level_results = results["levels"][level]
+        print(
+            f"{level:>4}: setup {level_results['cold_setup_ms']:.1f} ms cold,"
+            +f" {level_results['warm_setup_ms']:.1f} ms warm,"
+            +f" update {level_results['update']['mean_ms']:.3f} ms"
+            +(
+                f", draw {level_results['draw']['mean_ms']:.3f} ms"
+                if level_results["draw"] is not None else ""
+            )
+            )
+    window.close()
+    return results
+
+
+def compare_benchmarks(results, baseline, threshold=BENCH_THRESHOLD):
+    """
+    Prints the times which are slower than in the baseline results by
+    more than the threshold, and returns how many there are.
+    Times either run doesn't have (e.g. drawing without a window) are
+    skipped.
+    """
+    regressions = NOTHING
+    for level, level_results in results["levels"].items():
+        baseline_level = baseline["levels"].get(level)
+        if baseline_level is None:
+            continue
+        for keys in BENCH_COMPARED:
+            new_time, old_time = level_results, baseline_level
+            for key in keys:
+                new_time = new_time[key] if new_time is not None else None
+                old_time = old_time[key] if old_time is not None else None
+            if new_time is None or old_time is None:
+                continue
+            # (How much slower it got, in ms)
+            slower = new_time - old_time
+            if (
+                slower > old_time * threshold
+                and slower > BENCH_MIN_DIFFERENCE
+                ):
+                regressions += UNIT_INCREMENT
+                print(
+                    f"Regression in {level} {'.'.join(keys)}:"
+                    +f" {old_time:.3f} -> {new_time:.3f}"
+                    +f" ({slower / old_time:+.0%})"
+                    )
+    if regressions == NOTHING:
+        print("No regressions")
+    return regressions
+
+
+def bench(
+    output=None,
+    levels=None,
+    frames=BENCH_FRAMES,
+    draw=True,
+    baseline=None,
+    threshold=BENCH_THRESHOLD,
+):
+    """
+    Benchmarks the levels, saving the results to the output file and
+    comparing them with the baseline file (if they are given).
+    Returns the number of regressions found.
+    """
+    results = benchmark_levels(levels, frames, draw)
+    if output is not None:
+        with open(output, "w") as file:
+            json.dump(results, file, indent=2)
+    if baseline is None:
+        return NOTHING
+    with open(baseline) as file:
+        return compare_benchmarks(results, json.load(file), threshold)
+
+# Stress maps
+def stress_tile_layer(layer_id, name, tiles, width, height):
+    """
+    Returns the TMX of a tile layer, from its tile ids in rows from the
+    top of the map.
+    """
+    rows = [
+        ",".join(map(str, tiles[row*width:(row+INDEX_OFFSET)*width]))
+        for row in range(height)
+    ]
+    return (
+        f' <layer id="{layer_id}" name="{name}"'
+        +f' width="{width}" height="{height}">\n'
+        +'  <data encoding="csv">\n'
+        +",\n".join(rows)
+        +"\n</data>\n </layer>\n"
+    )
+
+
+def stress_object_layer(layer_id, name, objects, first_id):
+    """
+    Returns the TMX of an object layer of points, from their (x, y)
+    tile positions (counting down from the top of the map) and custom
+    properties.
+    """
+    lines = [f' <objectgroup id="{layer_id}" name="{name}">']
+    for object_id, (x, y, properties) in enumerate(objects, first_id):
+        # Each object is put in the middle of its tile.
+        lines.append(
+            f'  <object id="{object_id}"'
+            +f' x="{(x+HALF_BLOCK)*STRESS_TILE_SIZE}"'
+            +f' y="{(y+HALF_BLOCK)*STRESS_TILE_SIZE}">'
+            )
+        lines.append("   <properties>")
+        for property_name, value in properties.items():
+            if isinstance(value, bool):
+                lines.append(
+                    f'    <property name="{property_name}" type="bool"'
+                    +f' value="{str(value).lower()}"/>'
+                    )
+            elif isinstance(value, int):
+                lines.append(
+                    f'    <property name="{property_name}" type="int"'
+                    +f' value="{value}"/>'
+                    )
+            else:
+                lines.append(
+                    f'    <property name="{property_name}" value="{value}"/>'
+                    )
+        lines.append("   </properties>")
+        lines.append("   <point/>")
+        lines.append("  </object>")
+    lines.append(" </objectgroup>")
+    return "\n".join(lines) + "\n"
+
+
+def generate_stress_map(
+    name,
+    width=1000,
+    height=1000,
+    density=STRESS_DENSITY,
+    cave_density=STRESS_CAVE_DENSITY,
+    enemies=None,
+    orbs=None,
+    collectibles=None,
+    villagers=None,
+    doors=None,
+    seed=STRESS_SEED,
+):
+    """
+    Writes a random map with the given size into the stress maps
+    folder and returns its level name (which can be used like any
+    other level, e.g. "stress/big").
+    The map has solid ground along the bottom, platform and cave tiles
+    scattered above it, and enemies, orbs, collectibles, villagers and
+    warp doors anywhere above the ground. Object counts which aren't
+    given are worked out from the size of the map. The warp doors and
+    the goal portal lead back to the same map.
+    """
+    rng = random.Random(seed)
+    level = f"{STRESS_FOLDER}/{name}"
+    map_name = f"{MAIN_PATH}/maps/{level}.tmx"
+    os.makedirs(os.path.dirname(map_name), exist_ok=True)
+    area = width * height
+    if enemies is None:
+        enemies = int(area * STRESS_ENEMIES_PER_TILE)
+    if orbs is None:
+        orbs = int(area * STRESS_ORBS_PER_TILE)
+    if collectibles is None:
+        collectibles = int(area * STRESS_COLLECTIBLES_PER_TILE)
+    if villagers is None:
+        villagers = int(area * STRESS_VILLAGERS_PER_TILE)
+    if doors is None:
+        doors = int(area * STRESS_DOORS_PER_TILE)
+
+    # The tiles are stored in rows from the top of the map, like TMX,
+    # while the positions used here count up from the bottom.
+    platforms = array("I", bytes(area * array("I").itemsize))
+    cave = array("I", bytes(area * array("I").itemsize))
+    for y in range(min(STRESS_GROUND_HEIGHT, height)):
+        row = (height - INDEX_OFFSET - y) * width
+        tile = STRESS_GRASS_TILE
+        if y < STRESS_GROUND_HEIGHT - INDEX_OFFSET:
+            tile = STRESS_GROUND_TILE
+        for x in range(width):
+            platforms[row + x] = tile
+    for y in range(STRESS_GROUND_HEIGHT + STRESS_CLEARANCE, height):
+        row = (height - INDEX_OFFSET - y) * width
+        for x in range(width):
+            roll = rng.random()
+            if roll < density:
+                platforms[row + x] = STRESS_GROUND_TILE
+            elif roll < density + cave_density:
+                cave[row + x] = STRESS_CAVE_TILE
+    empty = array("I", bytes(area * array("I").itemsize))
+
+    def air_position():
+        """Returns a random tile position above the ground."""
+        return (
+            rng.randrange(width),
+            rng.randrange(min(STRESS_GROUND_HEIGHT, height-1), height),
+        )
+
+    quest_ids = list(QuestEngine().quests)
+    object_layers = {
+        LAYER_NAME_ENEMIES: [],
+        LAYER_NAME_ORBS: [],
+        LAYER_NAME_COLLECTIBLES: [],
+        LAYER_NAME_VILLAGERS: [],
+        LAYER_NAME_WARP_DOORS: [],
+        LAYER_NAME_GOAL: [],
+    }
+    for count in range(enemies):
+        x, y = air_position()
+        object_layers[LAYER_NAME_ENEMIES].append((x, y, {
+            "boundary_left": x - STRESS_ENEMY_RANGE,
+            "boundary_right": x + STRESS_ENEMY_RANGE,
+            "can_kill": True,
+            "drop": "Ectoplasm",
+            "type": STRESS_ENEMY_TYPES[count % len(STRESS_ENEMY_TYPES)],
+        }))
+    for count in range(orbs):
+        object_layers[LAYER_NAME_ORBS].append(
+            air_position() + ({"type": "Energy"},)
+            )
+    for count in range(collectibles):
+        object_layers[LAYER_NAME_COLLECTIBLES].append(
+            air_position() + ({
+                "type": STRESS_COLLECTIBLE_TYPES[
+                    count % len(STRESS_COLLECTIBLE_TYPES)
+                    ],
+            },)
+            )
+    for count in range(villagers):
+        object_layers[LAYER_NAME_VILLAGERS].append(
+            air_position() + ({"id": quest_ids[count % len(quest_ids)]},)
+            )
+    for count in range(doors):
+        object_layers[LAYER_NAME_WARP_DOORS].append(air_position() + ({
+            "dest_x": PLAYER_START_X,
+            "dest_y": PLAYER_START_Y,
+            "key_req": "None",
+            "warp": level,
+        },))
+    object_layers[LAYER_NAME_GOAL].append(air_position() + ({
+        "dest_x": PLAYER_START_X,
+        "dest_y": PLAYER_START_Y,
+        "warp": level,
+    },))
+
+    # The positions in TMX count down from the top of the map.
+    tileset = os.path.relpath(
+        f"{MAIN_PATH}/maps/{STRESS_TILESET}", os.path.dirname(map_name)
+        )
+    # (Every level needs a background, ladder and moving platform
+    # layer, even if they are empty)
+    tile_layers = [
+        (LAYER_NAME_BACKGROUND, empty),
+        (LAYER_NAME_PLATFORMS, platforms),
+        (LAYER_NAME_CAVE, cave),
+        (LAYER_NAME_LADDERS, empty),
+        (LAYER_NAME_MOVING_PLATFORMS, empty),
+    ]
+    layer_id = INDEX_OFFSET
+    object_id = INDEX_OFFSET
+    with open(map_name, "w") as file:
+        file.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            +'<map version="1.10" tiledversion="1.10.2"'
+            +' orientation="orthogonal" renderorder="right-down"'
+            +f' width="{width}" height="{height}"'
+            +f' tilewidth="{STRESS_TILE_SIZE}"'
+            +f' tileheight="{STRESS_TILE_SIZE}"'
+            +' infinite="0"'
+            +f' nextlayerid="{len(tile_layers) + len(object_layers) + 1}"'
+            +f' nextobjectid="{sum(map(len, object_layers.values())) + 1}">\n'
+            +f' <tileset firstgid="1" source="{tileset}"/>\n'
+            )
+        for layer_name, tiles in tile_layers:
+            file.write(
+                stress_tile_layer(layer_id, layer_name, tiles, width, height)
+                )
+            layer_id += UNIT_INCREMENT
+        for layer_name, objects in object_layers.items():
+            objects = [
+                (x, height - INDEX_OFFSET - y, properties)
+                for x, y, properties in objects
+            ]
+            file.write(
+                stress_object_layer(layer_id, layer_name, objects, object_id)
+                )
+            layer_id += UNIT_INCREMENT
+            object_id += len(objects)
+        file.write("</map>\n")
+    return level
+
+
+def stress_curve(sizes=STRESS_SIZES, frames=BENCH_FRAMES, draw=False):
+    """
+    Makes a square stress map of each size (with the default densities)
+    and benchmarks them, printing how the setup and frame times grow
+    with the size of the world. Returns the benchmark results.
+    """
+    levels = [
+        generate_stress_map(f"{size}x{size}", size, size) for size in sizes
+        ]
+    results = benchmark_levels(levels, frames, draw)
+    print(
+        f"{'size':>10}{'sprites':>10}{'setup ms':>10}"
+        +f"{'update ms':>11}{'p95 ms':>9}{'draw ms':>9}"
+        )
+    for size, level in zip(sizes, levels):
+        level_results = results["levels"][level]
+        draw_results = level_results["draw"]
+        print(
+            f"{f'{size}x{size}':>10}"
+            +f"{sum(level_results['sprites'].values()):>10}"
+            +f"{level_results['cold_setup_ms']:>10.1f}"
+            +f"{level_results['update']['mean_ms']:>11.3f}"
+            +f"{level_results['update']['p95_ms']:>9.3f}"
+            +(
+                f"{draw_results['mean_ms']:>9.3f}"
+                if draw_results is not None else f"{'-':>9}"
+            )
+            )
+    return results
 
 # Main Program
 
@@ -3373,12 +8099,219 @@ def main():
     """Main Function"""
     # Set the first view shown to the MainMenu() view.
     # Display the view and start the game.
-    window = arcade.Window(SCREEN_WIDTH, SCREEN_HEIGHT, SCREEN_TITLE)
+    # The window starts at the menu frame rate and the game view
+    # changes it to RENDER_RATE. (See run_event_loop)
+    window = arcade.Window(
+        SCREEN_WIDTH, SCREEN_HEIGHT, SCREEN_TITLE, update_rate=MENU_FRAME_RATE
+        )
     start_view = MainMenu()
     window.show_view(start_view)
-    arcade.run()
+    run_event_loop(MENU_FRAME_RATE)
+
+# Command line
+def run_command_line(arguments=None):
+    """
+    Runs the command given on the command line, or the game if there
+    isn't one.
+    """
+    parser = argparse.ArgumentParser(description=SCREEN_TITLE)
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser(
+        "build-atlas", help="pack the sprite images into the atlas"
+        )
+    bench_physics = commands.add_parser(
+        "bench-physics", help="compare arcade's and the grid physics engine"
+        )
+    bench_physics.add_argument("level", nargs="?", default="1.1")
+    bench_physics.add_argument(
+        "frames", nargs="?", type=int, default=BENCHMARK_FRAMES
+        )
+    check_physics_command = commands.add_parser(
+        "check-physics",
+        help="check the grid physics engine moves like arcade's (no window)",
+        )
+    check_physics_command.add_argument("levels", nargs="*")
+    check_physics_command.add_argument(
+        "--frames", type=int, default=BENCHMARK_FRAMES
+        )
+    simulate_command = commands.add_parser(
+        "simulate", help="run the game without a window"
+        )
+    simulate_command.add_argument("level", nargs="?", default="1.1")
+    simulate_command.add_argument(
+        "--frames", type=int, default=HEADLESS_FRAMES
+        )
+    simulate_command.add_argument(
+        "--keys",
+        type=parse_key_events,
+        default=[],
+        help='key presses and releases, e.g. "5+RIGHT,60+UP,62-UP"',
+        )
+    record_command = commands.add_parser(
+        "record", help="play a level and save the keys pressed"
+        )
+    record_command.add_argument("file")
+    record_command.add_argument("--level", default="1.1")
+    replay_command = commands.add_parser(
+        "replay", help="play back the keys saved by record"
+        )
+    replay_command.add_argument("file")
+    replay_command.add_argument(
+        "--headless",
+        action="store_true",
+        help="play back without a window, as fast as possible",
+        )
+    check_replay_command = commands.add_parser(
+        "check-replay",
+        help="check that a recorded headless run replays the same way",
+        )
+    check_replay_command.add_argument(
+        "level", nargs="?", default=REPLAY_CHECK_LEVEL
+        )
+    check_replay_command.add_argument(
+        "--warp",
+        default=REPLAY_CHECK_WARP,
+        help="start at the warp door to this level (\"none\" for the start)",
+        )
+    check_replay_command.add_argument(
+        "--frames", type=int, default=REPLAY_CHECK_FRAMES
+        )
+    check_replay_command.add_argument(
+        "--keys",
+        type=parse_key_events,
+        help='key presses and releases to check instead of the usual runs',
+        )
+    for command in [simulate_command, record_command, replay_command]:
+        command.add_argument(
+            "--trace",
+            help="file to save a Chrome trace of the game's timeline to",
+            )
+    bench_command = commands.add_parser(
+        "bench", help="time loading, updating and drawing every level"
+        )
+    bench_command.add_argument("levels", nargs="*")
+    bench_command.add_argument("--output", help="file to save the results to")
+    bench_command.add_argument("--frames", type=int, default=BENCH_FRAMES)
+    bench_command.add_argument(
+        "--no-draw",
+        action="store_true",
+        help="don't open a window or time drawing",
+        )
+    bench_command.add_argument(
+        "--compare", help="results file to check for regressions against"
+        )
+    bench_command.add_argument(
+        "--threshold",
+        type=float,
+        default=BENCH_THRESHOLD,
+        help="fraction slower than the baseline which is a regression",
+        )
+    stress_map = commands.add_parser(
+        "stress-map", help="write a large random map for stress tests"
+        )
+    stress_map.add_argument("name", help='the map is level "stress/NAME"')
+    stress_map.add_argument("--width", type=int, default=1000)
+    stress_map.add_argument("--height", type=int, default=1000)
+    stress_map.add_argument(
+        "--density",
+        type=float,
+        default=STRESS_DENSITY,
+        help="fraction of the tiles above the ground which are platforms",
+        )
+    stress_map.add_argument(
+        "--cave-density", type=float, default=STRESS_CAVE_DENSITY
+        )
+    for object_kind in [
+        "enemies", "orbs", "collectibles", "villagers", "doors"
+        ]:
+        stress_map.add_argument(
+            f"--{object_kind}",
+            type=int,
+            help="how many to add (worked out from the map size if not given)",
+            )
+    stress_map.add_argument("--seed", type=int, default=STRESS_SEED)
+    stress_curve_command = commands.add_parser(
+        "stress-curve", help="benchmark stress maps of increasing size"
+        )
+    stress_curve_command.add_argument(
+        "sizes", nargs="*", type=int, default=STRESS_SIZES
+        )
+    stress_curve_command.add_argument(
+        "--frames", type=int, default=BENCH_FRAMES
+        )
+    stress_curve_command.add_argument(
+        "--draw", action="store_true", help="also time drawing (in a window)"
+        )
+    stress_curve_command.add_argument(
+        "--output", help="file to save the results to"
+        )
+    args = parser.parse_args(arguments)
+
+    if args.command == "build-atlas":
+        build_sprite_atlas()
+    elif args.command == "bench-physics":
+        benchmark_physics(args.level, args.frames)
+    elif args.command == "check-physics":
+        if not check_physics(args.levels or None, args.frames):
+            sys.exit(INDEX_OFFSET)
+    elif args.command == "simulate":
+        simulate(args.level, args.frames, args.keys, args.trace)
+    elif args.command == "record":
+        record(args.file, args.level, args.trace)
+    elif args.command == "replay":
+        replay(args.file, args.headless, args.trace)
+    elif args.command == "check-replay":
+        warp = None if args.warp == "none" else args.warp
+        runs = REPLAY_CHECK_RUNS if args.keys is None else [args.keys]
+        if not check_replay(args.level, warp, args.frames, runs):
+            sys.exit(INDEX_OFFSET)
+    elif args.command == "bench":
+        regressions = bench(
+            args.output,
+            args.levels or None,
+            args.frames,
+            not args.no_draw,
+            args.compare,
+            args.threshold,
+            )
+        # (So scripts can tell that something got slower)
+        if regressions > NOTHING:
+            sys.exit(INDEX_OFFSET)
+    elif args.command == "stress-map":
+        level = generate_stress_map(
+            args.name,
+            args.width,
+            args.height,
+            args.density,
+            args.cave_density,
+            args.enemies,
+            args.orbs,
+            args.collectibles,
+            args.villagers,
+            args.doors,
+            args.seed,
+            )
+        print(f'Wrote level "{level}" (python game.py simulate {level})')
+    elif args.command == "stress-curve":
+        results = stress_curve(args.sizes, args.frames, args.draw)
+        if args.output is not None:
+            with open(args.output, "w") as file:
+                json.dump(results, file, indent=2)
+    else:
+        main()
 
 # Things that run
 # Run the game only if this file is the main program.
+# Commands can also be given (see run_command_line), e.g.
+# "python game.py build-atlas" packs the sprite atlas,
+# "python game.py bench-physics [level] [frames]" compares the physics
+# engines (and "python game.py check-physics" checks they match without
+# a window), "python game.py simulate [level]" runs the game without
+# a window, and "python game.py record FILE" and
+# "python game.py replay FILE [--headless]" save and play back the
+# keys pressed in a playthrough, "python game.py check-replay" checks
+# that a recorded run replays the same way, "python game.py bench" times every
+# level, and "python game.py stress-map NAME" and
+# "python game.py stress-curve" make and benchmark huge random maps.
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    run_command_line()